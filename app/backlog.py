@@ -0,0 +1,40 @@
+#circular buffer holding the tail of the replication stream
+
+class ReplicationBacklog:
+    #the last `size` bytes sent to replicas, addressed by offset; allocated once, overwritten in place
+
+    def __init__(self, size, end_offset = 0):
+        self.buffer = bytearray(size)
+        self.size = size
+        self.index = 0 #where the next byte goes
+        self.histlen = 0 #valid bytes in the buffer
+        self.end_offset = end_offset #replication offset just past the newest byte
+
+    @property
+    def start_offset(self):
+        return self.end_offset - self.histlen
+
+    def feed(self, data):
+        length = len(data)
+        self.end_offset += length
+        if length >= self.size:
+            self.buffer[:] = data[length - self.size:]
+            self.index = 0
+            self.histlen = self.size
+            return
+        first = min(length, self.size - self.index)
+        self.buffer[self.index:self.index + first] = data[:first]
+        if first < length:
+            self.buffer[:length - first] = data[first:]
+        self.index = (self.index + length) % self.size
+        self.histlen = min(self.size, self.histlen + length)
+
+    def read_from(self, offset):
+        #the stream from offset up to now, or None once that part was overwritten
+        if not self.start_offset <= offset <= self.end_offset:
+            return None
+        count = self.end_offset - offset
+        start = (self.index - count) % self.size
+        if start + count <= self.size:
+            return bytes(self.buffer[start:start + count])
+        return bytes(self.buffer[start:]) + bytes(self.buffer[:count - (self.size - start)])
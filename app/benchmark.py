@@ -0,0 +1,672 @@
+#measurement harness: each scenario starts its own servers, drives them from client processes
+#and prints one JSON document per run, e.g. python -m app.benchmark load --clients 50 --mix set=1,get=4
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from app.metrics import LatencyHistogram
+from app.resp import RespParser, decode_reply
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPAWN_SCRIPT = os.path.join(ROOT, "spawn_redis_server.sh")
+
+def encode_command(*args):
+    out = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        out.append(f"${len(arg)}\r\n".encode() + arg + b"\r\n")
+    return b"".join(out)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+def read_reply(sock):
+    #one bulk or simple reply, enough for the INFO and PING calls made here
+    data = b""
+    while b"\r\n" not in data:
+        data += sock.recv(65536)
+    if data[:1] != b"$":
+        return data
+    header, _, body = data.partition(b"\r\n")
+    length = int(header[1:])
+    if length < 0:
+        return None
+    while len(body) < length + 2:
+        body += sock.recv(65536)
+    return body[:length]
+
+def keyspace_size(sock):
+    sock.sendall(encode_command("INFO", "keyspace"))
+    info = read_reply(sock).decode()
+    for field in info.split(":", 1)[-1].split(","):
+        if field.startswith("keys="):
+            return int(field[len("keys="):])
+    return 0
+
+def start_server(port, *extra_args, launcher="python"):
+    #python runs app.main, script goes through spawn_redis_server.sh, fork runs main() in a forked copy of us
+    argv = ["--port", str(port), *extra_args]
+    if launcher == "fork":
+        process = multiprocessing.get_context("fork").Process(target=serve_in_process, args=(argv,))
+        process.start()
+    else:
+        command = ["sh", SPAWN_SCRIPT] if launcher == "script" else [sys.executable, "-m", "app.main"]
+        process = subprocess.Popen(command + argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=ROOT)
+    wait_for_port(port)
+    return process
+
+def serve_in_process(argv):
+    from app import main as server
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    os.chdir(ROOT)
+    sys.argv = ["app.main", *argv]
+    server.main()
+
+def stop_server(process):
+    process.kill()
+    if isinstance(process, subprocess.Popen):
+        process.wait()
+    else:
+        process.join()
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server on port {port} did not come up")
+
+def server_rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+def connect_to_owner(port, key):
+    #connect to the node serving key, following a -MOVED like a cluster client
+    sock = socket.create_connection(("localhost", port))
+    sock.sendall(encode_command("GET", key))
+    reply = read_reply(sock)
+    if reply is not None and reply.startswith(b"-MOVED"):
+        sock.close()
+        host, _, owner_port = reply.split()[2].decode().rpartition(":")
+        sock = socket.create_connection((host, int(owner_port)))
+    return sock
+
+def drive_set_get(port, clients, duration, results, follow_moved=False):
+    value = b"xyz"
+    requests = [
+        (encode_command("SET", "key:%d" % i, value), encode_command("GET", "key:%d" % i))
+        for i in range(clients)
+    ]
+    #reply sizes are fixed, so counting bytes is enough to find reply boundaries
+    expected = (len(b"+OK\r\n"), len(b"$3\r\nxyz\r\n"))
+    selector = selectors.DefaultSelector()
+    state = {}
+    for i in range(clients):
+        if follow_moved:
+            sock = connect_to_owner(port, "key:%d" % i)
+        else:
+            sock = socket.create_connection(("localhost", port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        state[sock] = [i, 0, 0]  # client index, request kind, bytes still owed
+        selector.register(sock, selectors.EVENT_READ)
+    for sock, st in state.items():
+        sock.sendall(requests[st[0]][0])
+        st[2] = expected[0]
+
+    ops = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for key, _ in selector.select(timeout=0.1):
+            sock = key.fileobj
+            st = state[sock]
+            data = sock.recv(65536)
+            if not data:
+                raise RuntimeError("server closed the connection")
+            st[2] -= len(data)
+            if st[2] <= 0:
+                ops += 1
+                st[1] ^= 1
+                st[2] = expected[st[1]]
+                sock.sendall(requests[st[0]][st[1]])
+    for sock in state:
+        sock.close()
+    results.put(ops)
+
+def run_load(port, clients, processes, duration, follow_moved=False):
+    results = multiprocessing.Queue()
+    per_process = [clients // processes + (1 if i < clients % processes else 0) for i in range(processes)]
+    workers = [
+        multiprocessing.Process(target=drive_set_get, args=(port, n, duration, results, follow_moved))
+        for n in per_process if n
+    ]
+    for w in workers:
+        w.start()
+    total = sum(results.get() for _ in workers)
+    for w in workers:
+        w.join()
+    return total / duration
+
+def scenario_io_models(args):
+    report = {"scenario": "io-models", "connections": args.connections,
+              "clients": args.clients, "duration": args.duration, "models": {}}
+    for model in ("threaded", "eventloop"):
+        port = free_port()
+        server = start_server(port, "--io-model", model)
+        try:
+            baseline_rss = server_rss_kb(server.pid)
+            idle = []
+            for _ in range(args.connections):
+                sock = socket.create_connection(("localhost", port))
+                sock.sendall(encode_command("PING"))
+                idle.append(sock)
+            for sock in idle:
+                sock.recv(64)
+            idle_rss = server_rss_kb(server.pid)
+            ops = run_load(port, args.clients, args.processes, args.duration)
+            report["models"][model] = {
+                "rss_kb_empty": baseline_rss,
+                "rss_kb_with_idle_connections": idle_rss,
+                "rss_kb_per_connection": round((idle_rss - baseline_rss) / max(args.connections, 1), 2),
+                "ops_per_sec": round(ops),
+            }
+            for sock in idle:
+                sock.close()
+        finally:
+            stop_server(server)
+    return report
+
+def load_keys(port, keys, make_value, batch=1000):
+    sock = socket.create_connection(("localhost", port))
+    for start in range(0, keys, batch):
+        end = min(start + batch, keys)
+        sock.sendall(b"".join(encode_command("SET", b"key:%08d" % i, make_value(i)) for i in range(start, end)))
+        owed = (end - start) * len(b"+OK\r\n")
+        while owed > 0:
+            data = sock.recv(65536)
+            if not data:
+                raise RuntimeError("server closed the connection")
+            owed -= len(data)
+    sock.close()
+
+def scenario_memory(args):
+    report = {"scenario": "memory", "keys": args.keys, "values": {}}
+    value_kinds = {
+        "string": lambda i: b"value-%d" % i,
+        "integer": lambda i: b"%d" % i,
+    }
+    for kind, make_value in value_kinds.items():
+        port = free_port()
+        server = start_server(port)
+        try:
+            baseline_rss = server_rss_kb(server.pid)
+            started = time.time()
+            load_keys(port, args.keys, make_value)
+            elapsed = time.time() - started
+            loaded_rss = server_rss_kb(server.pid)
+            report["values"][kind] = {
+                "rss_kb_empty": baseline_rss,
+                "rss_kb_loaded": loaded_rss,
+                "bytes_per_key": round((loaded_rss - baseline_rss) * 1024 / args.keys, 1),
+                "load_sets_per_sec": round(args.keys / elapsed),
+            }
+        finally:
+            stop_server(server)
+    return report
+
+def ping_latency(port, stop, results):
+    #ping back to back until stop is set, recording the slowest round trip
+    sock = socket.create_connection(("localhost", port))
+    worst = 0.0
+    while not stop.is_set():
+        started = time.perf_counter()
+        sock.sendall(encode_command("PING"))
+        read_reply(sock)
+        worst = max(worst, time.perf_counter() - started)
+    sock.close()
+    results["max_ping_ms"] = round(worst * 1000, 2)
+
+def scenario_sync(args):
+    report = {"scenario": "sync", "keys": args.keys, "models": {}}
+    for model in ("threaded", "eventloop"):
+        master_port, replica_port = free_port(), free_port()
+        with tempfile.TemporaryDirectory() as master_dir, tempfile.TemporaryDirectory() as replica_dir:
+            master = start_server(master_port, "--io-model", model, "--dir", master_dir)
+            replica = None
+            stop, latency = threading.Event(), {}
+            try:
+                load_keys(master_port, args.keys, lambda i: b"value-%d" % i)
+                #a client keeps pinging the master through the sync to show it isn't blocked
+                pinger = threading.Thread(target=ping_latency, args=(master_port, stop, latency))
+                pinger.start()
+                started = time.time()
+                replica = start_server(replica_port, "--io-model", model, "--dir", replica_dir,
+                                       "--replicaof", f"localhost {master_port}")
+                sock = socket.create_connection(("localhost", replica_port))
+                while keyspace_size(sock) < args.keys:
+                    time.sleep(0.01)
+                elapsed = time.time() - started
+                sock.close()
+                stop.set()
+                pinger.join()
+                report["models"][model] = {
+                    "sync_seconds": round(elapsed, 3),
+                    "keys_per_sec": round(args.keys / elapsed),
+                    "master_max_ping_ms_during_sync": latency["max_ping_ms"],
+                }
+            finally:
+                stop.set()
+                if replica is not None:
+                    stop_server(replica)
+                stop_server(master)
+    return report
+
+def scenario_workers(args):
+    #moved clients follow the redirect once, proxy clients stay on the shared port and get forwarded
+    report = {"scenario": "workers", "cpus": os.cpu_count(), "clients": args.clients,
+              "processes": args.processes, "duration": args.duration, "workers": {}}
+    baseline = None
+    counts = sorted({1, *range(2, args.max_workers + 1, 2), args.max_workers})
+    for workers in counts:
+        result = {}
+        for routing in ("moved", "proxy"):
+            port = free_port()
+            server = start_server(port, "--workers", str(workers), "--worker-routing", routing)
+            try:
+                for i in range(workers if workers > 1 else 0):
+                    wait_for_port(port + 1 + i)
+                ops = run_load(port, args.clients, args.processes, args.duration, follow_moved=routing == "moved")
+                result[f"{routing}_ops_per_sec"] = round(ops)
+            finally:
+                server.terminate()
+                server.wait()
+        if baseline is None:
+            baseline = result["moved_ops_per_sec"]
+        result["moved_speedup"] = round(result["moved_ops_per_sec"] / baseline, 2)
+        report["workers"][workers] = result
+    return report
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in LOAD_COMMANDS:
+            raise argparse.ArgumentTypeError(f"unknown command {name!r}, expected one of {', '.join(LOAD_COMMANDS)}")
+        mix[name] = int(weight or 1)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("the mix needs a command with a positive weight")
+    return mix
+
+LOAD_COMMANDS = ("set", "get", "setpx")
+COMMAND_POOL_SIZE = 8192 #pre-encoded commands a driver process cycles through
+
+def command_pool(mix, keyspace, value, expire_ms, seed):
+    #encoded commands over random keys, built before the clock starts
+    rng = random.Random(seed)
+    names = rng.choices(list(mix), weights=list(mix.values()), k=COMMAND_POOL_SIZE)
+    pool = []
+    for name in names:
+        key = b"key:%08d" % rng.randrange(keyspace)
+        if name == "get":
+            pool.append(encode_command("GET", key))
+        elif name == "set":
+            pool.append(encode_command("SET", key, value))
+        else:
+            pool.append(encode_command("SET", key, value, "PX", expire_ms))
+    return pool
+
+def drive_mix(port, clients, pipeline, duration, pool, results):
+    #a command's latency runs from the write of its batch to the parse of its reply, as in redis-benchmark
+    selector = selectors.DefaultSelector()
+    state = {}
+    cursor = 0
+    latency = LatencyHistogram()
+    ops = errors = 0
+
+    def send_batch(sock, st):
+        nonlocal cursor
+        batch = pool[cursor:cursor + pipeline]
+        cursor = (cursor + pipeline) % len(pool)
+        if len(batch) < pipeline:
+            batch += pool[:pipeline - len(batch)]
+        st[1] = time.perf_counter_ns()
+        st[2] = pipeline
+        sock.sendall(b"".join(batch))
+
+    for _ in range(clients):
+        sock = socket.create_connection(("localhost", port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        state[sock] = [RespParser(), 0, 0]  # reply parser, batch sent at, replies still owed
+        selector.register(sock, selectors.EVENT_READ)
+    for sock, st in state.items():
+        send_batch(sock, st)
+
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for key, _ in selector.select(timeout=0.1):
+            sock = key.fileobj
+            st = state[sock]
+            data = sock.recv(65536)
+            if not data:
+                raise RuntimeError("server closed the connection")
+            parser = st[0]
+            parser.feed(data)
+            now = time.perf_counter_ns()
+            while st[2]:
+                reply = parser.next_reply()
+                if reply is None:
+                    break
+                st[2] -= 1
+                ops += 1
+                latency.record((now - st[1]) // 1000)
+                if reply[:1] == b"-":
+                    errors += 1
+            if not st[2]:
+                send_batch(sock, st)
+    for sock in state:
+        sock.close()
+    results.put((ops, errors, latency))
+
+def info_fields(sock, section):
+    sock.sendall(encode_command("INFO", section))
+    fields = {}
+    for line in read_reply(sock).decode().split("\r\n"):
+        name, sep, value = line.partition(":")
+        if sep:
+            fields[name] = value
+    return fields
+
+def wait_for_replica_sync(master_port, replica_port, timeout=60):
+    with socket.create_connection(("localhost", master_port)) as master, \
+            socket.create_connection(("localhost", replica_port)) as replica:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            online = "state=online" in info_fields(master, "replication").get("slave0", "")
+            if online and info_fields(replica, "replication").get("master_link_status") == "up":
+                return
+            time.sleep(0.05)
+    raise RuntimeError("replica did not finish its initial sync")
+
+def replica_catch_up(master_port, replica_port, timeout=60):
+    #(bytes the replica was behind when the load stopped, seconds it took to catch up)
+    with socket.create_connection(("localhost", master_port)) as master, \
+            socket.create_connection(("localhost", replica_port)) as replica:
+        target = int(info_fields(master, "replication")["master_repl_offset"])
+        started = time.time()
+        behind = None
+        while time.time() - started < timeout:
+            offset = int(info_fields(replica, "replication")["slave_repl_offset"])
+            if behind is None:
+                behind = max(target - offset, 0)
+            if offset >= target:
+                return behind, time.time() - started
+            time.sleep(0.001)
+    raise RuntimeError("replica did not catch up with the master")
+
+def command_stats(port):
+    #server side calls and usec_per_call, to compare with what the clients saw
+    with socket.create_connection(("localhost", port)) as sock:
+        stats = {}
+        for name, value in info_fields(sock, "commandstats").items():
+            fields = dict(field.split("=") for field in value.split(","))
+            stats[name[len("cmdstat_"):]] = {"calls": int(fields["calls"]),
+                                              "usec_per_call": float(fields["usec_per_call"])}
+        return stats
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def scenario_load(args):
+    #GETs need existing keys, so the keyspace is loaded before the clock starts whenever the mix reads
+    report = {"scenario": "load", "commit": current_commit(), "launcher": args.launcher,
+              "io_model": args.io_model, "clients": args.clients, "processes": args.processes,
+              "pipeline": args.pipeline, "keyspace": args.keyspace, "value_size": args.value_size,
+              "mix": args.mix, "replica": args.replica, "duration": args.duration}
+    value = b"x" * args.value_size
+    master_port = free_port()
+    replica = None
+    with tempfile.TemporaryDirectory() as master_dir, tempfile.TemporaryDirectory() as replica_dir:
+        master = start_server(master_port, "--io-model", args.io_model, "--dir", master_dir, launcher=args.launcher)
+        try:
+            if args.mix.get("get"):
+                load_keys(master_port, args.keyspace, lambda i: value)
+            if args.replica:
+                replica_port = free_port()
+                replica = start_server(replica_port, "--io-model", args.io_model, "--dir", replica_dir,
+                                       "--replicaof", f"localhost {master_port}", launcher=args.launcher)
+                wait_for_replica_sync(master_port, replica_port)
+            with socket.create_connection(("localhost", master_port)) as sock:
+                #server_commandstats then covers the measured load only
+                sock.sendall(encode_command("CONFIG", "RESETSTAT"))
+                read_reply(sock)
+
+            results = multiprocessing.Queue()
+            per_process = [args.clients // args.processes + (1 if i < args.clients % args.processes else 0)
+                           for i in range(args.processes)]
+            workers = [
+                multiprocessing.Process(target=drive_mix, args=(
+                    master_port, n, args.pipeline, args.duration,
+                    command_pool(args.mix, args.keyspace, value, args.expire_ms, seed=i), results))
+                for i, n in enumerate(per_process) if n
+            ]
+            for w in workers:
+                w.start()
+            ops = errors = 0
+            latency = LatencyHistogram()
+            for _ in workers:
+                worker_ops, worker_errors, worker_latency = results.get()
+                ops += worker_ops
+                errors += worker_errors
+                latency.merge(worker_latency)
+            for w in workers:
+                w.join()
+
+            report["requests"] = ops
+            report["errors"] = errors
+            report["ops_per_sec"] = round(ops / args.duration)
+            report["latency_usec"] = {
+                "p50": latency.percentile(50),
+                "p99": latency.percentile(99),
+                "p999": latency.percentile(99.9),
+                "max": latency.percentile(100),
+            }
+            report["server_commandstats"] = command_stats(master_port)
+            if replica is not None:
+                behind, seconds = replica_catch_up(master_port, replica_port)
+                report["replica_bytes_behind_at_stop"] = behind
+                report["replica_catch_up_seconds"] = round(seconds, 3)
+        finally:
+            if replica is not None:
+                stop_server(replica)
+            stop_server(master)
+    return report
+
+def read_through_cache(port, hot_keys, duration, tracking, writer_done, results):
+    #invalidations received are applied before every read, which is what keeps the cache safe
+    rng = random.Random(port)
+    keys = [b"key:%08d" % i for i in range(hot_keys)]
+    sock = socket.create_connection(("localhost", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    parser = RespParser()
+    cache = {}
+    latency = LatencyHistogram()
+    reads = hits = invalidations = 0
+
+    def apply_pushes():
+        #consume buffered invalidations, returning the first regular reply if there is one
+        nonlocal invalidations
+        while True:
+            reply = parser.next_reply()
+            if reply is None or reply[:1] != b">":
+                return reply
+            invalidated = decode_reply(reply)[1]
+            if invalidated is None:
+                cache.clear()
+            else:
+                for key in invalidated:
+                    cache.pop(key, None)
+            invalidations += 1
+
+    def receive(flags=0):
+        data = sock.recv(65536, flags)
+        if not data:
+            raise RuntimeError("server closed the connection")
+        parser.feed(data)
+
+    def call(*args):
+        sock.sendall(encode_command(*args))
+        while True:
+            reply = apply_pushes()
+            if reply is not None:
+                return reply
+            receive()
+
+    call("HELLO", "3")
+    if tracking:
+        call("CLIENT", "TRACKING", "on")
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        key = keys[rng.randrange(hot_keys)]
+        started = time.perf_counter_ns()
+        value = None
+        if tracking:
+            try:
+                receive(socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                pass
+            apply_pushes()
+            value = cache.get(key)
+        if value is None:
+            value = call("GET", key)
+            if tracking:
+                cache[key] = value
+        else:
+            hits += 1
+        latency.record((time.perf_counter_ns() - started) // 1000)
+        reads += 1
+
+    #every invalidation for the writer's last writes is queued ahead of this reply
+    writer_done.wait()
+    call("PING")
+    stale = 0
+    if cache:
+        cached = list(cache)
+        current = decode_reply(call("MGET", *cached))
+        stale = sum(1 for key, value in zip(cached, current) if decode_reply(cache[key]) != value)
+    sock.close()
+    results.put((reads, hits, invalidations, stale, latency))
+
+def write_hot_keys(port, hot_keys, rate, duration, writer_done):
+    rng = random.Random(port + 1)
+    sock = socket.create_connection(("localhost", port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    next_write = time.time()
+    deadline = next_write + duration
+    written = 0
+    while next_write < deadline:
+        sock.sendall(encode_command("SET", b"key:%08d" % rng.randrange(hot_keys), b"value-%d" % written))
+        read_reply(sock)
+        written += 1
+        next_write += 1 / rate
+        time.sleep(max(0.0, next_write - time.time()))
+    sock.close()
+    writer_done.set()
+
+def scenario_tracking(args):
+    #read latency with and without a local cache kept valid by CLIENT TRACKING
+    report = {"scenario": "tracking", "commit": current_commit(), "hot_keys": args.hot_keys,
+              "writes_per_sec": args.writes_per_sec, "duration": args.duration, "modes": {}}
+    for mode in ("uncached", "tracking"):
+        port = free_port()
+        server = start_server(port, launcher=args.launcher)
+        try:
+            load_keys(port, args.hot_keys, lambda i: b"value")
+            results, writer_done = multiprocessing.Queue(), multiprocessing.Event()
+            reader = multiprocessing.Process(target=read_through_cache, args=(
+                port, args.hot_keys, args.duration, mode == "tracking", writer_done, results))
+            writer = multiprocessing.Process(target=write_hot_keys, args=(
+                port, args.hot_keys, args.writes_per_sec, args.duration, writer_done))
+            reader.start()
+            writer.start()
+            reads, hits, invalidations, stale, latency = results.get()
+            reader.join()
+            writer.join()
+            report["modes"][mode] = {
+                "reads_per_sec": round(reads / args.duration),
+                "cache_hit_rate": round(hits / max(reads, 1), 4),
+                "invalidations": invalidations,
+                "stale_entries_at_end": stale,
+                "read_latency_usec": {
+                    "p50": latency.percentile(50),
+                    "p99": latency.percentile(99),
+                    "p999": latency.percentile(99.9),
+                    "max": latency.percentile(100),
+                },
+            }
+        finally:
+            stop_server(server)
+    return report
+
+SCENARIOS = {
+    "io-models": scenario_io_models,
+    "load": scenario_load,
+    "memory": scenario_memory,
+    "sync": scenario_sync,
+    "tracking": scenario_tracking,
+    "workers": scenario_workers,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Redis Lite benchmark harness")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--connections", type=int, default=1000, help="idle connections held open")
+    parser.add_argument("--clients", type=int, default=50, help="concurrent active clients")
+    parser.add_argument("--processes", type=int, default=2, help="client driver processes")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of load per run")
+    parser.add_argument("--keys", type=int, default=1000000, help="keys loaded by the memory and sync scenarios")
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1,
+                        help="largest --workers count tried by the workers scenario")
+    parser.add_argument("--launcher", choices=["python", "script", "fork"], default="python",
+                        help="how the load scenario starts servers: python -m app.main, "
+                             "spawn_redis_server.sh, or a fork of this process")
+    parser.add_argument("--io-model", choices=["eventloop", "threaded"], default="eventloop",
+                        help="server I/O model used by the load scenario")
+    parser.add_argument("--pipeline", type=int, default=1, help="commands each client sends per round trip")
+    parser.add_argument("--keyspace", type=int, default=100000, help="distinct keys the load scenario touches")
+    parser.add_argument("--value-size", type=int, default=3, help="bytes per SET value")
+    parser.add_argument("--mix", type=parse_mix, default="set=1,get=1",
+                        help="weighted command mix of the load scenario, from " + ", ".join(LOAD_COMMANDS))
+    parser.add_argument("--expire-ms", type=int, default=10000, help="PX of the setpx commands")
+    parser.add_argument("--replica", action="store_true",
+                        help="attach a local replica so the load's writes are propagated")
+    parser.add_argument("--hot-keys", type=int, default=1000, help="keys the tracking scenario reads and writes")
+    parser.add_argument("--writes-per-sec", type=float, default=100,
+                        help="rate at which the tracking scenario's writer changes hot keys")
+    args = parser.parse_args()
+    print(json.dumps(SCENARIOS[args.scenario](args), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#Redis Cluster key -> hash slot mapping
+import hashlib
+
+CLUSTER_SLOTS = 16384
+
+def _crc16_table():
+    #CRC16-CCITT (XMODEM), polynomial 0x1021, the variant Redis Cluster uses
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+CRC16_TABLE = _crc16_table()
+
+def crc16(data):
+    crc = 0
+    table = CRC16_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+def key_hash_slot(key):
+    #CRC16 of the key, or of its non-empty {hash tag}, mod 16384
+    start = key.find(b"{")
+    if start >= 0:
+        end = key.find(b"}", start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key) & (CLUSTER_SLOTS - 1)
+
+def split_slots(count):
+    #contiguous, near-equal (first, last) slot ranges for count owners
+    return [(i * CLUSTER_SLOTS // count, (i + 1) * CLUSTER_SLOTS // count - 1) for i in range(count)]
+
+def slot_ranges(slot_owner):
+    #runs of consecutive slots with the same owner as (first, last, owner), unowned slots skipped
+    ranges = []
+    first = 0
+    for slot in range(1, CLUSTER_SLOTS + 1):
+        if slot == CLUSTER_SLOTS or slot_owner[slot] != slot_owner[first]:
+            if slot_owner[first] is not None:
+                ranges.append((first, slot - 1, slot_owner[first]))
+            first = slot
+    return ranges
+
+def parse_slot_ranges(fields):
+    #specs such as "0-5460" or "42" as (first, last) pairs
+    ranges = []
+    for field in fields:
+        first, _, last = field.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if not 0 <= first <= last < CLUSTER_SLOTS:
+            raise ValueError(f"invalid slot range '{field}'")
+        ranges.append((first, last))
+    return ranges
+
+def node_id(host, port):
+    #nodes don't gossip, so an ID every node can derive on its own stands in for Redis' random one
+    return hashlib.sha1(f"{host}:{port}".encode()).hexdigest()
@@ -0,0 +1,140 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from app.resp import RespParser, decode_reply, encode_command
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class Client:
+    def __init__(self, port):
+        self.sock = socket.create_connection(("localhost", port), timeout = 5)
+        self.parser = RespParser()
+        self.pushes = [] #RESP3 pushes received while waiting for replies
+
+    def send(self, *args):
+        self.sock.sendall(encode_command([arg if isinstance(arg, bytes) else str(arg).encode() for arg in args]))
+
+    def read_raw(self):
+        #one whole reply or push, undecoded
+        while True:
+            reply = self.parser.next_reply()
+            if reply is not None:
+                return reply
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("connection closed")
+            self.parser.feed(data)
+
+    def read(self):
+        while True:
+            reply = self.read_raw()
+            if not reply.startswith(b">"):
+                return decode_reply(reply)
+            self.pushes.append(decode_reply(reply))
+
+    def __call__(self, *args):
+        self.send(*args)
+        return self.read()
+
+    def info(self, section):
+        fields = {}
+        for line in self("INFO", section).decode().splitlines():
+            if ":" in line:
+                name, value = line.split(":", 1)
+                fields[name] = value
+        return fields
+
+    def close(self):
+        self.sock.close()
+
+def wait_for(condition, timeout = 10):
+    #polls until condition() is true, for effects that reach another process asynchronously
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out waiting for the condition")
+        time.sleep(0.02)
+
+def free_port(span = 1):
+    #a port whose span - 1 successors are free as well; only a bind with the server's own
+    #options tells, as a TIME_WAIT left by some client connection still blocks it
+    while True:
+        with socket.socket() as s:
+            s.bind(("localhost", 0))
+            port = s.getsockname()[1]
+        try:
+            for successor in range(port + 1, port + span):
+                socket.create_server(("127.0.0.1", successor)).close()
+            return port
+        except OSError:
+            pass
+
+class Server:
+    def __init__(self, directory, *options):
+        self.directory = directory
+        self.options = options
+        #with --workers, each worker also listens on one of the ports after this one
+        workers = int(options[options.index("--workers") + 1]) if "--workers" in options else 0
+        self.port = free_port(1 + workers)
+        self.process = None
+        self.clients = []
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "app.main", "--port", str(self.port), "--dir", str(self.directory), *self.options],
+            cwd = ROOT, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("localhost", self.port), timeout = 1).close()
+                return
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("server did not start")
+                time.sleep(0.05)
+
+    def stop(self):
+        for client in self.clients:
+            client.close()
+        self.clients.clear()
+        self.process.terminate()
+        self.process.wait()
+
+    def client(self):
+        client = Client(self.port)
+        self.clients.append(client)
+        return client
+
+@pytest.fixture(params = ["eventloop", "threaded"])
+def io_model(request):
+    return request.param
+
+@pytest.fixture
+def server(io_model, tmp_path):
+    server = Server(tmp_path, "--io-model", io_model)
+    server.start()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def start_server(tmp_path):
+    #starts servers with any options, each in its own directory, stopped at teardown
+    servers = []
+
+    def start(*options):
+        directory = tmp_path / str(len(servers))
+        directory.mkdir()
+        server = Server(directory, *options)
+        server.start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        if server.process.poll() is None:
+            server.stop()
@@ -0,0 +1,716 @@
+#collection values, kept in a compact layout while small and converted once past Redis' thresholds
+#every collection tracks nbytes, the approximate memory its elements take
+import bisect
+import itertools
+import random
+import sys
+from array import array
+from collections import deque
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+HASH_MAX_LISTPACK_ENTRIES = 128
+HASH_MAX_LISTPACK_VALUE = 64
+LIST_MAX_LISTPACK_ENTRIES = 128
+SET_MAX_INTSET_ENTRIES = 512
+SET_MAX_LISTPACK_ENTRIES = 128
+SET_MAX_LISTPACK_VALUE = 64
+ZSET_MAX_LISTPACK_ENTRIES = 128
+ZSET_MAX_LISTPACK_VALUE = 64
+
+#bytes an element costs beyond its own object: a list slot in the compact
+#encodings, a hash table entry (or skiplist node) in the full ones
+COMPACT_SLOT = 8
+TABLE_SLOT = 64
+
+SKIPLIST_MAXLEVEL = 32
+SKIPLIST_P = 0.25
+
+STREAM_NODE_MAX_ENTRIES = 100 #entries per stream block, Redis' stream-node-max-entries
+#a stream ID ms-seq is kept as the single int ms << 64 | seq, which orders the same way
+STREAM_SEQ_MASK = (1 << 64) - 1
+STREAM_ID_MAX = (1 << 128) - 1
+
+def try_int_encoding(value):
+    #store canonical decimal strings that fit in 64 bits as ints, like Redis's int encoding;
+    #anything else ("007", "+1", "-0", " 1") must round-trip byte for byte so stays bytes
+    if not value or len(value) > 20:
+        return value
+    digits = value[1:] if value[0] == 45 else value #45 is "-"
+    if not digits.isdigit() or (digits[0] == 48 and (len(digits) > 1 or digits is not value)): #48 is "0"
+        return value
+    number = int(value)
+    return number if INT64_MIN <= number <= INT64_MAX else value
+
+def _cost(item, slot):
+    return sys.getsizeof(item) + slot
+
+class Hash:
+    #two parallel lists up to 128 short fields, then a dict
+
+    type_name = "hash"
+    __slots__ = ("fields", "values", "table", "nbytes")
+
+    def __init__(self):
+        self.fields = []
+        self.values = []
+        self.table = None
+        self.nbytes = 0
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        value = cls()
+        for field, item in pairs:
+            value.set(field, item)
+        return value
+
+    @property
+    def encoding(self):
+        return "listpack" if self.table is None else "hashtable"
+
+    def __len__(self):
+        return len(self.fields) if self.table is None else len(self.table)
+
+    def get(self, field):
+        if self.table is not None:
+            return self.table.get(field)
+        try:
+            return self.values[self.fields.index(field)]
+        except ValueError:
+            return None
+
+    def set(self, field, value):
+        #True if the field is new
+        if self.table is None:
+            try:
+                i = self.fields.index(field)
+            except ValueError:
+                i = -1
+            if len(value) <= HASH_MAX_LISTPACK_VALUE:
+                if i >= 0:
+                    self.nbytes += sys.getsizeof(value) - sys.getsizeof(self.values[i])
+                    self.values[i] = value
+                    return False
+                if len(field) <= HASH_MAX_LISTPACK_VALUE and len(self.fields) < HASH_MAX_LISTPACK_ENTRIES:
+                    self.fields.append(field)
+                    self.values.append(value)
+                    self.nbytes += _cost(field, COMPACT_SLOT) + _cost(value, COMPACT_SLOT)
+                    return True
+            self._convert()
+        table = self.table
+        old = table.get(field)
+        table[field] = value
+        if old is None:
+            self.nbytes += _cost(field, TABLE_SLOT) + sys.getsizeof(value)
+            return True
+        self.nbytes += sys.getsizeof(value) - sys.getsizeof(old)
+        return False
+
+    def delete(self, field):
+        if self.table is not None:
+            value = self.table.pop(field, None)
+            if value is None:
+                return False
+            self.nbytes -= _cost(field, TABLE_SLOT) + sys.getsizeof(value)
+            return True
+        try:
+            i = self.fields.index(field)
+        except ValueError:
+            return False
+        self.nbytes -= _cost(field, COMPACT_SLOT) + _cost(self.values[i], COMPACT_SLOT)
+        del self.fields[i]
+        del self.values[i]
+        return True
+
+    def items(self):
+        if self.table is not None:
+            return self.table.items()
+        return zip(self.fields, self.values)
+
+    def _convert(self):
+        self.table = dict(zip(self.fields, self.values))
+        self.fields = self.values = None
+        self.nbytes = sum(_cost(field, TABLE_SLOT) + sys.getsizeof(value) for field, value in self.table.items())
+
+    def dismantle(self, count):
+        #drop up to count elements of a value nobody references any more, True once empty
+        if self.table is None:
+            del self.fields[-count:]
+            del self.values[-count:]
+            return not self.fields
+        for _ in range(min(count, len(self.table))):
+            self.table.popitem()
+        return not self.table
+
+class List:
+    #a list up to 128 elements, then a deque
+
+    type_name = "list"
+    __slots__ = ("items", "nbytes")
+
+    def __init__(self, items = ()):
+        self.items = []
+        self.nbytes = 0
+        if items:
+            self.push(list(items), left = False)
+
+    @property
+    def encoding(self):
+        return "listpack" if type(self.items) is list else "quicklist"
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def push(self, values, left):
+        items = self.items
+        if type(items) is list and len(items) + len(values) > LIST_MAX_LISTPACK_ENTRIES:
+            items = self.items = deque(items)
+        if left:
+            #LPUSH a b c leaves c first
+            if type(items) is list:
+                items[:0] = values[::-1]
+            else:
+                items.extendleft(values)
+        else:
+            items.extend(values)
+        self.nbytes += sum(_cost(value, COMPACT_SLOT) for value in values)
+
+    def pop(self, count, left):
+        items = self.items
+        count = min(count, len(items))
+        if type(items) is list:
+            if left:
+                popped = items[:count]
+                del items[:count]
+            else:
+                popped = items[:-count - 1:-1] if count else []
+                del items[len(items) - count:]
+        else:
+            popped = [items.popleft() if left else items.pop() for _ in range(count)]
+        self.nbytes -= sum(_cost(value, COMPACT_SLOT) for value in popped)
+        return popped
+
+    def range(self, start, stop):
+        #start and stop are inclusive and already clamped
+        items = self.items
+        if type(items) is list:
+            return items[start:stop + 1]
+        #a deque is indexed from the nearer end
+        if start > len(items) // 2:
+            tail = list(itertools.islice(reversed(items), len(items) - 1 - stop, len(items) - start))
+            tail.reverse()
+            return tail
+        return list(itertools.islice(items, start, stop + 1))
+
+    def dismantle(self, count):
+        items = self.items
+        if type(items) is list:
+            del items[-count:]
+        else:
+            for _ in range(min(count, len(items))):
+                items.pop()
+        return not items
+
+class Set:
+    #a sorted array of ints while every member is one, a list up to 128 short members, then a set
+
+    type_name = "set"
+    __slots__ = ("members", "nbytes")
+
+    def __init__(self, members = ()):
+        self.members = array("q")
+        self.nbytes = 0
+        for member in members:
+            self.add(member)
+
+    @property
+    def encoding(self):
+        members = self.members
+        return "intset" if type(members) is array else "listpack" if type(members) is list else "hashtable"
+
+    def __len__(self):
+        return len(self.members)
+
+    def __iter__(self):
+        if type(self.members) is array:
+            return (b"%d" % member for member in self.members)
+        return iter(self.members)
+
+    def add(self, member):
+        #True if member is new
+        members = self.members
+        if type(members) is array:
+            number = try_int_encoding(member)
+            if type(number) is int:
+                i = bisect.bisect_left(members, number)
+                if i < len(members) and members[i] == number:
+                    return False
+                if len(members) < SET_MAX_INTSET_ENTRIES:
+                    members.insert(i, number)
+                    self.nbytes += members.itemsize
+                    return True
+            if len(members) < SET_MAX_LISTPACK_ENTRIES and len(member) <= SET_MAX_LISTPACK_VALUE:
+                self._convert(list)
+            else:
+                self._convert(set)
+            members = self.members
+        if type(members) is list:
+            if member in members:
+                return False
+            if len(members) < SET_MAX_LISTPACK_ENTRIES and len(member) <= SET_MAX_LISTPACK_VALUE:
+                members.append(member)
+                self.nbytes += _cost(member, COMPACT_SLOT)
+                return True
+            self._convert(set)
+            members = self.members
+        if member in members:
+            return False
+        members.add(member)
+        self.nbytes += _cost(member, TABLE_SLOT)
+        return True
+
+    def __contains__(self, member):
+        members = self.members
+        if type(members) is array:
+            number = try_int_encoding(member)
+            if type(number) is not int:
+                return False
+            i = bisect.bisect_left(members, number)
+            return i < len(members) and members[i] == number
+        return member in members
+
+    def remove(self, member):
+        members = self.members
+        if type(members) is array:
+            if member not in self:
+                return False
+            del members[bisect.bisect_left(members, int(member))]
+            self.nbytes -= members.itemsize
+            return True
+        if member not in members:
+            return False
+        members.remove(member)
+        self.nbytes -= _cost(member, COMPACT_SLOT if type(members) is list else TABLE_SLOT)
+        return True
+
+    def _convert(self, kind):
+        members = list(self)
+        slot = COMPACT_SLOT if kind is list else TABLE_SLOT
+        self.members = kind(members)
+        self.nbytes = sum(_cost(member, slot) for member in members)
+
+    def dismantle(self, count):
+        members = self.members
+        if type(members) is set:
+            for _ in range(min(count, len(members))):
+                members.pop()
+        else:
+            del members[-count:]
+        return not members
+
+class _SkipNode:
+    __slots__ = ("key", "forward", "span", "backward")
+
+    def __init__(self, level, key):
+        self.key = key #(score, member), the order of the list
+        self.forward = [None] * level
+        self.span = [0] * level #nodes skipped by each forward pointer
+        self.backward = None
+
+class SkipList:
+    #Redis' zskiplist: spans give the rank of a key, or the key at a rank, in O(log n)
+
+    __slots__ = ("header", "tail", "length", "level")
+
+    def __init__(self):
+        self.header = _SkipNode(SKIPLIST_MAXLEVEL, None)
+        self.tail = None
+        self.length = 0
+        self.level = 1
+
+    def __len__(self):
+        return self.length
+
+    @staticmethod
+    def _random_level():
+        level = 1
+        while random.random() < SKIPLIST_P and level < SKIPLIST_MAXLEVEL:
+            level += 1
+        return level
+
+    def insert(self, key):
+        update = [None] * SKIPLIST_MAXLEVEL
+        rank = [0] * SKIPLIST_MAXLEVEL
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            rank[i] = 0 if i == self.level - 1 else rank[i + 1]
+            while x.forward[i] is not None and x.forward[i].key < key:
+                rank[i] += x.span[i]
+                x = x.forward[i]
+            update[i] = x
+        level = self._random_level()
+        if level > self.level:
+            for i in range(self.level, level):
+                update[i] = self.header
+                self.header.span[i] = self.length
+            self.level = level
+        node = _SkipNode(level, key)
+        for i in range(level):
+            node.forward[i] = update[i].forward[i]
+            update[i].forward[i] = node
+            node.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = rank[0] - rank[i] + 1
+        for i in range(level, self.level):
+            update[i].span[i] += 1
+        node.backward = None if update[0] is self.header else update[0]
+        if node.forward[0] is not None:
+            node.forward[0].backward = node
+        else:
+            self.tail = node
+        self.length += 1
+
+    def delete(self, key):
+        update = [None] * SKIPLIST_MAXLEVEL
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and x.forward[i].key < key:
+                x = x.forward[i]
+            update[i] = x
+        x = x.forward[0]
+        if x is None or x.key != key:
+            return False
+        for i in range(self.level):
+            if update[i].forward[i] is x:
+                update[i].span[i] += x.span[i] - 1
+                update[i].forward[i] = x.forward[i]
+            else:
+                update[i].span[i] -= 1
+        if x.forward[0] is not None:
+            x.forward[0].backward = x.backward
+        else:
+            self.tail = x.backward
+        while self.level > 1 and self.header.forward[self.level - 1] is None:
+            self.level -= 1
+        self.length -= 1
+        return True
+
+    def rank(self, key):
+        rank = 0
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and x.forward[i].key <= key:
+                rank += x.span[i]
+                x = x.forward[i]
+            if x.key == key:
+                return rank - 1
+        return None
+
+    def node_at(self, rank):
+        #rank must be in range
+        traversed = 0
+        rank += 1
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and traversed + x.span[i] <= rank:
+                traversed += x.span[i]
+                x = x.forward[i]
+            if traversed == rank:
+                return x
+        return None
+
+    def first_at_least(self, key):
+        #first node whose key is >= key, or None
+        x = self.header
+        for i in range(self.level - 1, -1, -1):
+            while x.forward[i] is not None and x.forward[i].key < key:
+                x = x.forward[i]
+        return x.forward[0]
+
+    def dismantle(self, count):
+        #unlink nodes from the front; each node only keeps later ones alive
+        header = self.header
+        header.forward[1:] = [None] * (SKIPLIST_MAXLEVEL - 1)
+        for _ in range(count):
+            node = header.forward[0]
+            if node is None:
+                break
+            header.forward[0] = node.forward[0]
+            node.forward = None
+        self.tail = None
+        return header.forward[0] is None
+
+class ZSet:
+    #a sorted list of (score, member) up to 128 short members, then a dict plus a skiplist
+
+    type_name = "zset"
+    __slots__ = ("entries", "scores", "skiplist", "nbytes")
+
+    def __init__(self):
+        self.entries = []
+        self.scores = None
+        self.skiplist = None
+        self.nbytes = 0
+
+    @classmethod
+    def from_items(cls, items):
+        value = cls()
+        for member, score in items:
+            value.add(member, score)
+        return value
+
+    @property
+    def encoding(self):
+        return "listpack" if self.scores is None else "skiplist"
+
+    def __len__(self):
+        return len(self.entries) if self.scores is None else len(self.scores)
+
+    def score(self, member):
+        if self.scores is not None:
+            return self.scores.get(member)
+        for score, item in self.entries:
+            if item == member:
+                return score
+        return None
+
+    def add(self, member, score):
+        #returns the previous score, None if member is new
+        old = self.score(member)
+        if old == score:
+            return old
+        if self.scores is None:
+            if old is None and (len(self.entries) >= ZSET_MAX_LISTPACK_ENTRIES
+                                or len(member) > ZSET_MAX_LISTPACK_VALUE):
+                self._convert()
+            else:
+                if old is not None:
+                    self.entries.remove((old, member))
+                else:
+                    self.nbytes += _cost(member, COMPACT_SLOT) + _cost(score, COMPACT_SLOT)
+                bisect.insort(self.entries, (score, member))
+                return old
+        if old is not None:
+            self.skiplist.delete((old, member))
+        else:
+            self.nbytes += _cost(member, TABLE_SLOT) + _cost(score, TABLE_SLOT)
+        self.scores[member] = score
+        self.skiplist.insert((score, member))
+        return old
+
+    def remove(self, member):
+        score = self.score(member)
+        if score is None:
+            return False
+        if self.scores is None:
+            self.entries.remove((score, member))
+            self.nbytes -= _cost(member, COMPACT_SLOT) + _cost(score, COMPACT_SLOT)
+        else:
+            del self.scores[member]
+            self.skiplist.delete((score, member))
+            self.nbytes -= _cost(member, TABLE_SLOT) + _cost(score, TABLE_SLOT)
+        return True
+
+    def rank(self, member):
+        score = self.score(member)
+        if score is None:
+            return None
+        if self.scores is None:
+            return self.entries.index((score, member))
+        return self.skiplist.rank((score, member))
+
+    def range_by_rank(self, start, stop):
+        #start and stop are inclusive and already clamped
+        if self.scores is None:
+            return self.entries[start:stop + 1]
+        result = []
+        node = self.skiplist.node_at(start)
+        for _ in range(stop - start + 1):
+            result.append(node.key)
+            node = node.forward[0]
+        return result
+
+    def range_by_score(self, low, low_exclusive, high, high_exclusive, offset = 0, count = -1):
+        #count < 0 means no limit
+        if self.scores is None:
+            i = bisect.bisect_left(self.entries, (low,))
+            entries = itertools.islice(self.entries, i, None)
+        else:
+            node = self.skiplist.first_at_least((low,))
+            entries = self._walk(node)
+        result = []
+        for score, member in entries:
+            if low_exclusive and score == low:
+                continue
+            if score > high or (high_exclusive and score == high):
+                break
+            if offset:
+                offset -= 1
+                continue
+            if len(result) == count:
+                break
+            result.append((score, member))
+        return result
+
+    @staticmethod
+    def _walk(node):
+        while node is not None:
+            yield node.key
+            node = node.forward[0]
+
+    def items(self):
+        if self.scores is None:
+            return [(member, score) for score, member in self.entries]
+        return [(member, score) for score, member in self._walk(self.skiplist.header.forward[0])]
+
+    def _convert(self):
+        self.scores = {}
+        self.skiplist = SkipList()
+        for score, member in self.entries:
+            self.scores[member] = score
+            self.skiplist.insert((score, member))
+        self.nbytes = sum(_cost(member, TABLE_SLOT) + _cost(score, TABLE_SLOT) for score, member in self.entries)
+        self.entries = None
+
+    def dismantle(self, count):
+        if self.scores is None:
+            del self.entries[-count:]
+            return not self.entries
+        for _ in range(min(count, len(self.scores))):
+            self.scores.popitem()
+        return self.skiplist.dismantle(count) and not self.scores
+
+def stream_id(ms, seq):
+    return ms << 64 | seq
+
+def format_stream_id(sid):
+    return b"%d-%d" % (sid >> 64, sid & STREAM_SEQ_MASK)
+
+class _StreamBlock:
+    __slots__ = ("ids", "entries")
+
+    def __init__(self):
+        self.ids = []
+        self.entries = [] #flat (field, value, field, value, ...) tuples
+
+class Stream:
+    #entries in blocks of up to 100 like Redis' listpacks, found by bisecting the blocks' first IDs
+
+    type_name = "stream"
+    encoding = "stream"
+    __slots__ = ("blocks", "first_ids", "length", "last_id", "entries_added", "max_deleted_id", "nbytes")
+
+    def __init__(self):
+        self.blocks = []
+        self.first_ids = []
+        self.length = 0
+        self.last_id = 0 #kept when the entries are trimmed, IDs never go back
+        self.entries_added = 0
+        self.max_deleted_id = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for block in self.blocks:
+            yield from zip(block.ids, block.entries)
+
+    @property
+    def first_id(self):
+        return self.first_ids[0] if self.blocks else 0
+
+    def append(self, sid, fields):
+        #sid must be greater than last_id
+        blocks = self.blocks
+        if not blocks or len(blocks[-1].ids) >= STREAM_NODE_MAX_ENTRIES:
+            blocks.append(_StreamBlock())
+            self.first_ids.append(sid)
+        block = blocks[-1]
+        if block.entries and block.entries[0][::2] == fields[::2]:
+            master = block.entries[0]
+            fields = tuple(item for pair in zip(master[::2], fields[1::2]) for item in pair)
+        else:
+            fields = tuple(fields)
+        block.ids.append(sid)
+        block.entries.append(fields)
+        self.nbytes += self._entry_cost(sid, fields)
+        self.length += 1
+        self.last_id = sid
+        self.entries_added += 1
+
+    def range(self, start, end, count = -1, reverse = False):
+        #start <= ID <= end, in ID order or reversed, at most count of them
+        result = []
+        blocks = self.blocks
+        if reverse:
+            i = bisect.bisect_right(self.first_ids, end) - 1
+            if i < 0:
+                return result
+            j = bisect.bisect_right(blocks[i].ids, end) - 1
+            while i >= 0 and len(result) != count:
+                block = blocks[i]
+                while j >= 0 and len(result) != count:
+                    if block.ids[j] < start:
+                        return result
+                    result.append((block.ids[j], block.entries[j]))
+                    j -= 1
+                i -= 1
+                j = len(blocks[i].ids) - 1 if i >= 0 else -1
+            return result
+        i = max(bisect.bisect_right(self.first_ids, start) - 1, 0)
+        j = bisect.bisect_left(blocks[i].ids, start) if blocks else 0
+        while i < len(blocks) and len(result) != count:
+            block = blocks[i]
+            while j < len(block.ids) and len(result) != count:
+                if block.ids[j] > end:
+                    return result
+                result.append((block.ids[j], block.entries[j]))
+                j += 1
+            i += 1
+            j = 0
+        return result
+
+    def trim(self, maxlen, approx):
+        #only whole blocks when approx; returns how many entries went
+        removed = 0
+        blocks = self.blocks
+        while blocks and self.length - len(blocks[0].ids) >= maxlen:
+            removed += self._drop_front(len(blocks[0].ids))
+        if not approx and self.length > maxlen:
+            removed += self._drop_front(self.length - maxlen)
+        return removed
+
+    @staticmethod
+    def _entry_cost(sid, fields):
+        #shared field names are counted for every entry, which keeps the sum exact as blocks are cut
+        return sys.getsizeof(sid) + _cost(fields, 2 * COMPACT_SLOT) + sum(map(sys.getsizeof, fields))
+
+    def _drop_front(self, count):
+        #remove count entries from the first block, which must hold that many
+        block = self.blocks[0]
+        self.max_deleted_id = max(self.max_deleted_id, block.ids[count - 1])
+        for sid, fields in zip(block.ids[:count], block.entries[:count]):
+            self.nbytes -= self._entry_cost(sid, fields)
+        if count == len(block.ids):
+            del self.blocks[0]
+            del self.first_ids[0]
+        else:
+            del block.ids[:count]
+            del block.entries[:count]
+            self.first_ids[0] = block.ids[0]
+        self.length -= count
+        return count
+
+    def dismantle(self, count):
+        blocks = self.blocks
+        while count > 0 and blocks:
+            count -= len(blocks.pop().ids)
+            self.first_ids.pop()
+        return not blocks
+
+#every collection type, for isinstance checks
+COLLECTION_TYPES = (Hash, List, Set, ZSet, Stream)
@@ -0,0 +1,124 @@
+import random
+from itertools import islice
+
+BUCKET_BITS = 14
+BUCKET_COUNT = 1 << BUCKET_BITS
+BUCKET_MASK = BUCKET_COUNT - 1
+
+class Keyspace:
+    #a dict split into a fixed number of buckets by key hash, so a random key is cheap to sample
+
+    def __init__(self):
+        self.buckets = [{} for _ in range(BUCKET_COUNT)]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return key in self.buckets[hash(key) & BUCKET_MASK]
+
+    def __getitem__(self, key):
+        return self.buckets[hash(key) & BUCKET_MASK][key]
+
+    def get(self, key, default = None):
+        return self.buckets[hash(key) & BUCKET_MASK].get(key, default)
+
+    def __setitem__(self, key, value):
+        bucket = self.buckets[hash(key) & BUCKET_MASK]
+        size = len(bucket)
+        bucket[key] = value
+        self.size += len(bucket) - size
+
+    def __delitem__(self, key):
+        del self.buckets[hash(key) & BUCKET_MASK][key]
+        self.size -= 1
+
+    def clear(self):
+        self.buckets = [{} for _ in range(BUCKET_COUNT)]
+        self.size = 0
+
+    def pop(self, key, default = None):
+        bucket = self.buckets[hash(key) & BUCKET_MASK]
+        if key not in bucket:
+            return default
+        self.size -= 1
+        return bucket.pop(key)
+
+    #iteration copies one bucket at a time, so callers may delete what they visit
+    def keys(self):
+        for bucket in self.buckets:
+            if bucket:
+                yield from list(bucket)
+
+    def values(self):
+        for bucket in self.buckets:
+            if bucket:
+                yield from list(bucket.values())
+
+    def items(self):
+        for bucket in self.buckets:
+            if bucket:
+                yield from list(bucket.items())
+
+    def scan(self, cursor, count):
+        #keys never change bucket, so each key present for the whole iteration is returned exactly once;
+        #stops after 10 * count buckets so a sparse keyspace still costs bounded work
+        if not 0 <= cursor < BUCKET_COUNT:
+            raise ValueError("invalid cursor")
+        if not self.size:
+            return 0, []
+        keys = []
+        visits = count * 10
+        while True:
+            bucket = self.buckets[cursor]
+            if bucket:
+                keys.extend(bucket)
+            cursor = (cursor + 1) & BUCKET_MASK
+            visits -= 1
+            if not cursor or len(keys) >= count or not visits:
+                return cursor, keys
+
+    def detach(self):
+        detached = Keyspace()
+        detached.buckets, self.buckets = self.buckets, detached.buckets
+        detached.size, self.size = self.size, 0
+        return detached
+
+    def dismantle(self, count):
+        #drop about count elements, emptying big values a chunk at a time; True once empty
+        buckets = self.buckets
+        while count > 0 and buckets:
+            bucket = buckets[-1]
+            if not bucket:
+                buckets.pop()
+                continue
+            key = next(reversed(bucket))
+            value = bucket[key]
+            if isinstance(value, (bytes, int)):
+                count -= 1
+            else:
+                size = len(value)
+                if not value.dismantle(count):
+                    return False
+                count -= size
+            del bucket[key]
+            self.size -= 1
+        return not buckets
+
+    def random_keys(self, count):
+        #one random key per non-empty bucket, walking from a random bucket
+        keys = []
+        if not self.size:
+            return keys
+        count = min(count, self.size)
+        index = random.getrandbits(BUCKET_BITS)
+        for _ in range(BUCKET_COUNT):
+            bucket = self.buckets[index]
+            if bucket:
+                offset = random.randrange(len(bucket)) if len(bucket) > 1 else 0
+                keys.append(next(islice(bucket, offset, None)))
+                if len(keys) == count:
+                    break
+            index = (index + 1) & BUCKET_MASK
+        return keys
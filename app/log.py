@@ -0,0 +1,31 @@
+#leveled server log in the Redis format: pid:role dd Mon yyyy hh:mm:ss.mmm <mark> message
+import os
+import sys
+import time
+
+DEBUG, VERBOSE, NOTICE, WARNING = range(4)
+LEVELS = {"debug": DEBUG, "verbose": VERBOSE, "notice": NOTICE, "warning": WARNING}
+MARKS = ".-*#" #per level, as Redis prints them
+
+verbosity = NOTICE
+role = "M" #M master, S replica, C forked child
+
+def set_verbosity(name):
+    global verbosity
+    verbosity = LEVELS[name]
+
+def set_role(name):
+    global role
+    role = name
+
+def log(level, message, *args):
+    #a disabled level returns before anything is formatted
+    if level < verbosity:
+        return
+    if args:
+        message = message % args
+    now = time.time()
+    stamp = time.strftime("%d %b %Y %H:%M:%S", time.localtime(now))
+    #one write per line keeps lines from several threads whole
+    sys.stdout.write(f"{os.getpid()}:{role} {stamp}.{int(now * 1000) % 1000:03d} {MARKS[level]} {message}\n")
+    sys.stdout.flush()
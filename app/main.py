@@ -1,317 +1,4311 @@
 import argparse
+import collections
+import fnmatch
+import heapq
+import itertools
+import os
+import random
 import socket
+import selectors
+import signal
+import sys
 import threading
 import time
-import base64
+import traceback
 
+from app import rdb
+from app.backlog import ReplicationBacklog
+from app.cluster import CLUSTER_SLOTS, key_hash_slot, node_id, parse_slot_ranges, slot_ranges, split_slots
+from app.datatypes import (
+    COLLECTION_TYPES, INT64_MAX, INT64_MIN, STREAM_ID_MAX, STREAM_SEQ_MASK, Hash, List, Set, Stream, ZSet,
+    format_stream_id, stream_id, try_int_encoding,
+)
+from app.keyspace import BUCKET_COUNT, Keyspace
+from app.log import DEBUG, NOTICE, VERBOSE, WARNING, LEVELS, log, set_role, set_verbosity
+from app.metrics import CommandStats, InstantaneousMetric, SlowLog
+from app.pubsub import PatternIndex, glob_to_regex
+from app.scripting import ScriptError, compile_script, run_script, script_sha
+from app.resp import (
+    NULL, NULL_ARRAY, NULL_BULK, OK, PONG, ProtocolError, RespParser,
+    encode_array, encode_bulk, encode_command, encode_error, encode_integer, encode_map, encode_push,
+)
+
+REDIS_VERSION = "7.2.0" #the version we report in INFO and RDB headers
 trigger_update = False #
-database = {} #store tuples: (value, expiry_time)
-MASTER_REPLID = "8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb"  # Hardcoded 40-character string
-MASTER_REPL_OFFSET = 0
-EMPTY_RDB = base64.b64decode("UkVESVMwMDEx+glyZWRpcy12ZXIFNy4yLjD6CnJlZGlzLWJpdHPAQPoFY3RpbWXCbQi8ZfoIdXNlZC1tZW3CsMQQAPoIYW9mLWJhc2XAAP/wbjv+wP9aog==")
-replica_sockets = []
+database = Keyspace() #key -> value, keys are bytes, values are bytes or int for integer strings, or a datatypes collection
+expires = {} #key -> absolute expiry in unix milliseconds, only for keys that have one
+replicas = [] #connections of attached replicas
+replication = {
+    #the replication history our dataset belongs to; a replica adopts its master's
+    "replid": os.urandom(20).hex(),
+    #master: bytes of write stream produced since the backlog exists; replica: bytes applied
+    "offset": 0,
+    "backlog": None, #tail of the stream for partial resyncs, created when a replica first attaches
+    #replica: replid and offset describe the data we hold, so PSYNC may continue from them
+    "cached_master": False,
+    "master_host": None,
+    "master_port": None,
+    "listening_port": None,
+    "master_link": None, #replica: connection to the master while the link is up
+    "master_last_io": None, #replica: monotonic time we last received anything from the master
+    "last_ping": 0.0, #master: monotonic time the replicas were last pinged
+    "getack_scheduled": False, #a REPLCONF GETACK * is about to go to the replicas
+    #replica: a command from the master is running, it still sees keys expired here but not yet there
+    "applying_master_stream": False,
+}
+waiting_acks = [] #clients blocked in WAIT, oldest first
+blocking_keys = {} #key -> deque of clients blocked popping it, oldest first
+ready_keys = [] #keys pushed to while clients wait on them, served once the push completes
+pubsub_channels = {} #channel -> {subscribed connection: None}, in subscription order
+pubsub_patterns = PatternIndex() #PSUBSCRIBE patterns and their subscribers
+watched_keys = {} #key -> {client WATCHing it: None}
+#an EXEC or a script is running; its writes reach the AOF and the replicas
+#wrapped in MULTI/EXEC, "opened" once the MULTI went out with the first of them
+atomic_block = {"depth": 0, "opened": False}
+MULTI_COMMAND = encode_command([b"MULTI"])
+EXEC_COMMAND = encode_command([b"EXEC"])
+scripts = {} #SHA1 of a script's source -> the compiled script
+#client-side caching: keys clients in the default tracking mode read, oldest first,
+#and the prefixes BCAST clients follow (b"" for every key)
+tracking_table = {} #key -> {client that may have cached it: None}
+tracking_prefixes = {} #prefix -> {client: None}
+INVALIDATE_PUSH = b">2\r\n$10\r\ninvalidate\r\n" #followed by the keys, or a null when every key is gone
+client_ids = itertools.count(1)
+#sharding of the keyspace by hash slot; every node numbers the others the same way
+cluster = {
+    "nodes": [], #(host, port) of each node, where clients are redirected to
+    "myself": None, #index of this node in nodes
+    "slot_owner": None, #slot -> index of the node serving it, None while sharding is off
+    "links": {}, #node index -> connection commands for its slots are proxied over
+}
+WORKER_CHECK_PERIOD = 1 #seconds between a worker's checks that its supervisor is still alive
+REPL_RECONNECT_PERIOD = 1 #seconds between attempts to reach a lost master
+REPL_TRANSFER_CHUNK = 1024 * 1024 #most RDB bytes a replica is sent or read per call
+REPL_CRON_PERIOD = 1 #seconds between replica ACKs, and between checks whether the replicas need a PING
+expiry_index = [] #min-heap of (expiry_ms, key), an entry goes stale once its key's expiry changes
+key_access = {} #key -> LRU clock or packed LFU counter, kept only under an lru/lfu maxmemory policy
+eviction_pool = [] #best eviction candidates seen by recent samples, as (score, key), best last
+used_memory = 0 #approximate bytes held by the dataset
+#commands, timer callbacks and the master link all mutate shared state under this lock;
+#it only ever contends in the threaded model
+server_lock = threading.RLock()
+
+ACTIVE_EXPIRE_CYCLE_PERIOD = 0.1 #seconds between two active expiry cycles
+ACTIVE_EXPIRE_CYCLE_BUDGET = 0.025 #longest a single cycle may keep the server busy
+#values freed by UNLINK that cost more than this many element frees are dismantled in the background
+LAZYFREE_THRESHOLD = 64
+LAZYFREE_CHUNK = 1024 #elements dropped per step of a lazy free
+LAZYFREE_CYCLE_BUDGET = 0.002 #longest a lazy free cycle may keep the server busy
+KEYS_CYCLE_BUDGET = 0.002 #longest a step of KEYS may keep the server busy
+KEYS_STEP_COUNT = 1024 #keys gathered between two checks of that budget
+lazyfree = {
+    "queue": collections.deque(), #values unlinked from the keyspace, waiting to be dismantled
+    "scheduled": False, #a lazy free cycle is due
+}
+
+#rough cost of a database entry beyond its key and value objects (the bucket dict
+#slot), and of an expiry (its slot in expires, the int and the expiry index tuple)
+ENTRY_OVERHEAD = 48
+EXPIRY_OVERHEAD = 140
+OOM_ERROR = encode_error("OOM command not allowed when used memory > 'maxmemory'.")
+NOT_INTEGER_ERROR = encode_error("ERR value is not an integer or out of range")
+READONLY_ERROR = encode_error("READONLY You can't write against a read only replica.")
+WRONGTYPE_ERROR = encode_error("WRONGTYPE Operation against a key holding the wrong kind of value")
+NOT_FLOAT_ERROR = encode_error("ERR value is not a valid float")
+INVALID_STREAM_ID_ERROR = encode_error("ERR Invalid stream ID specified as stream command argument")
+CROSSSLOT_ERROR = encode_error("CROSSSLOT Keys in request don't hash to the same slot")
+EVICTION_POOL_SIZE = 16
+LFU_INIT_VAL = 5
+
+persistence = {
+    "dirty": 0, #keys changed since the last successful save
+    "lastsave": int(time.time()),
+    "last_bgsave_status": "ok",
+    "last_bgsave_time_sec": -1,
+}
+background_child = None #the forked child doing a background save, with its bookkeeping
+CHILD_CHECK_PERIOD = 0.1 #seconds between checks whether the background child exited
+
+#append-only file state; offsets count bytes fed to the AOF since startup
+aof_state = {
+    "fd": None, #descriptor of the open AOF, None while appendonly is off
+    "buf": bytearray(), #commands fed but not written yet
+    "fed": 0, #offset just past the end of buf
+    "written": 0, #offset up to which buf reached the file
+    "synced": 0, #offset up to which the file is known to be on disk
+    "flushing": False, #some thread is writing buf out right now
+    "rewrite_buf": None, #commands fed since a rewrite child forked, appended to its output
+    "rewrite_scheduled": False, #BGREWRITEAOF waiting for a BGSAVE child to exit
+    "base_size": 0, #AOF size after the last rewrite or at startup
+    "base_offset": 0, #value of "fed" at that point
+    "last_bgrewrite_status": "ok",
+    "last_write_status": "ok",
+}
+#guards the AOF buffer and offsets; a thread waiting for its commands to be
+#written (and fsynced) sleeps on it until some flush covers them
+aof_cond = threading.Condition()
+AOF_LOAD_CHUNK = 4 * 1024 * 1024 #bytes of AOF parsed per read at startup
+AOF_FSYNC_PERIOD = 1 #seconds between fsyncs under appendfsync everysec
+AOF_REWRITE_BATCH = 1024 #commands the rewrite child encodes per write
+AOF_REWRITE_ITEMS_PER_CMD = 64 #collection elements per rewritten command, as in Redis
+pending_writes = set() #connections whose replies go out in before_sleep(), or from write_replies_forever()
+#threaded model: wakes the thread that sends replies queued by other clients' threads
+replies_queued = threading.Condition()
+
+stats = {
+    "expired_keys": 0,
+    "expired_time_cap_reached_count": 0,
+    "expire_cycle_cpu_milliseconds": 0.0,
+    "expire_cycle_last_cpu_usec": 0,
+    "evicted_keys": 0,
+    "lazyfreed_objects": 0,
+    "total_connections_received": 0,
+    "total_commands_processed": 0,
+    "total_net_input_bytes": 0,
+    "total_net_output_bytes": 0,
+    "total_net_repl_input_bytes": 0,
+    "total_net_repl_output_bytes": 0,
+    "rejected_calls": 0,
+}
+clients = set() #client connections, replicas included
+command_stats = {} #command name -> CommandStats, created on its first call
+slowlog = SlowLog(128)
+#counter in stats -> its per-second rate, sampled by stats_cron()
+instantaneous_metrics = {
+    "total_commands_processed": InstantaneousMetric(),
+    "total_net_input_bytes": InstantaneousMetric(),
+    "total_net_output_bytes": InstantaneousMetric(),
+}
+STATS_CRON_PERIOD = 0.1 #seconds between two samples of the instantaneous metrics
+LATENCY_PERCENTILES = (50, 99, 99.9) #reported by INFO latencystats
+
+IOV_MAX = 1024 #most iovecs a single sendmsg accepts
+
+config = {
+    #stop reading from a client while this many reply bytes are waiting to be written
+    "client-output-high-water": 1024 * 1024,
+    "maxmemory": 0,
+    "maxmemory-policy": "noeviction",
+    "maxmemory-samples": 5,
+    "lfu-log-factor": 10,
+    "lfu-decay-time": 1,
+    "dir": os.getcwd(),
+    "dbfilename": "dump.rdb",
+    #our LZF is pure Python and costs far more CPU than it saves in I/O, so unlike
+    #Redis it is off by default; compressed files from Redis load either way
+    "rdbcompression": "no",
+    "rdbchecksum": "yes",
+    "appendonly": "no",
+    "appendfilename": "appendonly.aof",
+    "appendfsync": "everysec",
+    "repl-backlog-size": 1024 * 1024,
+    "client-output-buffer-limit": "replica 268435456 67108864 60 pubsub 33554432 8388608 60",
+    "replica-read-only": "yes",
+    #replica: refuse reads once the master has been silent for longer than this, 0 never does
+    "replica-max-lag": 0,
+    #master: seconds between PINGs to the replicas, so an idle master still shows it is alive
+    "repl-ping-replica-period": 10,
+    "workers": 1,
+    #a worker asked for a key another one owns: "proxy" forwards the command, "moved" redirects the client
+    "worker-routing": "proxy",
+    "cluster-enabled": "no",
+    #static node map, one "host:port slot-range..." line per node
+    "cluster-config-file": "nodes.conf",
+    "cluster-announce-ip": "127.0.0.1", #the host this node is listed under in the node map
+    "loglevel": "notice",
+    #microseconds a command must run to enter the slow log, negative disables it, 0 logs every command
+    "slowlog-log-slower-than": 10000,
+    "slowlog-max-len": 128,
+    "latency-tracking": "yes", #per-command latency histograms, for INFO latencystats and LATENCY HISTOGRAM
+    #milliseconds after which a script that hasn't written anything yet is stopped
+    "busy-reply-threshold": 5000,
+    #keys remembered for CLIENT TRACKING, the oldest are invalidated past it; 0 is unlimited
+    "tracking-table-max-keys": 1000000,
+}
+
+MAXMEMORY_POLICIES = ("noeviction", "allkeys-lru", "allkeys-lfu", "volatile-ttl")
+APPENDFSYNC_POLICIES = ("always", "everysec", "no")
+#client class -> (hard limit, soft limit, seconds over the soft limit), from client-output-buffer-limit
+output_buffer_limits = {
+    "replica": (256 * 1024 * 1024, 64 * 1024 * 1024, 60),
+    "pubsub": (32 * 1024 * 1024, 8 * 1024 * 1024, 60),
+}
+
+class Timers:
+    #min-heap of scheduled callbacks, run by the event loop or, threaded, by their own thread
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+
+    def call_later(self, delay, callback, *args):
+        entry = [time.monotonic() + delay, next(self.counter), callback, args]
+        with self.cond:
+            heapq.heappush(self.heap, entry)
+            self.cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        #cancelled entries stay in the heap and are skipped when they come due
+        entry[2] = None
+
+    def next_timeout(self):
+        with self.cond:
+            if not self.heap:
+                return None
+            return max(0, self.heap[0][0] - time.monotonic())
+
+    def run_due(self):
+        now = time.monotonic()
+        while True:
+            #other threads push entries, so peek and pop under the same lock
+            with self.cond:
+                if not self.heap or self.heap[0][0] > now:
+                    return
+                _, _, callback, args = heapq.heappop(self.heap)
+            if callback is not None:
+                with server_lock:
+                    callback(*args)
 
-def handle_client(client_socket, addr, is_master):
-    print(f"handling connection from {addr}")
+    def run_forever(self, after_run = None):
+        while True:
+            with self.cond:
+                self.cond.wait(self.next_timeout())
+            self.run_due()
+            if after_run is not None:
+                after_run()
+
+timers = Timers()
+
+class EventLoop:
+    #single-threaded reactor: every socket has a read and a write callback
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.paused_readers = {}
+        #other threads write a byte here so select() returns and sees their new timers
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.add_reader(self.wake_reader, self._drain_wakeups)
+
+    def wake(self):
+        try:
+            self.wake_writer.send(b"\0")
+        except BlockingIOError:
+            pass #a wakeup is already pending
+
+    def _drain_wakeups(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def add_reader(self, sock, callback, *args):
+        self._set_handler(sock, 0, (callback, args))
+
+    def remove_reader(self, sock):
+        self._set_handler(sock, 0, None)
+
+    def add_writer(self, sock, callback, *args):
+        self._set_handler(sock, 1, (callback, args))
+
+    def remove_writer(self, sock):
+        self._set_handler(sock, 1, None)
+
+    def pause_reading(self, sock):
+        self.paused_readers[sock] = self.selector.get_key(sock).data[0]
+        self.remove_reader(sock)
+
+    def resume_reading(self, sock):
+        handler = self.paused_readers.pop(sock, None)
+        if handler is not None:
+            self._set_handler(sock, 0, handler)
+
+    def forget(self, sock):
+        self.paused_readers.pop(sock, None)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def _set_handler(self, sock, slot, handler):
+        try:
+            handlers = list(self.selector.get_key(sock).data)
+            registered = True
+        except (KeyError, ValueError):
+            handlers = [None, None]
+            registered = False
+        handlers[slot] = handler
+        events = (selectors.EVENT_READ if handlers[0] else 0) | (selectors.EVENT_WRITE if handlers[1] else 0)
+        if not events:
+            if registered:
+                self.selector.unregister(sock)
+        elif registered:
+            self.selector.modify(sock, events, handlers)
+        else:
+            self.selector.register(sock, events, handlers)
+
+    def run_forever(self, before_sleep = None):
+        while True:
+            if before_sleep is not None:
+                before_sleep()
+            for key, mask in self.selector.select(timers.next_timeout()):
+                reader, writer = key.data
+                if mask & selectors.EVENT_READ and reader:
+                    reader[0](key.fileobj, *reader[1])
+                    if mask & selectors.EVENT_WRITE:
+                        #the read handler may have closed or re-registered the socket
+                        try:
+                            writer = self.selector.get_key(key.fileobj).data[1]
+                        except (KeyError, ValueError):
+                            continue
+                if mask & selectors.EVENT_WRITE and writer:
+                    writer[0](key.fileobj, *writer[1])
+            timers.run_due()
+
+class Connection:
+    #per-socket state for both I/O models; loop is None in the threaded one
+
+    def __init__(self, sock, addr, loop = None, is_master_link = False, on_worker_port = False):
+        self.sock = sock
+        self.addr = addr
+        self.loop = loop
+        #accepted on a worker's own port rather than the shared one: keyspace-wide
+        #commands see that worker's shard only, as on a cluster node
+        self.on_worker_port = on_worker_port
+        #commands read from our master are applied without replies or eviction
+        self.is_master_link = is_master_link
+        self.parser = RespParser()
+        self.replies = []
+        self.reply_bytes = 0
+        self.reading_paused = False
+        #other threads append to a replica's buffer while its own thread reads from it
+        self.lock = threading.Lock()
+        #full resync of a replica: None until it sends PSYNC, then "wait_bgsave"
+        #until its snapshot is written, "send_bulk" while the file is sent, "online"
+        self.repl_state = None
+        self.repl_snapshot_pid = None #the child writing the snapshot this replica will get
+        self.repl_buffer = [] #writes propagated after that snapshot, sent once it is loaded
+        self.repl_transfer = None #open snapshot file being sent and the offset reached
+        self.repl_ack_offset = 0 #replica: last offset it acknowledged with REPLCONF ACK
+        self.repl_ack_time = 0.0 #replica: monotonic time of that acknowledgement
+        self.repl_buffer_bytes = 0
+        self.soft_limit_since = None #when the output first went over the soft limit
+        #threaded replicas: their sender thread waits on this for queued output
+        self.output_ready = None
+        #set while a blocking command (WAIT) waits; later commands stay in the parser
+        self.blocked = None
+        self.woff = 0 #replication offset right after this client's last write
+        self.repl_mark = 0 #master link: parser position the replication offset was counted up to
+        self.proxy_waiting = None #cluster link: clients waiting for its replies, oldest first
+        #channels and patterns this client is subscribed to; while it has any, it
+        #is in subscribe mode and only the pubsub commands are allowed
+        self.channels = set()
+        self.patterns = set()
+        self.multi = None #commands queued since MULTI, None outside a transaction
+        self.multi_error = False #a command was refused while queuing, EXEC will abort
+        self.watched = set() #keys this client WATCHes
+        self.watch_dirty = False #one of them changed since, EXEC will fail
+        self.id = next(client_ids)
+        self.name = None
+        self.resp = 2 #protocol version chosen with HELLO
+        #CLIENT TRACKING options while it is on: bcast, prefixes, optin, optout, and
+        #caching, what the last CLIENT CACHING said about the next command
+        self.tracking = None
+
+    def add_reply(self, data):
+        self.replies.append(data)
+        self.reply_bytes += len(data)
+
+    def write_pending(self):
+        #True once everything is sent
+        replies = self.replies
+        while replies:
+            try:
+                sent = self.sock.sendmsg(replies[:IOV_MAX])
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.reply_bytes -= sent
+            stats["total_net_repl_output_bytes" if self.repl_state is not None else "total_net_output_bytes"] += sent
+            #drop the chunks that went out completely and trim a partially sent one
+            done = 0
+            while done < len(replies) and sent >= len(replies[done]):
+                sent -= len(replies[done])
+                done += 1
+            del replies[:done]
+            if sent:
+                replies[0] = memoryview(replies[0])[sent:]
+        return True
+
+def flush_replies(conn):
+    if conn.output_ready is not None:
+        #a threaded replica's sender thread does the writing
+        with conn.output_ready:
+            conn.output_ready.notify()
+        return
+    if conn.repl_state == "send_bulk":
+        #the snapshot transfer owns the socket, replies wait until it is done
+        return
+    with conn.lock:
+        drained = conn.write_pending()
+    if conn.loop is None or drained:
+        return
+    #the kernel buffer is full: finish the write when the socket drains and
+    #stop reading new commands from a client that doesn't read its replies;
+    #a replica's output is bounded by the output buffer limit instead
+    conn.loop.add_writer(conn.sock, on_client_writable, conn)
+    if (conn.reply_bytes > config["client-output-high-water"] and not conn.reading_paused
+            and conn.repl_state is None and conn.proxy_waiting is None):
+        conn.reading_paused = True
+        conn.loop.pause_reading(conn.sock)
+
+def handle_client(client_socket, addr, is_master, on_worker_port):
+    conn = Connection(client_socket, addr, on_worker_port = on_worker_port)
+    with server_lock:
+        clients.add(conn)
     try:
         while True:
-            data = client_socket.recv(1024)
+            data = client_socket.recv(65536)
             if not data:
                 break
-            #always an array, and array can contain tuple(str/bytes tring)/str/byte string
-            response = process_command(data, is_master, client_socket)
-            if response is not None:
-                send_response(client_socket, response)
+            if not handle_client_data(conn, data, is_master):
+                break
     finally:
+        with server_lock:
+            clients.discard(conn)
+            unwatch_all_keys(conn)
+            disable_tracking(conn)
+        release_blocked_client(conn)
+        release_subscriptions(conn)
+        drop_replica(conn)
         client_socket.close()
-        print(f"Connetion from {addr} closed")
-
-def send_response(client_socket, response):
-    #always an array and it could contain tuple, str or byte string
-    for resp in response:
-        if isinstance(resp, tuple):
-            for r in resp:
-                if isinstance(r, str):
-                    r = r.encode()
-                client_socket.sendall(r)
-        elif isinstance(resp, str):
-            client_socket.sendall(resp.encode())
-        else:
-            client_socket.sendall(resp)
-
-def split_commands(data):
-    print(f"full byte string for split_commands {data}")
-    commands = []
-    i = 0
-
-    while i < len(data):
-        if data[i:i+1] == b'$':
-            # This is likely the RDB file or a bulk string
-            length_delimiter_start = data.index(b'\r\n', i)
-            length = int(data[i+1:length_delimiter_start])
-            content_start = length_delimiter_start + 2
-            content_end = content_start + length
-
-            #check if there is room for \r\n at the end
-            if content_end + 2 <= len(data) and data[content_end: content_end + 2] == b'\r\n':
-                command_end = content_end + 2
-            else:
-                command_end = content_end
-            
-            commands.append(data[i:command_end])
-            i = command_end
-        elif data[i:i+1] == b'*':
-            # This is a Redis command
-            command_end = data.index(b'\r\n', i)
-            num_parts = int(data[i+1:command_end])
-            for _ in range(num_parts):
-                command_end = data.index(b'\r\n', command_end + 1)
-                command_end = data.index(b'\r\n', command_end + 1)
-            commands.append(data[i:command_end+2])
-            i = command_end + 2
+        log(VERBOSE, "Client closed connection id=%s addr=%s:%d", id(conn), addr[0], addr[1])
+
+def handle_client_data(conn, data, is_master):
+    #returns False when the connection has to be closed
+    keep_open = True
+    try:
+        with server_lock:
+            #threaded clients share the counters too
+            stats["total_net_input_bytes"] += len(data)
+            #fed under the lock: another thread may be running this client's
+            #pipelined commands while unblocking it
+            conn.parser.feed(data)
+            process_command(conn, is_master)
+    except ProtocolError as e:
+        conn.add_reply(encode_error(f"ERR Protocol error: {e}"))
+        keep_open = False
+    if conn.loop is not None and keep_open:
+        #sent by before_sleep() along with every other client served in this iteration
+        pending_writes.add(conn)
+        return True
+    #a reply may only leave once the writes before it are in the AOF;
+    #everything produced by this read goes out in one write
+    flush_append_only_file()
+    flush_replies(conn)
+    return keep_open
+
+def before_sleep():
+    #group commit: one AOF write (and fsync under appendfsync always) covers the
+    #commands of every client served in this loop iteration, then their replies go out
+    flush_append_only_file()
+    while pending_writes:
+        conn = pending_writes.pop()
+        try:
+            flush_replies(conn)
+        except OSError as e:
+            log(VERBOSE, "Error writing to client %s:%d: %s", conn.addr[0], conn.addr[1], e)
+            close_client(conn)
+
+def close_client(conn):
+    if conn.is_master_link:
+        drop_master_link(conn)
+        return
+    pending_writes.discard(conn)
+    conn.loop.forget(conn.sock)
+    release_blocked_client(conn)
+    unwatch_all_keys(conn)
+    disable_tracking(conn)
+    release_subscriptions(conn)
+    drop_replica(conn)
+    drop_cluster_link(conn)
+    conn.sock.close()
+    if conn in clients:
+        clients.discard(conn)
+        log(VERBOSE, "Client closed connection id=%s addr=%s:%d", id(conn), conn.addr[0], conn.addr[1])
+
+def on_client_readable(client_socket, conn, is_master):
+    #the selector reported data, so this recv returns without blocking the loop
+    try:
+        data = client_socket.recv(65536)
+    except (BlockingIOError, InterruptedError):
+        return
+    except ConnectionError:
+        data = b""
+    try:
+        if data and handle_client_data(conn, data, is_master):
+            return
+    except OSError as e:
+        log(VERBOSE, "Error writing to client %s:%d: %s", conn.addr[0], conn.addr[1], e)
+    close_client(conn)
+
+def on_client_writable(client_socket, conn):
+    try:
+        drained = conn.write_pending()
+    except OSError as e:
+        log(VERBOSE, "Error writing to client %s:%d: %s", conn.addr[0], conn.addr[1], e)
+        close_client(conn)
+        return
+    if drained:
+        conn.loop.remove_writer(client_socket)
+    if conn.reading_paused and conn.reply_bytes <= config["client-output-high-water"] // 2:
+        conn.reading_paused = False
+        conn.loop.resume_reading(client_socket)
+
+def on_client_accept(server_socket, loop, is_master, on_worker_port):
+    try:
+        client_socket, addr = server_socket.accept()
+    except (BlockingIOError, InterruptedError):
+        return
+    client_socket.setblocking(False)
+    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    conn = Connection(client_socket, addr, loop, on_worker_port = on_worker_port)
+    loop.add_reader(client_socket, on_client_readable, conn, is_master)
+    #the replication thread walks clients while it loads a snapshot
+    with server_lock:
+        clients.add(conn)
+        stats["total_connections_received"] += 1
+    log(VERBOSE, "Accepted %s:%d", addr[0], addr[1])
+
+def process_command(conn, is_master):
+    #run every complete command buffered on the connection, partial ones wait for more data;
+    #a blocked client's commands wait until it is unblocked
+    while conn.blocked is None:
+        args = conn.parser.next_command()
+        if args is None:
+            break
+        offset = replication["offset"]
+        response = process_single_command(args, is_master, conn)
+        if ready_keys:
+            serve_blocked_clients()
+        if replication["offset"] != offset:
+            conn.woff = replication["offset"]
+        if response is not None:
+            with conn.lock:
+                conn.add_reply(response)
+
+def block_client(conn, timeout, on_timeout, on_close, **state):
+    #on_timeout(conn) must unblock the client, on_close(conn) unregisters it if it disconnects first
+    state.update(on_timeout = on_timeout, on_close = on_close, timer = None)
+    if timeout:
+        state["timer"] = timers.call_later(timeout, on_timeout, conn)
+    conn.blocked = state
+
+def unblock_client(conn, reply):
+    state = conn.blocked
+    conn.blocked = None
+    if state["timer"] is not None:
+        timers.cancel(state["timer"])
+    with conn.lock:
+        conn.add_reply(reply)
+    #commands pipelined behind the blocking one run now
+    try:
+        process_command(conn, replication["master_host"] is None)
+    except ProtocolError:
+        pass #raised again, and handled, on the connection's next read
+    schedule_flush(conn)
+
+def release_blocked_client(conn):
+    #the connection is closing
+    with server_lock:
+        state = conn.blocked
+        if state is None:
+            return
+        if state["timer"] is not None:
+            timers.cancel(state["timer"])
+        state["on_close"](conn)
+        conn.blocked = None
+
+def wrong_arity_error(command):
+    return encode_error(f"ERR wrong number of arguments for '{command.decode(errors='replace').lower()}' command")
+
+#commands that change the dataset, refused on a read-only replica unless they come from its master
+WRITE_COMMANDS = frozenset([b'SET', b'INCR', b'DECR', b'INCRBY', b'DECRBY', b'DEL', b'UNLINK',
+                            b'MSET', b'MSETNX', b'PEXPIREAT', b'HSET', b'HINCRBY', b'HDEL', b'LPUSH',
+                            b'RPUSH', b'LPOP', b'RPOP', b'SADD', b'SREM', b'ZADD', b'ZREM',
+                            b'LMOVE', b'BLPOP', b'BRPOP', b'BLMOVE', b'XADD', b'XTRIM', b'XSETID',
+                            b'FLUSHALL', b'FLUSHDB'])
+#commands a replica keeps serving when its data is too stale (Redis' CMD_STALE)
+STALE_COMMANDS = frozenset([b'PING', b'ECHO', b'INFO', b'REPLCONF', b'WAIT', b'PSYNC', b'CONFIG',
+                            b'SAVE', b'BGSAVE', b'BGREWRITEAOF', b'LASTSAVE', b'CLUSTER', b'PUBLISH',
+                            b'SUBSCRIBE', b'UNSUBSCRIBE', b'PSUBSCRIBE', b'PUNSUBSCRIBE', b'PUBSUB',
+                            b'SLOWLOG', b'LATENCY', b'MULTI', b'EXEC', b'DISCARD',
+                            b'WATCH', b'UNWATCH', b'SCRIPT', b'HELLO', b'CLIENT'])
+#all a client in subscribe mode may send
+SUBSCRIBE_MODE_COMMANDS = frozenset([b'SUBSCRIBE', b'UNSUBSCRIBE', b'PSUBSCRIBE', b'PUNSUBSCRIBE', b'PING'])
+
+def replica_refusal(command):
+    #the error a replica answers a client's command with, or None to run it
+    if command in WRITE_COMMANDS and config["replica-read-only"] == "yes":
+        return READONLY_ERROR
+    max_lag = config["replica-max-lag"]
+    if max_lag and command not in STALE_COMMANDS:
+        lag = replica_lag()
+        if lag > max_lag:
+            state = "up" if replication["master_link"] is not None else "down"
+            return encode_error(f"MASTERDOWN Link with MASTER is {state} and no data arrived for "
+                                f"{lag:.0f} seconds, over replica-max-lag ({max_lag})")
+    return None
+
+#command -> (first, last, step) argument positions of its keys, a negative last counting from the end
+COMMAND_KEYS = {
+    b'SET': (1, 1, 1),
+    b'GET': (1, 1, 1),
+    b'INCR': (1, 1, 1),
+    b'DECR': (1, 1, 1),
+    b'INCRBY': (1, 1, 1),
+    b'DECRBY': (1, 1, 1),
+    b'DEL': (1, -1, 1),
+    b'UNLINK': (1, -1, 1),
+    b'EXISTS': (1, -1, 1),
+    b'MGET': (1, -1, 1),
+    b'MSET': (1, -1, 2),
+    b'MSETNX': (1, -1, 2),
+    b'TYPE': (1, 1, 1),
+    b'OBJECT': (2, 2, 1),
+    b'PEXPIREAT': (1, 1, 1),
+    b'LMOVE': (1, 2, 1),
+    b'BLMOVE': (1, 2, 1),
+    b'BLPOP': (1, -2, 1),
+    b'BRPOP': (1, -2, 1),
+}
+BLOCKING_COMMANDS = frozenset([b'BLPOP', b'BRPOP', b'BLMOVE'])
+#commands over the whole keyspace; with --workers, one sent to the shared port runs on every worker
+KEYSPACE_COMMANDS = frozenset([b'DBSIZE', b'KEYS', b'SCAN', b'FLUSHALL', b'FLUSHDB'])
+HASH_COMMANDS = frozenset([b'HSET', b'HGET', b'HGETALL', b'HINCRBY', b'HDEL', b'HLEN'])
+LIST_COMMANDS = frozenset([b'LPUSH', b'RPUSH', b'LPOP', b'RPOP', b'LRANGE', b'LLEN'])
+SET_COMMANDS = frozenset([b'SADD', b'SREM', b'SISMEMBER', b'SMEMBERS', b'SCARD'])
+ZSET_COMMANDS = frozenset([b'ZADD', b'ZREM', b'ZRANGE', b'ZRANGEBYSCORE', b'ZRANK', b'ZSCORE', b'ZCARD'])
+STREAM_COMMANDS = frozenset([b'XADD', b'XRANGE', b'XREVRANGE', b'XLEN', b'XTRIM', b'XSETID'])
+for command in HASH_COMMANDS | LIST_COMMANDS | SET_COMMANDS | ZSET_COMMANDS | STREAM_COMMANDS:
+    COMMAND_KEYS[command] = (1, 1, 1)
+
+def key_arguments(command, args):
+    #the keys among args, for a command listed in COMMAND_KEYS
+    first, last, step = COMMAND_KEYS[command]
+    return args[first:len(args) + last + 1 if last < 0 else last + 1:step]
+
+class WrongTypeError(Exception):
+    pass
+
+def route_command(command, args, conn):
+    #False runs the command here; anything else is its response (None once it is proxied)
+    if command in KEYSPACE_COMMANDS:
+        if config["workers"] > 1 and not conn.on_worker_port:
+            return fan_out_command(command, args, conn)
+        return False
+    blocking = command in BLOCKING_COMMANDS
+    if command == b'XREAD':
+        #its keys follow STREAMS
+        try:
+            _, block, keys, _ = parse_xread(args)
+        except (SyntaxError, IndexError, ValueError):
+            return False
+        blocking = block is not None
+    elif command in (b'EVAL', b'EVALSHA'):
+        #a script declares its keys up front
+        try:
+            numkeys = int(args[2])
+        except (IndexError, ValueError):
+            return False
+        keys = args[3:3 + max(numkeys, 0)]
+    else:
+        if command not in COMMAND_KEYS:
+            return False
+        keys = key_arguments(command, args)
+    if not keys:
+        return False #the command reports its own arity error
+    slot = key_hash_slot(keys[0])
+    for key in keys[1:]:
+        if key_hash_slot(key) != slot:
+            return CROSSSLOT_ERROR
+    owner = cluster["slot_owner"][slot]
+    if owner == cluster["myself"]:
+        return False
+    if owner is None:
+        return encode_error("CLUSTERDOWN Hash slot not served")
+    #cluster nodes always redirect, only workers of one server may forward
+    if config["cluster-enabled"] == "yes" or config["worker-routing"] == "moved":
+        host, port = cluster["nodes"][owner]
+        return encode_error(f"MOVED {slot} {host}:{port}")
+    if conn.multi is not None:
+        #a transaction runs in one process, which has to own all of its keys
+        return encode_error("ERR transactions on keys of another worker are not supported with --workers")
+    #a blocking command would hold up every command queued behind it on the shared link
+    return proxy_command(conn, [owner], args, dedicated = blocking)
+
+def fan_out_command(command, args, conn):
+    #run on every worker's own port and merge the replies; SCAN visits the workers one after
+    #another, the worker being scanned kept in the cursor
+    if conn.multi is not None:
+        return encode_error(f"ERR '{command.decode().lower()}' can't be used in a transaction with --workers")
+    count = len(cluster["nodes"])
+    if command == b'SCAN':
+        if len(args) < 2:
+            return False #the command reports its own arity error
+        try:
+            cursor = int(args[1])
+        except ValueError:
+            return encode_error("ERR invalid cursor")
+        if not 0 <= cursor < BUCKET_COUNT * count:
+            return encode_error("ERR invalid cursor")
+        index = cursor % count
+        return proxy_command(conn, [index], [args[0], b"%d" % (cursor // count)] + args[2:],
+                             lambda replies: worker_scan_reply(replies[0], index, count))
+    if command == b'DBSIZE':
+        merge = merge_integer_replies
+    elif command == b'KEYS':
+        merge = merge_array_replies
+    else:
+        merge = merge_status_replies
+    return proxy_command(conn, range(count), args, merge)
+
+def worker_scan_reply(reply, index, count):
+    #a worker's own cursor c becomes c * count + index; once it is done, the scan moves to the next worker
+    if not reply.startswith(b"*2\r\n"):
+        return reply
+    _, _, cursor, keys = reply.split(b"\r\n", 3)
+    cursor = int(cursor)
+    if cursor:
+        cursor = cursor * count + index
+    elif index + 1 < count:
+        cursor = index + 1
+    return b"*2\r\n" + encode_bulk(b"%d" % cursor) + keys
+
+def first_error_reply(replies):
+    for reply in replies:
+        if reply.startswith(b"-"):
+            return reply
+    return None
+
+def merge_integer_replies(replies):
+    return first_error_reply(replies) or encode_integer(sum(int(reply[1:-2]) for reply in replies))
+
+def merge_array_replies(replies):
+    error = first_error_reply(replies)
+    if error is not None:
+        return error
+    headers, bodies = zip(*(reply.split(b"\r\n", 1) for reply in replies))
+    return b"*%d\r\n" % sum(int(header[1:]) for header in headers) + b"".join(bodies)
+
+def merge_status_replies(replies):
+    return first_error_reply(replies) or replies[0]
+
+class UnknownCommandError(Exception):
+    pass #no dispatch branch, so no commandstats entry either
+
+#every command execute_command() knows, checked while a transaction is queued
+COMMANDS = frozenset([
+    b'SET', b'GET', b'MGET', b'MSET', b'MSETNX', b'DEL', b'UNLINK', b'EXISTS', b'BLPOP', b'BRPOP', b'LMOVE',
+    b'BLMOVE', b'XREAD', b'TYPE', b'DBSIZE', b'KEYS', b'SCAN', b'FLUSHALL', b'FLUSHDB', b'OBJECT', b'PEXPIREAT',
+    b'INCR', b'DECR', b'INCRBY', b'DECRBY', b'ECHO', b'PING', b'PUBLISH', b'SUBSCRIBE', b'PSUBSCRIBE',
+    b'UNSUBSCRIBE', b'PUNSUBSCRIBE', b'PUBSUB', b'INFO', b'REPLCONF', b'WAIT', b'PSYNC', b'CONFIG', b'SAVE',
+    b'BGSAVE', b'BGREWRITEAOF', b'LASTSAVE', b'CLUSTER', b'SLOWLOG', b'LATENCY', b'MULTI', b'EXEC',
+    b'DISCARD', b'WATCH', b'UNWATCH', b'EVAL', b'EVALSHA', b'SCRIPT', b'HELLO', b'CLIENT',
+]) | HASH_COMMANDS | LIST_COMMANDS | SET_COMMANDS | ZSET_COMMANDS | STREAM_COMMANDS
+#run at once inside MULTI instead of being queued
+TRANSACTION_COMMANDS = frozenset([b'MULTI', b'EXEC', b'DISCARD', b'WATCH'])
+#commands a script can't call: they control the connection or run scripts themselves
+NOSCRIPT_COMMANDS = frozenset([b'MULTI', b'EXEC', b'DISCARD', b'WATCH', b'UNWATCH', b'EVAL', b'EVALSHA', b'SCRIPT',
+                               b'SUBSCRIBE', b'PSUBSCRIBE', b'UNSUBSCRIBE', b'PUNSUBSCRIBE', b'PSYNC',
+                               b'REPLCONF', b'WAIT', b'SAVE', b'BGSAVE', b'BGREWRITEAOF', b'CLUSTER',
+                               b'HELLO', b'CLIENT'])
+
+def process_single_command(args, is_master, conn):
+    command = args[0].upper()
+    #a RESP3 client tells messages from replies by their type and may send anything
+    if (conn.channels or conn.patterns) and command not in SUBSCRIBE_MODE_COMMANDS and conn.resp == 2:
+        return reject_command(conn, command, encode_error(
+            f"ERR Can't execute '{args[0].decode(errors='replace').lower()}': only (P|S)SUBSCRIBE / "
+            "(P|S)UNSUBSCRIBE / PING / QUIT / RESET are allowed in this context"))
+    if conn.multi is not None and command not in COMMANDS:
+        return reject_command(conn, command, encode_error(f"ERR unknown command '{args[0].decode(errors='replace')}'"))
+    if not is_master and not conn.is_master_link:
+        refusal = replica_refusal(command)
+        if refusal is not None:
+            return reject_command(conn, command, refusal)
+    if cluster["slot_owner"] is not None and not conn.is_master_link:
+        response = route_command(command, args, conn)
+        if response is not False:
+            return response if response is None else reject_command(conn, command, response)
+    if conn.multi is not None and command not in TRANSACTION_COMMANDS:
+        conn.multi.append(args)
+        return b"+QUEUED\r\n"
+    response = call_command(command, args, is_master, conn)
+    if conn.tracking is not None and command not in (b'CLIENT', b'MULTI'):
+        #CLIENT CACHING covers the one command after it, or the transaction it opens
+        conn.tracking["caching"] = None
+    return response
+
+def call_command(command, args, is_master, conn):
+    #run a command that passed the checks, timing it for commandstats and the slow log
+    started = time.perf_counter_ns()
+    try:
+        response = execute_command(command, args, is_master, conn)
+    except UnknownCommandError:
+        return encode_error(f"ERR unknown command '{args[0].decode(errors='replace')}'")
+    except IndexError:
+        return reject_command(conn, command, wrong_arity_error(command))
+    except Exception:
+        #a bug in one command fails that command only, not the whole server
+        log(WARNING, "Error running '%s' for %s:%s\n%s", command.decode(errors = "replace"), conn.addr[0],
+            conn.addr[1], traceback.format_exc().rstrip())
+        response = encode_error(f"ERR internal error running '{command.decode(errors='replace').lower()}'")
+    usec = (time.perf_counter_ns() - started) // 1000
+    if conn.tracking is not None and command in COMMAND_KEYS and command not in WRITE_COMMANDS:
+        remember_read_keys(conn, command, args)
+
+    entry = command_stats.get(command)
+    if entry is None:
+        entry = command_stats[command] = CommandStats()
+    entry.calls += 1
+    entry.usec += usec
+    if response is not None and response[:1] == b"-":
+        entry.failed_calls += 1
+    if config["latency-tracking"] == "yes":
+        entry.latency.record(usec)
+    stats["total_commands_processed"] += 1
+    threshold = config["slowlog-log-slower-than"]
+    if 0 <= threshold <= usec:
+        slowlog.add(args, time.time(), usec, conn.addr)
+    return response
+
+def reject_command(conn, command, response):
+    #refused before it ran: counted apart from calls, like Redis' rejected_calls,
+    #and a transaction being queued is aborted by EXEC
+    stats["rejected_calls"] += 1
+    if command in COMMANDS:
+        entry = command_stats.get(command)
+        if entry is None:
+            entry = command_stats[command] = CommandStats()
+        entry.rejected_calls += 1
+    if conn.multi is not None:
+        conn.multi_error = True
+    return response
+
+def execute_command(command, args, is_master, conn):
+    try:
+        if command == b'SET':
+            return set_command(args[1], args[2], args, conn.is_master_link)
+        elif command == b'GET':
+            return get_command(args[1])
+        elif command == b'MGET':
+            if len(args) < 2:
+                return wrong_arity_error(command)
+            return mget_command(args)
+        elif command in (b'MSET', b'MSETNX'):
+            if len(args) < 3 or len(args) % 2 == 0:
+                return wrong_arity_error(command)
+            return mset_command(args, command == b'MSETNX', conn.is_master_link)
+        elif command in (b'DEL', b'UNLINK'):
+            if len(args) < 2:
+                return wrong_arity_error(command)
+            return del_command(args, command == b'UNLINK', conn.is_master_link)
+        elif command == b'EXISTS':
+            if len(args) < 2:
+                return wrong_arity_error(command)
+            return encode_integer(sum(1 for key in args[1:] if lookup_key(key) is not None))
+        elif command in HASH_COMMANDS:
+            return hash_command(command, args, conn.is_master_link)
+        elif command in (b'BLPOP', b'BRPOP'):
+            if len(args) < 3:
+                return wrong_arity_error(command)
+            return blocking_pop_command(conn, command, args)
+        elif command == b'LMOVE':
+            if len(args) != 5:
+                return wrong_arity_error(command)
+            return lmove_command(args)
+        elif command == b'BLMOVE':
+            if len(args) != 6:
+                return wrong_arity_error(command)
+            return blocking_pop_command(conn, command, args)
+        elif command in LIST_COMMANDS:
+            return list_command(command, args, conn.is_master_link)
+        elif command in SET_COMMANDS:
+            return settype_command(command, args, conn.is_master_link)
+        elif command in ZSET_COMMANDS:
+            return zset_command(command, args, conn.is_master_link)
+        elif command in STREAM_COMMANDS:
+            return stream_command(command, args, conn.is_master_link)
+        elif command == b'XREAD':
+            return xread_command(conn, args)
+        elif command == b'TYPE':
+            return type_command(args[1])
+        elif command == b'DBSIZE':
+            return encode_integer(len(database))
+        elif command == b'KEYS':
+            if len(args) != 2:
+                return wrong_arity_error(command)
+            return keys_command(conn, args[1])
+        elif command == b'SCAN':
+            return scan_command(args)
+        elif command in (b'FLUSHALL', b'FLUSHDB'):
+            return flushall_command(args)
+        elif command == b'OBJECT':
+            return object_command(args)
+        elif command == b'PEXPIREAT':
+            return pexpireat_command(args[1], args, conn.is_master_link)
+        elif command in (b'INCR', b'DECR'):
+            return incr_command(args[1], 1 if command == b'INCR' else -1, args, conn.is_master_link)
+        elif command in (b'INCRBY', b'DECRBY'):
+            try:
+                delta = int(args[2])
+            except ValueError:
+                return NOT_INTEGER_ERROR
+            return incr_command(args[1], delta if command == b'INCRBY' else -delta, args, conn.is_master_link)
+        elif command == b'ECHO':
+            return encode_bulk(args[1])
+        elif command == b'PING':
+            if (conn.channels or conn.patterns) and conn.resp == 2:
+                #in subscribe mode replies are arrays, like the messages around them
+                return encode_array([encode_bulk(b"pong"), encode_bulk(args[1] if len(args) > 1 else b"")])
+            return encode_bulk(args[1]) if len(args) > 1 else PONG
+        elif command == b'PUBLISH':
+            if len(args) != 3:
+                return wrong_arity_error(command)
+            return encode_integer(publish(args[1], args[2], args))
+        elif command in (b'SUBSCRIBE', b'PSUBSCRIBE'):
+            if len(args) < 2:
+                return wrong_arity_error(command)
+            return subscribe_command(conn, args[1:], command == b'PSUBSCRIBE')
+        elif command in (b'UNSUBSCRIBE', b'PUNSUBSCRIBE'):
+            return unsubscribe_command(conn, args[1:], command == b'PUNSUBSCRIBE')
+        elif command == b'PUBSUB':
+            return pubsub_command(args)
+        elif command == b'INFO':
+            section = args[1] if len(args) > 1 else b""
+            return info_command(section, is_master)
+        elif command == b"REPLCONF":
+            return handle_replconf(args, conn)
+        elif command == b"WAIT":
+            return wait_command(conn, args[1], args[2], is_master)
+        elif command == b"PSYNC":
+            return handle_psync(conn, args[1], args[2])
+        elif command == b"CONFIG":
+            return config_command(args)
+        elif command == b"SAVE":
+            return save_command()
+        elif command == b"BGSAVE":
+            return bgsave_command()
+        elif command == b"BGREWRITEAOF":
+            return bgrewriteaof_command()
+        elif command == b"LASTSAVE":
+            return encode_integer(persistence["lastsave"])
+        elif command == b"CLUSTER":
+            return cluster_command(args)
+        elif command == b"SLOWLOG":
+            return slowlog_command(args)
+        elif command == b"LATENCY":
+            return latency_command(args)
+        elif command == b"MULTI":
+            return multi_command(conn)
+        elif command == b"EXEC":
+            return exec_command(conn, is_master)
+        elif command == b"DISCARD":
+            return discard_command(conn)
+        elif command == b"WATCH":
+            if len(args) < 2:
+                return wrong_arity_error(command)
+            return watch_command(conn, args[1:])
+        elif command == b"UNWATCH":
+            unwatch_all_keys(conn)
+            return OK
+        elif command in (b"EVAL", b"EVALSHA"):
+            if len(args) < 3:
+                return wrong_arity_error(command)
+            return eval_command(conn, args, is_master, command == b"EVALSHA")
+        elif command == b"SCRIPT":
+            return script_command(args)
+        elif command == b"HELLO":
+            return hello_command(conn, args)
+        elif command == b"CLIENT":
+            return client_command(conn, args)
         else:
-            # Unexpected data
-            raise ValueError(f"Unexpected data format at position {i}")
+            raise UnknownCommandError()
+    except WrongTypeError:
+        return WRONGTYPE_ERROR
+
+def process_master_single_command(args, master_conn):
+    command = args[0].upper()
+    if command == b"REPLCONF":
+        #the master asks where we are; the reply leaves out the GETACK itself
+        if args[1].lower() == b"getack":
+            return encode_command([b"REPLCONF", b"ACK", b"%d" % replication["offset"]])
+        return None
+    else:
+        #writes from the master go through the regular commands, their replies are dropped
+        replication["applying_master_stream"] = True
+        try:
+            process_single_command(args, False, master_conn)
+        finally:
+            replication["applying_master_stream"] = False
+        return None
+
+def set_command(key, value, args, from_master = False):
+    expiry = None
+    if len(args) > 3:
+        option = args[3].upper()
+        if option not in (b'EX', b'PX', b'EXAT', b'PXAT') or len(args) != 5:
+            return encode_error("ERR syntax error")
+        try:
+            amount = int(args[4])
+        except ValueError:
+            return NOT_INTEGER_ERROR
+        if amount <= 0:
+            return encode_error("ERR invalid expire time in 'set' command")
+        if option in (b'EX', b'EXAT'):
+            amount *= 1000
+        expiry = amount if option.endswith(b'AT') else mstime() + amount
+        #the deadline is stored, and saved in RDB files, as a signed 64 bit ms time
+        if expiry > INT64_MAX:
+            return encode_error("ERR invalid expire time in 'set' command")
+    value = try_int_encoding(value)
+
+    if write_refused(entry_size(key, value), from_master):
+        return OOM_ERROR
+
+    set_key(key, value, expiry)
+
+    #replicas and the AOF get the absolute expiry, so a command applied
+    #later (or replayed after a restart) doesn't push the deadline back
+    if expiry is not None:
+        args = [args[0], key, args[2], b'PXAT', b'%d' % expiry]
+    propagate_command(args)
     
-    print(f"all split commands are: {commands}")
-    return commands 
+    return OK
+
+def incr_command(key, delta, args, from_master = False):
+    if write_refused(0, from_master):
+        return OOM_ERROR
+    value = lookup_string(key)
+    if value is None:
+        value = 0
+    elif not isinstance(value, int):
+        #a string that isn't a canonical integer can't be incremented
+        return NOT_INTEGER_ERROR
+    value += delta
+    if not INT64_MIN <= value <= INT64_MAX:
+        return encode_error("ERR increment or decrement would overflow")
+    set_key(key, value, keepttl = True)
+    propagate_command(args)
+    return encode_integer(value)
+
+def mget_command(args):
+    #one reply for all the keys, built in a single pass
+    values = []
+    for key in args[1:]:
+        value = lookup_key(key)
+        #keys holding other types read as missing, as in Redis
+        if value is None or isinstance(value, COLLECTION_TYPES):
+            values.append(NULL_BULK)
+        else:
+            touch_key(key)
+            values.append(encode_bulk(value_bytes(value)))
+    return encode_array(values)
+
+def mset_command(args, nx, from_master = False):
+    pairs = [(args[i], try_int_encoding(args[i + 1])) for i in range(1, len(args), 2)]
+    if nx and any(lookup_key(key) is not None for key, _ in pairs):
+        return encode_integer(0)
+    if write_refused(sum(entry_size(key, value) for key, value in pairs), from_master):
+        return OOM_ERROR
+    for key, value in pairs:
+        set_key(key, value)
+    #replicas and the AOF get the whole batch as one command
+    propagate_command(args)
+    return encode_integer(1) if nx else OK
+
+def del_command(args, lazy, from_master = False):
+    deleted = 0
+    for key in args[1:]:
+        #the master's DEL is applied as is, our own clock doesn't decide what it removes
+        if from_master or lookup_key(key) is not None:
+            deleted += delete_key(key, lazy)
+    if deleted:
+        propagate_command(args)
+    return encode_integer(deleted)
+
+def parse_score(value):
+    #float() also takes "nan", "1_0" and surrounding spaces, none of which Redis does
+    if b"_" in value or value != value.strip():
+        raise ValueError(value)
+    score = float(value)
+    if score != score:
+        raise ValueError(value)
+    return score
+
+def parse_score_bound(value):
+    #"(1.5" is an exclusive bound
+    if value[:1] == b"(":
+        return parse_score(value[1:]), True
+    return parse_score(value), False
+
+def format_score(score):
+    text = repr(score)
+    return (text[:-2] if text.endswith(".0") else text).encode()
+
+def clamp_range(start, stop, length):
+    #negative indexes count from the end; None when nothing is left
+    if start < 0:
+        start = max(start + length, 0)
+    if stop < 0:
+        stop += length
+    stop = min(stop, length - 1)
+    if start > stop:
+        return None
+    return start, stop
+
+def hash_command(command, args, from_master = False):
+    key = args[1]
+    if command == b'HGET':
+        value = lookup_collection(key, Hash)
+        item = value.get(args[2]) if value is not None else None
+        return NULL_BULK if item is None else encode_bulk(item)
+    elif command == b'HGETALL':
+        value = lookup_collection(key, Hash)
+        if value is None:
+            return encode_array([])
+        return encode_array([encode_bulk(item) for pair in value.items() for item in pair])
+    elif command == b'HLEN':
+        value = lookup_collection(key, Hash)
+        return encode_integer(len(value) if value is not None else 0)
+
+    value = lookup_collection(key, Hash)
+    if command == b'HDEL':
+        if len(args) < 3:
+            return wrong_arity_error(command)
+        if value is None:
+            return encode_integer(0)
+        nbytes = value.nbytes
+        deleted = sum(1 for field in args[2:] if value.delete(field))
+        if deleted:
+            collection_written(key, value, nbytes)
+            propagate_command(args)
+        return encode_integer(deleted)
+
+    if command == b'HSET':
+        if len(args) < 4 or len(args) % 2:
+            return wrong_arity_error(command)
+    elif len(args) != 4:
+        return wrong_arity_error(command)
+    if write_refused(sum(len(arg) for arg in args[2:]), from_master):
+        return OOM_ERROR
+    if value is None:
+        value = Hash()
+    nbytes = value.nbytes
+    if command == b'HSET':
+        added = sum(1 for i in range(2, len(args), 2) if value.set(args[i], args[i + 1]))
+        reply = encode_integer(added)
+    else:
+        try:
+            delta = int(args[3])
+        except ValueError:
+            return NOT_INTEGER_ERROR
+        current = value.get(args[2])
+        number = try_int_encoding(current) if current is not None else 0
+        if not isinstance(number, int):
+            return encode_error("ERR hash value is not an integer")
+        number += delta
+        if not INT64_MIN <= number <= INT64_MAX:
+            return encode_error("ERR increment or decrement would overflow")
+        value.set(args[2], b"%d" % number)
+        reply = encode_integer(number)
+    collection_written(key, value, nbytes)
+    propagate_command(args)
+    return reply
+
+def list_command(command, args, from_master = False):
+    key = args[1]
+    value = lookup_collection(key, List)
+    if command == b'LLEN':
+        return encode_integer(len(value) if value is not None else 0)
+    elif command == b'LRANGE':
+        try:
+            start, stop = int(args[2]), int(args[3])
+        except ValueError:
+            return NOT_INTEGER_ERROR
+        bounds = clamp_range(start, stop, len(value)) if value is not None else None
+        if bounds is None:
+            return encode_array([])
+        return encode_array([encode_bulk(item) for item in value.range(*bounds)])
+    elif command in (b'LPOP', b'RPOP'):
+        count = None
+        if len(args) > 2:
+            try:
+                count = int(args[2])
+            except ValueError:
+                count = -1
+            if count < 0:
+                return encode_error("ERR value is out of range, must be positive")
+        if value is None:
+            #a missing key with a count is a null array, as in Redis
+            return NULL_BULK if count is None else NULL_ARRAY
+        nbytes = value.nbytes
+        popped = value.pop(1 if count is None else count, command == b'LPOP')
+        if popped:
+            collection_written(key, value, nbytes)
+            propagate_command(args)
+        if count is None:
+            return encode_bulk(popped[0])
+        return encode_array([encode_bulk(item) for item in popped])
+
+    #LPUSH, RPUSH
+    if len(args) < 3:
+        return wrong_arity_error(command)
+    if write_refused(sum(len(arg) for arg in args[2:]), from_master):
+        return OOM_ERROR
+    if value is None:
+        value = List()
+    nbytes = value.nbytes
+    value.push(args[2:], command == b'LPUSH')
+    collection_written(key, value, nbytes)
+    propagate_command(args)
+    signal_key_as_ready(key)
+    return encode_integer(len(value))
+
+def list_move(source, destination, wherefrom, whereto):
+    #move one element between the ends of two lists, None when source is empty
+    value = lookup_collection(source, List)
+    lookup_collection(destination, List) #WRONGTYPE before anything is popped
+    if value is None:
+        return None
+    nbytes = value.nbytes
+    item = value.pop(1, wherefrom == b'LEFT')[0]
+    collection_written(source, value, nbytes)
+    #looked up again, source may be destination and may just have been emptied
+    target = lookup_collection(destination, List)
+    if target is None:
+        target = List()
+    nbytes = target.nbytes
+    target.push([item], whereto == b'LEFT')
+    collection_written(destination, target, nbytes)
+    signal_key_as_ready(destination)
+    return item
+
+def parse_move_directions(args):
+    wherefrom, whereto = args[0].upper(), args[1].upper()
+    if wherefrom not in (b'LEFT', b'RIGHT') or whereto not in (b'LEFT', b'RIGHT'):
+        return None
+    return wherefrom, whereto
 
-def process_commands(data, command_processor, *args):
+def lmove_command(args):
+    directions = parse_move_directions(args[3:5])
+    if directions is None:
+        return encode_error("ERR syntax error")
+    item = list_move(args[1], args[2], *directions)
+    if item is None:
+        return NULL_BULK
+    propagate_command([b"LMOVE", args[1], args[2], *directions])
+    return encode_bulk(item)
+
+def blocking_pop_command(conn, command, args):
+    #BLPOP/BRPOP key [key ...] timeout, BLMOVE source destination from to timeout
     try:
-        commands = split_commands(data)
-        responses = []
+        timeout = parse_score(args[-1])
+    except ValueError:
+        return encode_error("ERR timeout is not a float or out of range")
+    if timeout < 0:
+        return encode_error("ERR timeout is negative")
+    if command == b'BLMOVE':
+        directions = parse_move_directions(args[3:5])
+        if directions is None:
+            return encode_error("ERR syntax error")
+        keys = args[1:2]
+        state = dict(destination = args[2], directions = directions)
+    else:
+        keys = args[1:-1]
+        state = dict(left = command == b'BLPOP')
+    for key in keys:
+        lookup_collection(key, List)
+    for key in keys:
+        if lookup_key(key) is not None:
+            return serve_blocked_pop(command, key, state)
+    #the master propagates the pop it served, a blocking command never reaches a replica;
+    #inside a transaction or a script it can't block either
+    if conn.is_master_link or atomic_block["depth"]:
+        return NULL_BULK if command == b'BLMOVE' else NULL_ARRAY
+    block_on_keys(conn, timeout, keys, command = command, **state)
+    return None
+
+def block_on_keys(conn, timeout, keys, **state):
+    #park conn until a write to one of keys serves it, see serve_blocked_clients()
+    block_client(conn, timeout, on_blocked_keys_timeout, unregister_blocked_keys, keys = keys, **state)
+    for key in keys:
+        blocking_keys.setdefault(key, collections.deque()).append(conn)
+
+def serve_blocked_pop(command, key, state):
+    #pop for a blocking command from the non-empty list at key and propagate the
+    #non-blocking equivalent, so replicas and the AOF never block
+    if command == b'BLMOVE':
+        item = list_move(key, state["destination"], *state["directions"])
+        propagate_command([b"LMOVE", key, state["destination"], *state["directions"]])
+        return encode_bulk(item)
+    value = lookup_collection(key, List)
+    nbytes = value.nbytes
+    item = value.pop(1, state["left"])[0]
+    collection_written(key, value, nbytes)
+    propagate_command([b"LPOP" if state["left"] else b"RPOP", key])
+    return encode_array([encode_bulk(key), encode_bulk(item)])
 
-        for command in commands:
-            if not command.endswith(b'\r\n'):
-                print(f"Received RDB file data, length:{len(command)}")
+def signal_key_as_ready(key):
+    if key in blocking_keys and key not in ready_keys:
+        ready_keys.append(key)
+
+def serve_blocked_clients():
+    #after a write, offer the key to the clients blocked on it, longest waiting first;
+    #a pop ends once the list is gone, every XREAD waiting for newer entries is served
+    while ready_keys:
+        key = ready_keys.pop(0)
+        for conn in list(blocking_keys.get(key, ())):
+            if lookup_key(key) is None:
+                break
+            state = conn.blocked
+            #an earlier client's pipelined commands may have changed things
+            if state is None or key not in state["keys"]:
                 continue
-            decoded_command = command.decode('utf-8').strip()
-            parts = decoded_command.split('\r\n')
-            if parts:
-                response = command_processor(parts, *args)
-                if response is not None:
-                    responses.append(response)
-        return responses if responses else '$-1\r\n'
-    except UnicodeDecodeError:
-        print(f"Received non-UTF-8 data (perhaps empty RDB file), unable to process. Data: {data}")
-        return ['$-1\r\n']
-    except Exception as e:
-        print(f"Error processing commands: {e}")
-        return ['$-1\r\n']
-
-def process_single_command(parts, is_master, client_socket):
-    command = parts[2].upper() 
-
-    if command == 'SET':
-        key = parts[4]
-        value = parts[6]
-        return set_command(key, value, parts)
-    elif command == 'GET':
-        key = parts[4]
-        return get_command(key)
-    elif command == 'ECHO':
-        message = parts[4]
-        return f"${len(message)}\r\n{message}\r\n"
-    elif command == 'INFO':
-        section = parts[4] if len(parts) > 4 else ""
-        return info_command(section, is_master)
-    elif command == "REPLCONF": 
-        return handle_replconf(parts, client_socket)
-    elif command == "PSYNC":
-        return handle_psync()
+            try:
+                if state["command"] == b'XREAD':
+                    reply = xread_reply(state["streams"], state["count"], [key])
+                else:
+                    reply = serve_blocked_pop(state["command"], key, state)
+            except WrongTypeError:
+                reply = WRONGTYPE_ERROR
+            if reply is None:
+                continue
+            unregister_blocked_keys(conn)
+            conn.woff = replication["offset"]
+            unblock_client(conn, reply)
+
+def unregister_blocked_keys(conn):
+    for key in conn.blocked["keys"]:
+        waiters = blocking_keys[key]
+        waiters.remove(conn)
+        if not waiters:
+            del blocking_keys[key]
+
+def on_blocked_keys_timeout(conn):
+    command = conn.blocked["command"]
+    unregister_blocked_keys(conn)
+    unblock_client(conn, NULL_BULK if command == b'BLMOVE' else NULL_ARRAY)
+
+def settype_command(command, args, from_master = False):
+    key = args[1]
+    value = lookup_collection(key, Set)
+    if command == b'SISMEMBER':
+        return encode_integer(1 if value is not None and args[2] in value else 0)
+    elif command == b'SMEMBERS':
+        return encode_array([encode_bulk(member) for member in value] if value is not None else [])
+    elif command == b'SCARD':
+        return encode_integer(len(value) if value is not None else 0)
+
+    if len(args) < 3:
+        return wrong_arity_error(command)
+    if command == b'SREM':
+        if value is None:
+            return encode_integer(0)
+        nbytes = value.nbytes
+        changed = sum(1 for member in args[2:] if value.remove(member))
     else:
-        return '+PONG\r\n'
-
-def process_master_single_command(parts):
-    command = parts[2].upper() 
-    if command == 'SET':
-        key = parts[4]
-        value = parts[6]
-        set_command(key, value, parts)
-        return None
-    elif command == "REPLCONF":
-        return handle_replconf(parts, None)
+        if write_refused(sum(len(arg) for arg in args[2:]), from_master):
+            return OOM_ERROR
+        if value is None:
+            value = Set()
+        nbytes = value.nbytes
+        changed = sum(1 for member in args[2:] if value.add(member))
+    if changed:
+        collection_written(key, value, nbytes)
+        propagate_command(args)
+    return encode_integer(changed)
+
+def zset_command(command, args, from_master = False):
+    key = args[1]
+    value = lookup_collection(key, ZSet)
+    if command == b'ZSCORE':
+        score = value.score(args[2]) if value is not None else None
+        return NULL_BULK if score is None else encode_bulk(format_score(score))
+    elif command == b'ZRANK':
+        rank = value.rank(args[2]) if value is not None else None
+        return NULL_BULK if rank is None else encode_integer(rank)
+    elif command == b'ZCARD':
+        return encode_integer(len(value) if value is not None else 0)
+    elif command == b'ZRANGE':
+        if len(args) not in (4, 5) or (len(args) == 5 and args[4].upper() != b'WITHSCORES'):
+            return encode_error("ERR syntax error")
+        try:
+            start, stop = int(args[2]), int(args[3])
+        except ValueError:
+            return NOT_INTEGER_ERROR
+        bounds = clamp_range(start, stop, len(value)) if value is not None else None
+        entries = value.range_by_rank(*bounds) if bounds is not None else []
+        return zset_reply(entries, len(args) == 5)
+    elif command == b'ZRANGEBYSCORE':
+        try:
+            low, low_exclusive = parse_score_bound(args[2])
+            high, high_exclusive = parse_score_bound(args[3])
+        except ValueError:
+            return encode_error("ERR min or max is not a float")
+        withscores = False
+        offset, count = 0, -1
+        i = 4
+        while i < len(args):
+            option = args[i].upper()
+            if option == b'WITHSCORES':
+                withscores = True
+                i += 1
+            elif option == b'LIMIT' and i + 2 < len(args):
+                try:
+                    offset, count = int(args[i + 1]), int(args[i + 2])
+                except ValueError:
+                    return NOT_INTEGER_ERROR
+                i += 3
+            else:
+                return encode_error("ERR syntax error")
+        if value is None or offset < 0:
+            return encode_array([])
+        return zset_reply(value.range_by_score(low, low_exclusive, high, high_exclusive, offset, count), withscores)
+    elif command == b'ZREM':
+        if len(args) < 3:
+            return wrong_arity_error(command)
+        if value is None:
+            return encode_integer(0)
+        nbytes = value.nbytes
+        removed = sum(1 for member in args[2:] if value.remove(member))
+        if removed:
+            collection_written(key, value, nbytes)
+            propagate_command(args)
+        return encode_integer(removed)
+
+    #ZADD key [NX|XX] [GT|LT] [CH] score member [score member ...]
+    flags = set()
+    i = 2
+    while i < len(args) and args[i].upper() in (b'NX', b'XX', b'GT', b'LT', b'CH'):
+        flags.add(args[i].upper())
+        i += 1
+    if i >= len(args) or (len(args) - i) % 2:
+        return encode_error("ERR syntax error")
+    if (b'NX' in flags and b'XX' in flags) or (b'NX' in flags and (b'GT' in flags or b'LT' in flags)) \
+            or (b'GT' in flags and b'LT' in flags):
+        return encode_error("ERR GT, LT, and/or NX options at the same time are not compatible")
+    try:
+        pairs = [(args[j + 1], parse_score(args[j])) for j in range(i, len(args), 2)]
+    except ValueError:
+        return NOT_FLOAT_ERROR
+    if write_refused(sum(len(member) + 8 for member, _ in pairs), from_master):
+        return OOM_ERROR
+    if value is None:
+        if b'XX' in flags:
+            return encode_integer(0)
+        value = ZSet()
+    nbytes = value.nbytes
+    added = changed = 0
+    for member, score in pairs:
+        old = value.score(member)
+        if old is None:
+            if b'XX' in flags:
+                continue
+        elif b'NX' in flags or (b'GT' in flags and score <= old) or (b'LT' in flags and score >= old):
+            continue
+        value.add(member, score)
+        if old is None:
+            added += 1
+        elif old != score:
+            changed += 1
+    if added or changed:
+        collection_written(key, value, nbytes)
+        propagate_command(args)
+    return encode_integer(added + changed if b'CH' in flags else added)
+
+def zset_reply(entries, withscores):
+    items = []
+    for score, member in entries:
+        items.append(encode_bulk(member))
+        if withscores:
+            items.append(encode_bulk(format_score(score)))
+    return encode_array(items)
+
+def parse_stream_id(value, seq = 0):
+    #ms-seq, or ms alone taking seq; - and + are the smallest and largest IDs
+    if value == b"-":
+        return 0
+    if value == b"+":
+        return STREAM_ID_MAX
+    ms, dash, rest = value.partition(b"-")
+    if not ms.isdigit() or (dash and not rest.isdigit()):
+        raise ValueError(value)
+    ms = int(ms)
+    if dash:
+        seq = int(rest)
+    if ms > STREAM_SEQ_MASK or seq > STREAM_SEQ_MASK:
+        raise ValueError(value)
+    return stream_id(ms, seq)
+
+def parse_range_bound(value, start):
+    #"(id" excludes id itself (Redis 6.2); a bare ms covers every seq of that millisecond
+    exclusive = value[:1] == b"("
+    if exclusive:
+        value = value[1:]
+        if value in (b"-", b"+"):
+            raise ValueError(value)
+    sid = parse_stream_id(value, 0 if start else STREAM_SEQ_MASK)
+    if exclusive:
+        sid += 1 if start else -1
+        if not 0 <= sid <= STREAM_ID_MAX:
+            raise ValueError(value)
+    return sid
+
+def encode_stream_entries(entries):
+    return encode_array([encode_array([encode_bulk(format_stream_id(sid)),
+                                       encode_array([encode_bulk(item) for item in fields])])
+                         for sid, fields in entries])
+
+def parse_maxlen(args, i):
+    #MAXLEN [=|~] threshold at args[i]; returns (maxlen, approximate, index after it)
+    approx = False
+    if args[i + 1] in (b"=", b"~"):
+        approx = args[i + 1] == b"~"
+        i += 1
+    maxlen = int(args[i + 1])
+    if maxlen < 0:
+        raise ValueError(maxlen)
+    return maxlen, approx, i + 2
+
+def stream_command(command, args, from_master = False):
+    key = args[1]
+    value = lookup_collection(key, Stream)
+    if command == b'XLEN':
+        return encode_integer(len(value) if value is not None else 0)
+    elif command in (b'XRANGE', b'XREVRANGE'):
+        reverse = command == b'XREVRANGE'
+        if len(args) not in (4, 6) or (len(args) == 6 and args[4].upper() != b'COUNT'):
+            return encode_error("ERR syntax error")
+        try:
+            start = parse_range_bound(args[3 if reverse else 2], True)
+            end = parse_range_bound(args[2 if reverse else 3], False)
+        except ValueError:
+            return INVALID_STREAM_ID_ERROR
+        try:
+            count = int(args[5]) if len(args) == 6 else -1
+        except ValueError:
+            return NOT_INTEGER_ERROR
+        if value is None or count == 0 or start > end:
+            return encode_array([])
+        return encode_stream_entries(value.range(start, end, max(count, -1), reverse))
+    elif command == b'XTRIM':
+        if len(args) < 4 or args[2].upper() != b'MAXLEN':
+            return encode_error("ERR syntax error")
+        try:
+            maxlen, approx, end = parse_maxlen(args, 2)
+        except (ValueError, IndexError):
+            return NOT_INTEGER_ERROR
+        if end != len(args):
+            return encode_error("ERR syntax error")
+        if value is None:
+            return encode_integer(0)
+        nbytes = value.nbytes
+        removed = value.trim(maxlen, approx)
+        if removed:
+            collection_written(key, value, nbytes)
+            #replicas trim exactly what we trimmed, not their own approximation
+            propagate_command([b"XTRIM", key, b"MAXLEN", b"=", b"%d" % len(value)])
+        return encode_integer(removed)
+    elif command == b'XSETID':
+        #XSETID key last-id [ENTRIESADDED n] [MAXDELETEDID id], what AOF rewrites end a stream with
+        if len(args) not in (3, 5, 7):
+            return encode_error("ERR syntax error")
+        try:
+            last_id = parse_stream_id(args[2])
+            options = {args[i].upper(): args[i + 1] for i in range(3, len(args), 2)}
+            entries_added = int(options.pop(b"ENTRIESADDED", -1))
+            max_deleted_id = parse_stream_id(options.pop(b"MAXDELETEDID", b"0-0"))
+        except ValueError:
+            return INVALID_STREAM_ID_ERROR
+        if options:
+            return encode_error("ERR syntax error")
+        if value is None:
+            return encode_error("ERR no such key")
+        if len(value) and last_id < value.last_id:
+            return encode_error("ERR The ID specified in XSETID is smaller than the target stream top item")
+        max_deleted_id = max(value.max_deleted_id, max_deleted_id)
+        if last_id < max_deleted_id:
+            return encode_error("ERR The ID specified in XSETID is smaller than current max_deleted_entry_id")
+        value.last_id = last_id
+        if entries_added >= 0:
+            value.entries_added = entries_added
+        value.max_deleted_id = max_deleted_id
+        persistence["dirty"] += 1
+        propagate_command(args)
+        return OK
+
+    #XADD key [NOMKSTREAM] [MAXLEN [=|~] threshold] <* | ms-* | ms-seq> field value [field value ...]
+    i = 2
+    nomkstream = False
+    maxlen = None
+    try:
+        while args[i].upper() in (b'NOMKSTREAM', b'MAXLEN'):
+            if args[i].upper() == b'NOMKSTREAM':
+                nomkstream = True
+                i += 1
+            else:
+                maxlen, approx, i = parse_maxlen(args, i)
+    except ValueError:
+        return NOT_INTEGER_ERROR
+    fields = args[i + 1:]
+    if not fields or len(fields) % 2:
+        return wrong_arity_error(command)
+    if value is None and nomkstream:
+        return NULL_BULK
+    last_id = value.last_id if value is not None else 0
+    try:
+        if args[i] == b"*":
+            ms = max(mstime(), last_id >> 64)
+            sid = stream_id(ms, (last_id & STREAM_SEQ_MASK) + 1 if ms == last_id >> 64 else 0)
+        elif args[i].endswith(b"-*"):
+            ms = parse_stream_id(args[i][:-2]) >> 64
+            sid = stream_id(ms, (last_id & STREAM_SEQ_MASK) + 1 if ms == last_id >> 64 else 0)
+        else:
+            sid = parse_stream_id(args[i])
+            if sid == 0:
+                return encode_error("ERR The ID specified in XADD must be greater than 0-0")
+    except ValueError:
+        return INVALID_STREAM_ID_ERROR
+    if sid <= last_id or sid > STREAM_ID_MAX:
+        return encode_error("ERR The ID specified in XADD is equal or smaller than the target stream top item")
+    if write_refused(sum(len(arg) for arg in fields), from_master):
+        return OOM_ERROR
+    if value is None:
+        value = Stream()
+    nbytes = value.nbytes
+    value.append(sid, fields)
+    if maxlen is not None:
+        value.trim(maxlen, approx)
+    collection_written(key, value, nbytes)
+    #the generated ID and the length actually trimmed to go to replicas and the AOF
+    propagated = [b"XADD", key]
+    if maxlen is not None:
+        propagated += [b"MAXLEN", b"=", b"%d" % len(value)]
+    propagate_command(propagated + [format_stream_id(sid)] + fields)
+    signal_key_as_ready(key)
+    return encode_bulk(format_stream_id(sid))
+
+def parse_xread(args):
+    #XREAD [COUNT n] [BLOCK ms] STREAMS key [key ...] id [id ...]
+    count, block = -1, None
+    i = 1
+    while i < len(args) and args[i].upper() != b'STREAMS':
+        option = args[i].upper()
+        if option not in (b'COUNT', b'BLOCK') or i + 1 >= len(args):
+            raise SyntaxError()
+        if option == b'COUNT':
+            count = max(int(args[i + 1]), -1)
+        else:
+            block = int(args[i + 1])
+        i += 2
+    streams = args[i + 1:]
+    if i >= len(args) or not streams:
+        raise SyntaxError()
+    if len(streams) % 2:
+        raise IndexError()
+    half = len(streams) // 2
+    return count, block, streams[:half], streams[half:]
+
+def xread_command(conn, args):
+    try:
+        count, block, keys, ids = parse_xread(args)
+    except SyntaxError:
+        return encode_error("ERR syntax error")
+    except IndexError:
+        return encode_error("ERR Unbalanced 'xread' list of streams: for each stream key an ID or '$' must be specified.")
+    except ValueError:
+        return NOT_INTEGER_ERROR
+    if block is not None and block < 0:
+        return encode_error("ERR timeout is negative")
+    streams = {}
+    for key, sid in zip(keys, ids):
+        value = lookup_collection(key, Stream)
+        if sid == b"$":
+            #only entries added from now on
+            streams[key] = value.last_id if value is not None else 0
+            continue
+        try:
+            streams[key] = parse_stream_id(sid)
+        except ValueError:
+            return INVALID_STREAM_ID_ERROR
+    reply = xread_reply(streams, count, keys)
+    if reply is not None or block is None or conn.is_master_link or atomic_block["depth"]:
+        return reply if reply is not None else NULL_ARRAY
+    block_on_keys(conn, block / 1000, list(streams), command = b'XREAD', streams = streams, count = count)
+    return None
+
+def xread_reply(streams, count, keys):
+    #entries after each stream's ID, None when there are none in any of keys
+    replies = []
+    for key in keys:
+        value = lookup_collection(key, Stream)
+        if value is None or value.last_id <= streams[key]:
+            continue
+        entries = value.range(streams[key] + 1, STREAM_ID_MAX, count)
+        if entries:
+            replies.append(encode_array([encode_bulk(key), encode_stream_entries(entries)]))
+    return encode_array(replies) if replies else None
+
+def type_name(value):
+    return value.type_name if isinstance(value, COLLECTION_TYPES) else "string"
+
+def type_command(key):
+    value = lookup_key(key)
+    if value is None:
+        return b"+none\r\n"
+    return b"+%s\r\n" % type_name(value).encode()
+
+def filter_keys(keys, regex, kind):
+    #the keys that match the pattern and type; expired ones are skipped, and deleted on a master
+    found = []
+    now = mstime()
+    for key in keys:
+        if regex is not None and not regex.fullmatch(key):
+            continue
+        expiry = expires.get(key)
+        if expiry is not None and expiry < now:
+            if replication["master_host"] is None:
+                expire_key(key)
+            continue
+        if kind is not None and type_name(database[key]) != kind:
+            continue
+        found.append(key)
+    return found
+
+def scan_command(args):
+    try:
+        cursor = int(args[1])
+    except ValueError:
+        return encode_error("ERR invalid cursor")
+    if not 0 <= cursor < BUCKET_COUNT:
+        return encode_error("ERR invalid cursor")
+    regex = kind = None
+    count = 10
+    i = 2
+    while i < len(args):
+        option = args[i].upper()
+        if i + 1 >= len(args):
+            return encode_error("ERR syntax error")
+        if option == b"MATCH":
+            regex = None if args[i + 1] == b"*" else glob_to_regex(args[i + 1])
+        elif option == b"COUNT":
+            try:
+                count = int(args[i + 1])
+            except ValueError:
+                return NOT_INTEGER_ERROR
+            if count < 1:
+                return encode_error("ERR syntax error")
+        elif option == b"TYPE":
+            kind = args[i + 1].decode(errors = "replace").lower()
+        else:
+            return encode_error("ERR syntax error")
+        i += 2
+    cursor, keys = database.scan(cursor, count)
+    keys = filter_keys(keys, regex, kind)
+    return encode_array([encode_bulk(b"%d" % cursor), encode_array([encode_bulk(key) for key in keys])])
+
+def keys_command(conn, pattern):
+    #a big keyspace is walked in steps between events with the client blocked
+    walk = dict(cursor = 0, found = [], regex = None if pattern == b"*" else glob_to_regex(pattern))
+    while not keys_step(walk):
+        #the master never sends KEYS, so conn can't be the master link; a transaction
+        #or a script can't let other clients in, it walks to the end in one go
+        if not atomic_block["depth"]:
+            block_client(conn, 0, None, cancel_keys_walk, step = timers.call_later(0, keys_cycle, conn), **walk)
+            return None
+    return encode_array(walk["found"])
+
+def keys_step(walk):
+    #advance the walk by up to KEYS_CYCLE_BUDGET, True once it is complete; keys are
+    #encoded as they are found so the reply isn't built in one go at the end
+    deadline = time.perf_counter() + KEYS_CYCLE_BUDGET
+    while True:
+        walk["cursor"], keys = database.scan(walk["cursor"], KEYS_STEP_COUNT)
+        walk["found"] += map(encode_bulk, filter_keys(keys, walk["regex"], None))
+        if not walk["cursor"]:
+            return True
+        if time.perf_counter() >= deadline:
+            return False
+
+def keys_cycle(conn):
+    walk = conn.blocked
+    if keys_step(walk):
+        unblock_client(conn, encode_array(walk["found"]))
+    else:
+        walk["step"] = timers.call_later(0, keys_cycle, conn)
+
+def cancel_keys_walk(conn):
+    timers.cancel(conn.blocked["step"])
+
+def flushall_command(args):
+    #ASYNC hands the old keyspace to the lazy free cycle
+    lazy = False
+    if len(args) > 2:
+        return encode_error("ERR syntax error")
+    if len(args) == 2:
+        mode = args[1].upper()
+        if mode not in (b"ASYNC", b"SYNC"):
+            return encode_error("ERR syntax error")
+        lazy = mode == b"ASYNC"
+    persistence["dirty"] += len(database)
+    empty_database(lazy)
+    propagate_command(args)
+    return OK
+
+def object_command(args):
+    if args[1].upper() != b'ENCODING' or len(args) != 3:
+        return encode_error("ERR syntax error")
+    value = lookup_key(args[2])
+    if value is None:
+        return NULL_BULK
+    if isinstance(value, COLLECTION_TYPES):
+        encoding = value.encoding.encode()
+    elif isinstance(value, int):
+        encoding = b"int"
     else:
+        encoding = b"embstr" if len(value) <= 44 else b"raw"
+    return encode_bulk(encoding)
+
+def pexpireat_command(key, args, from_master = False):
+    try:
+        expiry = int(args[2])
+    except ValueError:
+        return NOT_INTEGER_ERROR
+    if not INT64_MIN <= expiry <= INT64_MAX:
+        return encode_error("ERR invalid expire time in 'pexpireat' command")
+    if lookup_key(key) is None:
+        return encode_integer(0)
+    if expiry <= mstime() and not from_master:
+        #a deadline already passed deletes the key right away, replicas get the DEL
+        delete_key(key)
+        propagate_command([b"DEL", key])
+        return encode_integer(1)
+    set_expiry(key, expiry)
+    persistence["dirty"] += 1
+    signal_modified_key(key)
+    propagate_command(args)
+    return encode_integer(1)
+
+def mstime():
+    return int(time.time() * 1000)
+
+def value_bytes(value):
+    return b"%d" % value if isinstance(value, int) else value
+
+def entry_size(key, value):
+    size = sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+    if isinstance(value, COLLECTION_TYPES):
+        size += value.nbytes
+    return size
+
+def set_key(key, value, expiry = None, keepttl = False):
+    global used_memory
+    old = database.get(key)
+    if old is not None:
+        used_memory -= entry_size(key, old)
+    database[key] = value
+    used_memory += entry_size(key, value)
+    persistence["dirty"] += 1
+    touch_key(key)
+    signal_modified_key(key)
+    if not keepttl:
+        set_expiry(key, expiry)
+
+def set_expiry(key, expiry):
+    #replace the key's expiry, None makes it persistent
+    global used_memory
+    if key in expires:
+        del expires[key]
+        used_memory -= EXPIRY_OVERHEAD
+    if expiry is not None:
+        expires[key] = expiry
+        used_memory += EXPIRY_OVERHEAD
+        heapq.heappush(expiry_index, (expiry, key))
+        #keys that are overwritten or deleted leave stale entries behind, rebuild
+        #the index once they dominate it
+        if len(expiry_index) > 2 * len(expires) + 1024:
+            rebuild_expiry_index()
+
+def rebuild_expiry_index():
+    expiry_index[:] = [(expiry, key) for key, expiry in expires.items()]
+    heapq.heapify(expiry_index)
+
+def delete_key(key, lazy = False):
+    global used_memory
+    value = database.pop(key)
+    if value is None:
+        return False
+    used_memory -= entry_size(key, value)
+    persistence["dirty"] += 1
+    signal_modified_key(key)
+    if expires.pop(key, None) is not None:
+        used_memory -= EXPIRY_OVERHEAD
+    key_access.pop(key, None)
+    if lazy and free_effort(value) > LAZYFREE_THRESHOLD:
+        lazy_free(value)
+    return True
+
+def free_effort(value):
+    #roughly how many objects freeing value releases, as Redis estimates it
+    if isinstance(value, COLLECTION_TYPES):
+        return len(value)
+    return 1
+
+def lazy_free(value):
+    lazyfree["queue"].append(value)
+    if not lazyfree["scheduled"]:
+        lazyfree["scheduled"] = True
+        timers.call_later(0, lazyfree_cycle)
+
+def dismantle(value, count):
+    #drop up to count elements of value, True once it is empty; the plain containers
+    #come from a lazy FLUSHALL, everything else has its own dismantle()
+    if type(value) is dict:
+        for _ in range(min(count, len(value))):
+            value.popitem()
+        return not value
+    if type(value) is list:
+        del value[-count:]
+        return not value
+    return value.dismantle(count)
+
+def lazyfree_cycle():
+    #a thread wouldn't help as the GIL frees a container in one go, short steps between events do
+    queue = lazyfree["queue"]
+    deadline = time.perf_counter() + LAZYFREE_CYCLE_BUDGET
+    while queue and time.perf_counter() < deadline:
+        if dismantle(queue[0], LAZYFREE_CHUNK):
+            queue.popleft()
+            stats["lazyfreed_objects"] += 1
+    if queue:
+        timers.call_later(0, lazyfree_cycle)
+    else:
+        lazyfree["scheduled"] = False
+
+def write_refused(incoming, from_master):
+    #make room before a write; a replica mirrors its master and never evicts
+    return bool(config["maxmemory"]) and not from_master and not evict_to_fit(incoming)
+
+def lookup_string(key):
+    value = lookup_key(key)
+    if value is not None and isinstance(value, COLLECTION_TYPES):
+        raise WrongTypeError()
+    return value
+
+def lookup_collection(key, kind):
+    value = lookup_key(key)
+    if value is not None and type(value) is not kind:
+        raise WrongTypeError()
+    return value
+
+def collection_written(key, value, nbytes_before):
+    #account for a collection a command changed: store it if it is new, drop it once
+    #empty; an empty stream still remembers its last ID, so it stays
+    global used_memory
+    emptied = not len(value) and not isinstance(value, Stream)
+    if key not in database:
+        if not emptied:
+            set_key(key, value)
+        return
+    used_memory += value.nbytes - nbytes_before
+    persistence["dirty"] += 1
+    touch_key(key)
+    signal_modified_key(key)
+    if emptied:
+        delete_key(key)
+
+def lookup_key(key):
+    #the live value of key or None; a key found past its expiry is deleted on the spot
+    value = database.get(key)
+    if value is not None and key in expires and expires[key] < mstime():
+        if replication["master_host"] is None:
+            expire_key(key)
+        elif replication["applying_master_stream"]:
+            #the master had the key when it sent the command, its DEL comes later
+            return value
+        #a replica only hides the key, the DEL from its master deletes it
         return None
+    return value
 
-def process_command(data, is_master, client_socket):
-    return process_commands(data, process_single_command, is_master, client_socket)
+def expire_key(key):
+    #expired keys are deleted on replicas through the DEL the master propagates
+    delete_key(key)
+    stats["expired_keys"] += 1
+    propagate_command([b"DEL", key])
 
-def process_master_command(data):
-    return process_commands(data, process_master_single_command)
+def touch_key(key):
+    #record an access for the lru/lfu policies, other policies don't pay for it
+    policy = config["maxmemory-policy"]
+    if policy == "allkeys-lru":
+        key_access[key] = int(time.monotonic() * 1000)
+    elif policy == "allkeys-lfu":
+        packed = key_access.get(key)
+        counter = LFU_INIT_VAL if packed is None else lfu_log_incr(lfu_decayed_counter(packed))
+        key_access[key] = (int(time.monotonic() // 60) << 8) | counter
 
-def set_command(key, value, parts):
-    expiry = None
+def lfu_decayed_counter(packed):
+    #packed LFU data is (minutes of last access << 8) | logarithmic counter, as in Redis
+    counter = packed & 0xFF
+    if config["lfu-decay-time"]:
+        periods = (int(time.monotonic() // 60) - (packed >> 8)) // config["lfu-decay-time"]
+        counter = max(0, counter - periods)
+    return counter
 
-    if len(parts) > 8 and parts[8].upper() == 'PX':
-        try:
-            expiry = time.time() + (int(parts[10]) / 1000) #convert ms to s
-        except (IndexError, ValueError):
-            return '-ERR invalid expires time in set\r\n'
-    
-    database[key] = (value, expiry)
+def lfu_log_incr(counter):
+    if counter == 255:
+        return counter
+    base = max(0, counter - LFU_INIT_VAL)
+    if random.random() < 1.0 / (base * config["lfu-log-factor"] + 1):
+        counter += 1
+    return counter
 
-    #propagate command to replica
-    propagate_command("\r\n".join(parts) + "\r\n")
-    
-    return '+OK\r\n'
+def eviction_score(key):
+    #higher means a better candidate
+    packed = key_access.get(key)
+    if config["maxmemory-policy"] == "allkeys-lru":
+        return int(time.monotonic() * 1000) - (packed or 0)
+    return 255 - (LFU_INIT_VAL if packed is None else lfu_decayed_counter(packed))
 
-def get_command(key):
-    if is_expired(key):
+def next_eviction_candidate():
+    policy = config["maxmemory-policy"]
+    if policy == "volatile-ttl":
+        #the expiry index already orders volatile keys by ttl, no sampling needed
+        while expiry_index:
+            expiry, key = heapq.heappop(expiry_index)
+            if expires.get(key) == expiry:
+                return key
+        return None
+
+    #approximate lru/lfu like Redis: sample a few random keys and keep the best
+    #candidates seen so far in a small pool that survives between evictions
+    pooled = {key for _, key in eviction_pool}
+    for key in database.random_keys(config["maxmemory-samples"]):
+        if key not in pooled:
+            eviction_pool.append((eviction_score(key), key))
+    eviction_pool.sort()
+    del eviction_pool[:-EVICTION_POOL_SIZE]
+    while eviction_pool:
+        _, key = eviction_pool.pop()
         if key in database:
-            del database[key] 
-        return '$-1\r\n' 
-    
-    value, _ = database.get(key, (None, None))
+            return key
+    return None
+
+def evict_to_fit(incoming):
+    #returns False when the write has to be refused
+    while used_memory + incoming > config["maxmemory"]:
+        if config["maxmemory-policy"] == "noeviction":
+            return False
+        key = next_eviction_candidate()
+        if key is None:
+            return False
+        delete_key(key)
+        stats["evicted_keys"] += 1
+        propagate_command([b"DEL", key])
+    return True
+
+def active_expire_cycle():
+    #evict keys whose expiry passed even if nobody reads them again, within a time budget
+    start = time.perf_counter()
+    deadline = start + ACTIVE_EXPIRE_CYCLE_BUDGET
+    now = mstime()
+    checked = 0
+    #a replica leaves expiring to its master
+    is_master = replication["master_host"] is None
+    while is_master and expiry_index and expiry_index[0][0] < now:
+        expiry, key = heapq.heappop(expiry_index)
+        if expires.get(key) == expiry:
+            expire_key(key)
+        checked += 1
+        if checked % 16 == 0 and time.perf_counter() > deadline:
+            stats["expired_time_cap_reached_count"] += 1
+            break
+    elapsed = time.perf_counter() - start
+    stats["expire_cycle_cpu_milliseconds"] += elapsed * 1000
+    stats["expire_cycle_last_cpu_usec"] = int(elapsed * 1000000)
+    timers.call_later(ACTIVE_EXPIRE_CYCLE_PERIOD, active_expire_cycle)
+
+def get_command(key):
+    value = lookup_string(key)
 
     if value is None:
-        return '$-1\r\n'  
+        return NULL_BULK
     else:
-        return f"${len(value)}\r\n{value}\r\n"
+        touch_key(key)
+        return encode_bulk(value_bytes(value))
 
-def is_expired(key):
-    if key not in database:
-        return True
-    _, expiry = database[key]
+def info_replication(is_master):
+    lines = [f"role:{'master' if is_master else 'slave'}"]
+    if not is_master:
+        lines += [
+            f"master_host:{replication['master_host']}",
+            f"master_port:{replication['master_port']}",
+            f"master_link_status:{'up' if replication['master_link'] is not None else 'down'}",
+            f"master_last_io_seconds_ago:{int(replica_lag()) if replication['master_link'] is not None else -1}",
+        ]
+        if replication["master_link"] is None and replication["master_last_io"] is not None:
+            lines.append(f"master_link_down_since_seconds:{int(replica_lag())}")
+        lines += [
+            f"slave_repl_offset:{replication['offset']}",
+            f"slave_read_only:{1 if config['replica-read-only'] == 'yes' else 0}",
+            f"replica_max_lag:{config['replica-max-lag']}",
+            f"replica_serving_reads:{0 if replica_refusal(b'GET') else 1}",
+        ]
+    lines.append(f"connected_slaves:{len(replicas)}")
+    now = time.monotonic()
+    for i, replica in enumerate(replicas):
+        #lag is the time since the replica's last ACK, which it sends every second
+        lag = int(now - replica.repl_ack_time) if replica.repl_ack_time else -1
+        lines.append(f"slave{i}:ip={replica.addr[0]},port={replica.addr[1]},state={replica.repl_state},"
+                     f"offset={replica.repl_ack_offset},lag={lag}")
+    backlog = replication["backlog"]
+    lines += [
+        f"master_replid:{replication['replid']}",
+        f"master_repl_offset:{replication['offset']}",
+        f"repl_backlog_active:{1 if backlog else 0}",
+        f"repl_backlog_size:{config['repl-backlog-size']}",
+        f"repl_backlog_first_byte_offset:{backlog.start_offset + 1 if backlog else 0}",
+        f"repl_backlog_histlen:{backlog.histlen if backlog else 0}",
+    ]
+    return lines
 
-    if expiry is None:
-        return False
-    
-    return time.time() > expiry
+def info_memory(is_master):
+    return [
+        f"used_memory:{used_memory}",
+        f"used_memory_human:{used_memory / (1024 * 1024):.2f}M",
+        f"maxmemory:{config['maxmemory']}",
+        f"maxmemory_human:{config['maxmemory'] / (1024 * 1024):.2f}M",
+        f"maxmemory_policy:{config['maxmemory-policy']}",
+        f"lazyfree_pending_objects:{len(lazyfree['queue'])}",
+    ]
+
+def info_persistence(is_master):
+    child = background_child
+    return [
+        f"rdb_changes_since_last_save:{persistence['dirty']}",
+        f"rdb_bgsave_in_progress:{1 if child else 0}",
+        f"rdb_last_save_time:{persistence['lastsave']}",
+        f"rdb_last_bgsave_status:{persistence['last_bgsave_status']}",
+        f"rdb_last_bgsave_time_sec:{persistence['last_bgsave_time_sec']}",
+        f"rdb_current_bgsave_time_sec:{int(time.time() - child['started']) if child else -1}",
+        f"aof_enabled:{1 if aof_state['fd'] is not None else 0}",
+        f"aof_rewrite_in_progress:{1 if aof_state['rewrite_buf'] is not None else 0}",
+        f"aof_rewrite_scheduled:{1 if aof_state['rewrite_scheduled'] else 0}",
+        f"aof_last_bgrewrite_status:{aof_state['last_bgrewrite_status']}",
+        f"aof_last_write_status:{aof_state['last_write_status']}",
+    ] + ([
+        f"aof_current_size:{aof_state['base_size'] + aof_state['written'] - aof_state['base_offset']}",
+        f"aof_base_size:{aof_state['base_size']}",
+        f"aof_buffer_length:{len(aof_state['buf'])}",
+    ] if aof_state["fd"] is not None else [])
+
+def info_clients(is_master):
+    return [
+        f"connected_clients:{len(clients) - len(replicas)}",
+        #a client popping several keys waits under each of them
+        f"blocked_clients:{len(waiting_acks) + len(set(itertools.chain(*blocking_keys.values())))}",
+        f"total_blocking_keys:{len(blocking_keys)}",
+        f"tracking_clients:{sum(1 for conn in clients if conn.tracking is not None)}",
+    ]
+
+def info_stats(is_master):
+    return [
+        f"total_connections_received:{stats['total_connections_received']}",
+        f"total_commands_processed:{stats['total_commands_processed']}",
+        f"instantaneous_ops_per_sec:{int(instantaneous_metrics['total_commands_processed'].rate())}",
+        f"total_net_input_bytes:{stats['total_net_input_bytes']}",
+        f"total_net_output_bytes:{stats['total_net_output_bytes']}",
+        f"total_net_repl_input_bytes:{stats['total_net_repl_input_bytes']}",
+        f"total_net_repl_output_bytes:{stats['total_net_repl_output_bytes']}",
+        f"instantaneous_input_kbps:{instantaneous_metrics['total_net_input_bytes'].rate() / 1024:.2f}",
+        f"instantaneous_output_kbps:{instantaneous_metrics['total_net_output_bytes'].rate() / 1024:.2f}",
+        f"rejected_calls:{stats['rejected_calls']}",
+        f"expired_keys:{stats['expired_keys']}",
+        f"expired_time_cap_reached_count:{stats['expired_time_cap_reached_count']}",
+        f"expire_cycle_cpu_milliseconds:{int(stats['expire_cycle_cpu_milliseconds'])}",
+        f"expire_cycle_last_cpu_usec:{stats['expire_cycle_last_cpu_usec']}",
+        f"evicted_keys:{stats['evicted_keys']}",
+        f"lazyfreed_objects:{stats['lazyfreed_objects']}",
+        f"tracking_total_keys:{len(tracking_table)}",
+        f"tracking_total_prefixes:{len(tracking_prefixes)}",
+    ]
+
+def info_commandstats(is_master):
+    lines = []
+    for command, entry in sorted(command_stats.items()):
+        per_call = entry.usec / entry.calls if entry.calls else 0
+        lines.append(f"cmdstat_{command.decode(errors='replace').lower()}:calls={entry.calls},usec={entry.usec},"
+                     f"usec_per_call={per_call:.2f},rejected_calls={entry.rejected_calls},"
+                     f"failed_calls={entry.failed_calls}")
+    return lines
+
+def info_latencystats(is_master):
+    lines = []
+    for command, entry in sorted(command_stats.items()):
+        if not entry.latency.total:
+            continue
+        percentiles = ",".join(f"p{p:g}={entry.latency.percentile(p):.3f}" for p in LATENCY_PERCENTILES)
+        lines.append(f"latency_percentiles_usec_{command.decode(errors='replace').lower()}:{percentiles}")
+    return lines
+
+def info_keyspace(is_master):
+    if not database:
+        return []
+    return [f"db0:keys={len(database)},expires={len(expires)}"]
+
+def info_cluster(is_master):
+    return [f"cluster_enabled:{0 if cluster['slot_owner'] is None else 1}"]
+
+INFO_SECTIONS = {
+    b"clients": ("Clients", info_clients),
+    b"memory": ("Memory", info_memory),
+    b"persistence": ("Persistence", info_persistence),
+    b"replication": ("Replication", info_replication),
+    b"stats": ("Stats", info_stats),
+    b"commandstats": ("Commandstats", info_commandstats),
+    b"latencystats": ("Latencystats", info_latencystats),
+    b"cluster": ("Cluster", info_cluster),
+    b"keyspace": ("Keyspace", info_keyspace),
+}
 
 def info_command(section, is_master):
-    if section.lower() == 'replication':
-        info = [
-            f"role:{'master' if is_master else 'slave'}",
-            f"master_replid:{MASTER_REPLID}",
-            f"master_repl_offset:{MASTER_REPL_OFFSET}"
-        ]
-        info_str = "\r\n".join(info)
-        return f"${len(info_str)}\r\n{info_str}\r\n"
+    section = section.lower()
+    if section in (b"all", b"everything"):
+        selected = INFO_SECTIONS.values()
+    elif section in (b"", b"default"):
+        #one line per command seen, so like Redis they are only shown when asked for
+        selected = [value for name, value in INFO_SECTIONS.items() if name not in (b"commandstats", b"latencystats")]
+    elif section in INFO_SECTIONS:
+        selected = [INFO_SECTIONS[section]]
     else:
-        return "$-1\r\n"
+        return encode_bulk(b"")
+    blocks = []
+    for title, render in selected:
+        blocks.append("\r\n".join([f"# {title}"] + render(is_master)))
+    return encode_bulk("\r\n\r\n".join(blocks).encode())
+
+def config_command(args):
+    subcommand = args[1].upper()
+    if subcommand == b"GET":
+        reply = []
+        for pattern in args[2:]:
+            pattern = pattern.decode(errors="replace").lower()
+            for name, value in config.items():
+                if fnmatch.fnmatchcase(name, pattern):
+                    reply += [encode_bulk(name.encode()), encode_bulk(str(value).encode())]
+        return encode_array(reply)
+    elif subcommand == b"SET":
+        if len(args) < 4 or len(args) % 2:
+            return wrong_arity_error(b"CONFIG|SET")
+        updates = {}
+        for name, value in zip(args[2::2], args[3::2]):
+            name = name.decode(errors="replace").lower()
+            if name not in RUNTIME_CONFIG:
+                return encode_error(f"ERR Unknown option or number of arguments for CONFIG SET - '{name}'")
+            try:
+                updates[name] = RUNTIME_CONFIG[name](value.decode())
+            except (ValueError, UnicodeDecodeError):
+                return encode_error(f"ERR Invalid argument '{value.decode(errors='replace')}' for CONFIG SET '{name}'")
+        for name, value in updates.items():
+            apply_config(name, value)
+        return OK
+    elif subcommand == b"RESETSTAT":
+        for name, value in stats.items():
+            stats[name] = type(value)()
+        command_stats.clear()
+        for name in instantaneous_metrics:
+            instantaneous_metrics[name] = InstantaneousMetric()
+        return OK
+    return encode_error(f"ERR unknown subcommand '{args[1].decode(errors='replace')}'")
+
+def parse_choice(*choices):
+    def parse(value):
+        if value.lower() not in choices:
+            raise ValueError(value)
+        return value.lower()
+    return parse
+
+def parse_nonnegative(value):
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+#what CONFIG SET may change on a running server, name -> parser of the new value
+RUNTIME_CONFIG = {
+    "loglevel": parse_choice(*LEVELS),
+    "slowlog-log-slower-than": int,
+    "slowlog-max-len": parse_nonnegative,
+    "latency-tracking": parse_choice("yes", "no"),
+    "busy-reply-threshold": parse_nonnegative,
+    "tracking-table-max-keys": parse_nonnegative,
+}
+
+def apply_config(name, value):
+    config[name] = value
+    if name == "loglevel":
+        set_verbosity(value)
+    elif name == "slowlog-max-len":
+        slowlog.resize(value)
+
+def slowlog_command(args):
+    subcommand = args[1].upper()
+    if subcommand == b"GET":
+        count = 10
+        if len(args) > 2:
+            try:
+                count = int(args[2])
+            except ValueError:
+                return NOT_INTEGER_ERROR
+            if count < -1:
+                return encode_error("ERR count should be greater than or equal to -1")
+        entries = list(slowlog.entries) if count == -1 else list(itertools.islice(slowlog.entries, count))
+        return encode_array([encode_array([
+            encode_integer(entry_id),
+            encode_integer(started),
+            encode_integer(usec),
+            encode_array([encode_bulk(arg) for arg in kept]),
+            encode_bulk(f"{client[0]}:{client[1]}".encode()),
+            encode_bulk(b""),
+        ]) for entry_id, started, usec, kept, client in entries])
+    elif subcommand == b"LEN":
+        return encode_integer(len(slowlog))
+    elif subcommand == b"RESET":
+        slowlog.reset()
+        return OK
+    return encode_error(f"ERR unknown subcommand '{args[1].decode(errors='replace')}'")
+
+def latency_command(args):
+    subcommand = args[1].upper()
+    if subcommand == b"HISTOGRAM":
+        if len(args) > 2:
+            names = [name.upper() for name in args[2:]]
+        else:
+            names = sorted(command_stats)
+        reply = []
+        for name in names:
+            entry = command_stats.get(name)
+            if entry is None or not entry.latency.total:
+                continue
+            buckets = []
+            for bound, calls in entry.latency.cumulative_powers_of_two():
+                buckets += [encode_integer(bound), encode_integer(calls)]
+            reply += [encode_bulk(name.lower()), encode_array([
+                encode_bulk(b"calls"), encode_integer(entry.calls),
+                encode_bulk(b"histogram_usec"), encode_array(buckets),
+            ])]
+        return encode_array(reply)
+    return encode_error(f"ERR unknown subcommand '{args[1].decode(errors='replace')}'")
+
+def stats_cron():
+    timers.call_later(STATS_CRON_PERIOD, stats_cron)
+    now = time.monotonic()
+    for name, metric in instantaneous_metrics.items():
+        metric.track(stats[name], now)
+
+def rdb_path():
+    return os.path.join(config["dir"], config["dbfilename"])
+
+def rdb_save():
+    #write to a temp file and rename it over the old snapshot, so a crash mid-save
+    #never leaves a truncated dump behind
+    temp_path = os.path.join(config["dir"], f"temp-{os.getpid()}.rdb")
+    aux = {"redis-ver": REDIS_VERSION, "redis-bits": 64, "ctime": int(time.time()), "used-mem": used_memory,
+           "repl-id": replication["replid"], "repl-offset": replication["offset"]}
+    entries = ((key, value, expires.get(key)) for key, value in database.items())
+    try:
+        with open(temp_path, "wb") as f:
+            rdb.dump(f, entries, aux, len(database), len(expires),
+                     checksum = config["rdbchecksum"] == "yes", compression = config["rdbcompression"] == "yes")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, rdb_path())
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def save_command():
+    if background_child is not None:
+        return encode_error("ERR Background save already in progress")
+    try:
+        rdb_save()
+    except Exception as e:
+        log(WARNING, "Error saving DB on disk: %s", e)
+        return encode_error(f"ERR {e}")
+    persistence["dirty"] = 0
+    persistence["lastsave"] = int(time.time())
+    return OK
+
+def bgsave_command():
+    if background_child is not None:
+        if background_child["on_done"] is on_aof_rewrite_done:
+            return encode_error("ERR An AOF log rewriting in progress: can't BGSAVE right now.")
+        return encode_error("ERR Background save already in progress")
+    try:
+        start_background_child(rdb_save, on_bgsave_done)
+    except OSError as e:
+        return encode_error(f"ERR {e}")
+    return b"+Background saving started\r\n"
+
+def start_background_child(task, on_done):
+    #on_done(child, succeeded) runs in the parent once the child exits
+    global background_child
+    dirty_at_start = persistence["dirty"]
+    pid = os.fork()
+    if pid == 0:
+        set_role("C")
+        status = 1
+        try:
+            task()
+            status = 0
+        except BaseException as e:
+            log(WARNING, "Background child failed: %s", e)
+        finally:
+            os._exit(status)
+    background_child = {"pid": pid, "started": time.time(), "dirty": dirty_at_start, "on_done": on_done}
+    timers.call_later(CHILD_CHECK_PERIOD, check_background_child)
+
+def check_background_child():
+    global background_child
+    child = background_child
+    try:
+        pid, status = os.waitpid(child["pid"], os.WNOHANG)
+    except ChildProcessError:
+        pid, status = child["pid"], 1 << 8
+    if pid == 0:
+        timers.call_later(CHILD_CHECK_PERIOD, check_background_child)
+        return
+    background_child = None
+    succeeded = os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    child["on_done"](child, succeeded)
+    #replicas that attached while this child ran need a snapshot taken after they did
+    if any(replica.repl_state == "wait_bgsave" for replica in replicas):
+        try:
+            start_bgsave_for_replication()
+        except OSError as e:
+            log(WARNING, "Can't start the BGSAVE for replication: %s", e)
+        return
+    if aof_state["rewrite_scheduled"]:
+        try:
+            start_aof_rewrite()
+        except OSError as e:
+            log(WARNING, "Can't start the scheduled AOF rewrite: %s", e)
+
+def on_bgsave_done(child, succeeded):
+    persistence["last_bgsave_time_sec"] = int(time.time() - child["started"])
+    if succeeded:
+        #writes that happened while the child was saving are still unsaved
+        persistence["dirty"] -= child["dirty"]
+        persistence["lastsave"] = int(child["started"])
+        persistence["last_bgsave_status"] = "ok"
+        log(NOTICE, "Background saving terminated with success")
+    else:
+        persistence["last_bgsave_status"] = "err"
+        temp_path = os.path.join(config["dir"], f"temp-{child['pid']}.rdb")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        log(WARNING, "Background saving error")
+    for replica in list(replicas):
+        if replica.repl_state == "wait_bgsave" and replica.repl_snapshot_pid == child["pid"]:
+            if succeeded:
+                start_rdb_transfer(replica)
+            else:
+                disconnect_replica(replica)
+
+def aof_path():
+    return os.path.join(config["dir"], config["appendfilename"])
+
+def aof_rewrite_temp_path(pid):
+    return os.path.join(config["dir"], f"temp-rewriteaof-bg-{pid}.aof")
+
+def write_all(fd, data):
+    with memoryview(data) as view:
+        while view:
+            view = view[os.write(fd, view):]
+
+def feed_append_only_file(command):
+    #runs under server_lock with the command that just executed
+    if aof_state["fd"] is None:
+        return
+    with aof_cond:
+        aof_state["buf"] += command
+        aof_state["fed"] += len(command)
+        if aof_state["rewrite_buf"] is not None:
+            aof_state["rewrite_buf"] += command
+
+def flush_append_only_file():
+    #replies may only go out once this returns; one write and fsync serves every thread waiting on it
+    if aof_state["fd"] is None:
+        return
+    always = config["appendfsync"] == "always"
+    done = "synced" if always else "written"
+    target = aof_state["fed"]
+    with aof_cond:
+        while aof_state[done] < target:
+            if aof_state["flushing"]:
+                aof_cond.wait()
+                continue
+            data = aof_state["buf"]
+            end = aof_state["fed"]
+            fd = aof_state["fd"]
+            aof_state["buf"] = bytearray()
+            aof_state["flushing"] = True
+            aof_cond.release()
+            try:
+                size = os.fstat(fd).st_size
+                write_all(fd, data)
+                if always:
+                    os.fsync(fd)
+                failed = None
+            except OSError as e:
+                failed = e
+            aof_cond.acquire()
+            aof_state["flushing"] = False
+            aof_cond.notify_all()
+            if failed is not None:
+                handle_aof_write_error(fd, size, data, failed)
+                return
+            aof_state["written"] = end
+            if always:
+                aof_state["synced"] = end
+            aof_state["last_write_status"] = "ok"
+
+def handle_aof_write_error(fd, size, data, error):
+    #called with aof_cond held; drop a partial write so the log stays parseable
+    log(WARNING, "Error writing to the AOF: %s", error)
+    aof_state["last_write_status"] = "err"
+    if config["appendfsync"] == "always":
+        #the replies can't go out and there is no way to take the writes back
+        log(WARNING, "Can't recover from AOF write error when the AOF fsync policy is 'always'. Exiting...")
+        os._exit(1)
+    try:
+        os.ftruncate(fd, size)
+    except OSError:
+        pass
+    #keep the commands to retry with the next flush
+    aof_state["buf"][:0] = data
+
+def aof_background_fsync():
+    #appendfsync everysec: fsync from this thread so no command ever waits for the disk
+    while True:
+        time.sleep(AOF_FSYNC_PERIOD)
+        with aof_cond:
+            fd, written = aof_state["fd"], aof_state["written"]
+            if fd is None or aof_state["synced"] >= written:
+                continue
+            #a duplicate stays valid even if a rewrite swaps the AOF meanwhile
+            fd = os.dup(fd)
+        try:
+            os.fsync(fd)
+        except OSError as e:
+            log(WARNING, "Error fsyncing the AOF: %s", e)
+            continue
+        finally:
+            os.close(fd)
+        with aof_cond:
+            aof_state["synced"] = max(aof_state["synced"], written)
+
+def rewrite_collection(key, value):
+    #commands rebuilding a collection, AOF_REWRITE_ITEMS_PER_CMD elements at a time
+    if isinstance(value, Stream):
+        return rewrite_stream(key, value)
+    if isinstance(value, Hash):
+        command, items = b"HSET", [item for pair in value.items() for item in pair]
+        step = 2
+    elif isinstance(value, ZSet):
+        command, items = b"ZADD", [item for member, score in value.items() for item in (format_score(score), member)]
+        step = 2
+    else:
+        command, items = (b"RPUSH" if isinstance(value, List) else b"SADD"), list(value)
+        step = 1
+    chunk = AOF_REWRITE_ITEMS_PER_CMD * step
+    return [encode_command([command, key] + items[i:i + chunk]) for i in range(0, len(items), chunk)]
+
+def rewrite_stream(key, value):
+    #an XADD per entry, then XSETID restores what trimming left behind: the last ID
+    #(an empty stream is created by adding and trimming an entry with it) and the counters
+    if len(value):
+        commands = [encode_command([b"XADD", key, format_stream_id(sid), *fields]) for sid, fields in value]
+    else:
+        commands = [encode_command([b"XADD", key, b"MAXLEN", b"0", format_stream_id(value.last_id), b"x", b"y"])]
+    commands.append(encode_command([b"XSETID", key, format_stream_id(value.last_id),
+                                    b"ENTRIESADDED", b"%d" % value.entries_added,
+                                    b"MAXDELETEDID", format_stream_id(value.max_deleted_id)]))
+    return commands
+
+def aof_rewrite(path):
+    #the shortest log rebuilding the dataset: one SET per live string, a few
+    #commands per collection
+    now = mstime()
+    with open(path, "wb") as f:
+        batch = []
+        for key, value in database.items():
+            expiry = expires.get(key)
+            if expiry is not None and expiry < now:
+                continue
+            if isinstance(value, COLLECTION_TYPES):
+                batch += rewrite_collection(key, value)
+                if expiry is not None:
+                    batch.append(encode_command([b"PEXPIREAT", key, b"%d" % expiry]))
+            else:
+                args = [b"SET", key, value_bytes(value)]
+                if expiry is not None:
+                    args += [b"PXAT", b"%d" % expiry]
+                batch.append(encode_command(args))
+            if len(batch) >= AOF_REWRITE_BATCH:
+                f.write(b"".join(batch))
+                batch.clear()
+        f.write(b"".join(batch))
+        f.flush()
+        os.fsync(f.fileno())
+
+def bgrewriteaof_command():
+    child = background_child
+    if child is not None:
+        if child["on_done"] is on_aof_rewrite_done:
+            return encode_error("ERR Background append only file rewriting already in progress")
+        #run it as soon as the BGSAVE child exits
+        aof_state["rewrite_scheduled"] = True
+        return b"+Background append only file rewriting scheduled\r\n"
+    try:
+        start_aof_rewrite()
+    except OSError as e:
+        return encode_error(f"ERR {e}")
+    return b"+Background append only file rewriting started\r\n"
+
+def start_aof_rewrite():
+    aof_state["rewrite_scheduled"] = False
+    with aof_cond:
+        aof_state["rewrite_buf"] = bytearray()
+    try:
+        start_background_child(lambda: aof_rewrite(aof_rewrite_temp_path(os.getpid())), on_aof_rewrite_done)
+    except OSError:
+        with aof_cond:
+            aof_state["rewrite_buf"] = None
+        raise
+
+def on_aof_rewrite_done(child, succeeded):
+    temp_path = aof_rewrite_temp_path(child["pid"])
+    with aof_cond:
+        rewrite_buf, aof_state["rewrite_buf"] = aof_state["rewrite_buf"], None
+        try:
+            if not succeeded:
+                raise OSError("rewrite child failed")
+            #the child's snapshot plus every command fed since the fork is the whole dataset
+            fd = os.open(temp_path, os.O_WRONLY | os.O_APPEND)
+            try:
+                write_all(fd, rewrite_buf)
+                os.fsync(fd)
+            except OSError:
+                os.close(fd)
+                raise
+            #a flush still writing to the old file must finish before it goes away
+            while aof_state["flushing"]:
+                aof_cond.wait()
+            os.replace(temp_path, aof_path())
+        except OSError as e:
+            aof_state["last_bgrewrite_status"] = "err"
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            log(WARNING, "Background AOF rewrite error: %s", e)
+            return
+        if aof_state["fd"] is not None:
+            os.close(aof_state["fd"])
+            aof_state["fd"] = fd
+            #whatever was still buffered is already in rewrite_buf, and now on disk
+            aof_state["buf"] = bytearray()
+            aof_state["written"] = aof_state["synced"] = aof_state["fed"]
+            aof_cond.notify_all()
+        else:
+            os.close(fd)
+        aof_state["base_size"] = os.path.getsize(aof_path())
+        aof_state["base_offset"] = aof_state["fed"]
+        aof_state["last_bgrewrite_status"] = "ok"
+    log(NOTICE, "Background AOF rewrite terminated with success")
+
+def load_append_only_file():
+    #commands run as if streamed from a master; one cut short by a crash is dropped from the file
+    path = aof_path()
+    started = time.time()
+    client = Connection(None, ("aof", 0), is_master_link = True)
+    parser = client.parser
+    fed = valid_end = commands = 0
+    try:
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(AOF_LOAD_CHUNK)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                fed += len(chunk)
+                for args in parser:
+                    process_master_single_command(args, client)
+                    commands += 1
+                    if client.multi is None:
+                        #a transaction only counts once its EXEC made it to the file
+                        valid_end = fed - parser.pending()
+    except (ProtocolError, OSError) as e:
+        log(WARNING, "Bad file format reading the append only file %s: %s", path, e)
+        sys.exit(1)
+    if valid_end < fed:
+        log(WARNING, "!!! Warning: short read while loading the AOF %s, truncating it to %d bytes", path, valid_end)
+        os.truncate(path, valid_end)
+    persistence["dirty"] = 0
+    log(NOTICE, "DB loaded from append only file: %d commands in %.3f seconds", commands, time.time() - started)
+
+def open_append_only_file():
+    path = aof_path()
+    if not os.path.exists(path):
+        #start the log from whatever the snapshot held
+        aof_rewrite(path)
+    aof_state["fd"] = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    aof_state["base_size"] = os.path.getsize(path)
+    if config["appendfsync"] == "everysec":
+        threading.Thread(target=aof_background_fsync, daemon=True).start()
+
+def load_dataset():
+    #the AOF, when enabled, is more recent than any snapshot
+    if config["appendonly"] == "yes" and os.path.exists(aof_path()):
+        load_append_only_file()
+        return
+    path = rdb_path()
+    if not os.path.exists(path):
+        return
+    try:
+        aux = load_rdb(path)
+    except (rdb.RdbError, OSError) as e:
+        #like Redis, refuse to start on a damaged snapshot rather than silently lose data
+        log(WARNING, "Error loading %s: %s", path, e)
+        sys.exit(1)
+    #a restarted replica can then ask its master for just what it missed
+    if replication["master_host"] is not None and b"repl-id" in aux and b"repl-offset" in aux:
+        replication["replid"] = aux[b"repl-id"].decode()
+        replication["offset"] = int(aux[b"repl-offset"])
+        replication["cached_master"] = True
+
+def load_rdb(path):
+    #returns the snapshot's auxiliary fields
+    loaded = read_rdb(path)
+    install_dataset(loaded)
+    return loaded["aux"]
+
+def read_rdb(path):
+    #decode a snapshot into containers of its own, so the slow part of a load
+    #doesn't need server_lock; install_dataset() swaps them in
+    started = time.time()
+    now = mstime()
+    policy = config["maxmemory-policy"]
+    if policy == "allkeys-lru":
+        access = int(time.monotonic() * 1000)
+    elif policy == "allkeys-lfu":
+        access = (int(time.monotonic() // 60) << 8) | LFU_INIT_VAL
+    else:
+        access = None
+    keys, key_expires, key_access_times, size = Keyspace(), {}, {}, 0
+    aux = {}
+    for key, value, expire_ms in rdb.load_file(path, config["rdbchecksum"] == "yes", aux):
+        if expire_ms is not None:
+            #a replica keeps expired keys until its master's DEL for them arrives
+            if expire_ms < now and replication["master_host"] is None:
+                continue
+            key_expires[key] = expire_ms
+            size += EXPIRY_OVERHEAD
+        if isinstance(value, bytes):
+            value = try_int_encoding(value)
+        keys[key] = value
+        size += entry_size(key, value)
+        if access is not None:
+            key_access_times[key] = access
+    index = [(expiry, key) for key, expiry in key_expires.items()]
+    heapq.heapify(index)
+    log(NOTICE, "DB loaded from disk: %d keys in %.3f seconds", len(keys), time.time() - started)
+    return dict(database = keys, expires = key_expires, expiry_index = index, key_access = key_access_times,
+                used_memory = size, aux = aux)
+
+def install_dataset(loaded):
+    #replace the dataset with one read by read_rdb() in O(1), the old one goes to the lazy free cycle
+    global database, expires, expiry_index, key_access, used_memory
+    empty_database(lazy = True)
+    database, expires = loaded["database"], loaded["expires"]
+    expiry_index, key_access = loaded["expiry_index"], loaded["key_access"]
+    used_memory = loaded["used_memory"]
+    for key, watchers in watched_keys.items():
+        if key in database:
+            for conn in watchers:
+                conn.watch_dirty = True
+    persistence["dirty"] = 0
+
+def empty_database(lazy = False):
+    global used_memory, expires, expiry_index, key_access, tracking_table
+    for key in list(watched_keys):
+        if key in database:
+            for conn in watched_keys[key]:
+                conn.watch_dirty = True
+    if tracking_table or tracking_prefixes:
+        #one null invalidation drops every tracking client's whole cache
+        for conn in [conn for conn in clients if conn.tracking is not None]:
+            deliver_message(conn, INVALIDATE_PUSH + NULL)
+    if lazy and len(database) > LAZYFREE_THRESHOLD:
+        #swapped for empty containers in O(1), the lazy free cycle frees the old ones in steps
+        for container in (database.detach(), expires, expiry_index, key_access, tracking_table):
+            lazy_free(container)
+        expires, expiry_index, key_access, tracking_table = {}, [], {}, {}
+    else:
+        database.clear()
+        expires.clear()
+        expiry_index.clear()
+        key_access.clear()
+        tracking_table.clear()
+    eviction_pool.clear()
+    used_memory = 0
 
 def connect_to_master(master_host, master_port, replica_port):
     master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     master_socket.connect((master_host, master_port))
-    print(f"Connected to master at {master_host}:{master_port}")
+    log(NOTICE, "Connected to MASTER %s:%d", master_host, master_port)
 
-    send_ping_to_master(master_socket)
-    send_replconf_to_master(master_socket, replica_port)
-    send_pysnc_to_master(master_socket)
+    #the handshake reads through the link's parser, so anything the master sends
+    #right after the RDB stays buffered for the command loop
+    master_conn = Connection(master_socket, (master_host, master_port), is_master_link = True)
+    try:
+        send_ping_to_master(master_conn)
+        send_replconf_to_master(master_conn, replica_port)
+        send_pysnc_to_master(master_conn)
+    except BaseException:
+        master_socket.close()
+        raise
+    #the replication offset advances by the bytes of every command parsed from here on
+    master_conn.repl_mark = master_conn.parser.consumed()
+    replication["master_last_io"] = time.monotonic()
+
+    log(NOTICE, "MASTER <-> REPLICA sync: handshake finished")
 
-    print(f"finished connecting with master")
+    return master_conn
+
+def reconnect_to_master():
+    #retry until the master answers, then resume from where the lost link stopped
+    while True:
+        time.sleep(REPL_RECONNECT_PERIOD)
+        try:
+            return connect_to_master(replication["master_host"], replication["master_port"],
+                                     replication["listening_port"])
+        except (OSError, ProtocolError, ValueError, rdb.RdbError) as e:
+            log(WARNING, "Error reconnecting to master: %s", e)
 
-    return master_socket
+def read_from_master(master_conn, read):
+    #read() pulls one item out of the parser, or None while it is incomplete
+    while True:
+        item = read()
+        if item is not None:
+            return item
+        data = master_conn.sock.recv(65536)
+        if not data:
+            raise ConnectionError("master closed the connection during handshake")
+        master_conn.parser.feed(data)
 
-def send_ping_to_master(master_socket):
-    ping_command = "*1\r\n$4\r\nPING\r\n"
-    master_socket.sendall(ping_command.encode()) #or can use b"string" instead of "encode"
-    print("Sent PING to master")
-    response = master_socket.recv(1024)
-    print("Recceived from master:", response.decode())
+def send_ping_to_master(master_conn):
+    master_conn.sock.sendall(encode_command([b"PING"]))
+    response = read_from_master(master_conn, master_conn.parser.next_line)
+    log(NOTICE, "Master replied to PING, replication can continue...")
 
-def send_replconf_to_master(master_socket, replica_port):
+def send_replconf_to_master(master_conn, replica_port):
     #send replica listening port
-    replconf_listening = f"*3\r\n$8\r\nREPLCONF\r\n$14\r\nlistening-port\r\n${len(str(replica_port))}\r\n{replica_port}\r\n"
-    master_socket.sendall(replconf_listening.encode())
-    response = master_socket.recv(1024)
-    print("Received from master (REPLCONF listening-port):", response.decode())
+    master_conn.sock.sendall(encode_command([b"REPLCONF", b"listening-port", str(replica_port).encode()]))
+    response = read_from_master(master_conn, master_conn.parser.next_line)
+    log(DEBUG, "Received from master (REPLCONF listening-port): %r", response)
 
     #Second REPLCONF command: REPLCONF capa psync2
-    replconf_capa = "*3\r\n$8\r\nREPLCONF\r\n$4\r\ncapa\r\n$6\r\npsync2\r\n"
-    master_socket.sendall(replconf_capa.encode())
-    response = master_socket.recv(1024)
-    print("Received from master (REPLCONF capa psync2):", response.decode())
-
-def send_pysnc_to_master(master_socket):
-    # PSYNC ? -1 command
-    psync_command = "*3\r\n$5\r\nPSYNC\r\n$1\r\n?\r\n$2\r\n-1\r\n"
-    master_socket.sendall(psync_command.encode())
-
-    response = master_socket.recv(1024).decode()
-    print(f"Received from master (PSYNC): {response}")
-
-def handle_psync():
-    full_resync_resopnse = f"+FULLRESYNC {MASTER_REPLID} {MASTER_REPL_OFFSET}\r\n"
-    rdb_response = f"${len(EMPTY_RDB)}\r\n".encode() + EMPTY_RDB
-    return (full_resync_resopnse, rdb_response)
-
-def handle_replconf(parts, client_socket = None):
-    if parts[4].lower() == "listening-port":
-        replica_ip, replica_port = client_socket.getpeername()[0], client_socket.getpeername()[1]
-        replica_sockets.append(client_socket)
-        print(f"Connected to the replica at {replica_ip}:{replica_port}")
-    elif parts[4].lower() == "getack": 
-        #if coming from master then propagate command
-        if parts[6] == '*':
-            propagate_command(propagate_command("\r\n".join(parts) + "\r\n"))
-        #replica responding with offste
+    master_conn.sock.sendall(encode_command([b"REPLCONF", b"capa", b"psync2"]))
+    response = read_from_master(master_conn, master_conn.parser.next_line)
+    log(DEBUG, "Received from master (REPLCONF capa psync2): %r", response)
+
+def send_pysnc_to_master(master_conn):
+    #ask for the stream right after the last byte we applied, or for everything
+    if replication["cached_master"]:
+        psync = [b"PSYNC", replication["replid"].encode(), b"%d" % (replication["offset"] + 1)]
+    else:
+        psync = [b"PSYNC", b"?", b"-1"]
+    master_conn.sock.sendall(encode_command(psync))
+
+    response = read_from_master(master_conn, master_conn.parser.next_line)
+    log(NOTICE, "Received from master (PSYNC): %s", response.decode(errors = "replace"))
+    if response.startswith(b"+CONTINUE"):
+        #the master streams what we missed from its backlog; it may have a new replid
+        fields = response.split()
+        if len(fields) > 1:
+            replication["replid"] = fields[1].decode()
+        return
+    if not response.startswith(b"+FULLRESYNC"):
+        raise ProtocolError(f"unexpected reply to PSYNC: {response!r}")
+    _, replid, offset = response.split()
+    receive_rdb_from_master(master_conn)
+    replication["replid"] = replid.decode()
+    replication["offset"] = int(offset)
+    replication["cached_master"] = True
+
+def receive_rdb_from_master(master_conn):
+    #$<len>\r\n and the RDB without a trailing CRLF, read exactly so the stream after it stays buffered
+    header = read_from_master(master_conn, master_conn.parser.next_line)
+    if not header.startswith(b"$"):
+        raise ProtocolError(f"expected '$' before RDB payload, got {header!r}")
+    remaining = int(header[1:])
+    started = time.time()
+    temp_path = os.path.join(config["dir"], f"temp-{int(started)}.{os.getpid()}.rdb")
+    with open(temp_path, "wb") as f:
+        data = master_conn.parser.take(remaining)
+        while True:
+            f.write(data)
+            remaining -= len(data)
+            if not remaining:
+                break
+            data = master_conn.sock.recv(min(remaining, REPL_TRANSFER_CHUNK))
+            if not data:
+                raise ConnectionError("master closed the connection during the RDB transfer")
+        f.flush()
+        os.fsync(f.fileno())
+    log(NOTICE, "MASTER <-> REPLICA sync: received the RDB in %.3f seconds", time.time() - started)
+    os.replace(temp_path, rdb_path())
+    #decoded outside the lock so clients are served meanwhile, then swapped in at once
+    loaded = read_rdb(rdb_path())
+    with server_lock:
+        install_dataset(loaded)
+
+def handle_psync(conn, replid, offset):
+    if replication["backlog"] is None:
+        replication["backlog"] = ReplicationBacklog(config["repl-backlog-size"], replication["offset"])
+    if conn not in replicas:
+        replicas.append(conn)
+    response = try_partial_resync(conn, replid, offset)
+    if response is None:
+        #full resync: the replica gets a snapshot taken after it attached, then
+        #every write propagated since that snapshot
+        conn.repl_state = "wait_bgsave"
+        conn.repl_snapshot_pid = None
+        conn.repl_buffer = []
+        conn.repl_buffer_bytes = 0
+    if conn.loop is None and conn.output_ready is None:
+        conn.output_ready = threading.Condition(conn.lock)
+        threading.Thread(target=replica_sender, args=(conn,), daemon=True).start()
+    if response is None and background_child is None:
+        try:
+            start_bgsave_for_replication()
+        except OSError as e:
+            log(WARNING, "Can't start the BGSAVE for replication: %s", e)
+            disconnect_replica(conn)
+    #otherwise another child is running, and the snapshot starts once it exits;
+    #+FULLRESYNC is sent at the fork, with the offset the snapshot is taken at
+    return response
+
+def try_partial_resync(conn, replid, offset):
+    #the replica sends the offset of the first byte it lacks, one past what it holds
+    backlog = replication["backlog"]
+    try:
+        held = int(offset) - 1
+    except ValueError:
+        return None
+    if replid.decode(errors = "replace") != replication["replid"]:
+        return None
+    missing = backlog.read_from(held)
+    if missing is None:
+        log(NOTICE, "Unable to partial resync with replica %s:%d: offset %d is outside the backlog", conn.addr[0], conn.addr[1], held)
+        return None
+    with conn.lock:
+        conn.repl_state = "online"
+    log(NOTICE, "Partial resynchronization request from %s:%d accepted, sending %d bytes of backlog", conn.addr[0], conn.addr[1], len(missing))
+    return f"+CONTINUE {replication['replid']}\r\n".encode() + missing
+
+def start_bgsave_for_replication():
+    start_background_child(rdb_save, on_bgsave_done)
+    resync = f"+FULLRESYNC {replication['replid']} {replication['offset']}\r\n".encode()
+    for replica in replicas:
+        if replica.repl_state == "wait_bgsave" and replica.repl_snapshot_pid is None:
+            replica.repl_snapshot_pid = background_child["pid"]
+            with replica.lock:
+                replica.add_reply(resync)
+            schedule_flush(replica)
+
+def schedule_flush(conn):
+    #the event loop writes once per iteration; threaded, the caller usually holds server_lock,
+    #where a blocking send to a slow client would stall every other one
+    if conn.loop is not None:
+        pending_writes.add(conn)
+        return
+    with replies_queued:
+        pending_writes.add(conn)
+        replies_queued.notify()
+
+def write_replies_forever():
+    #threaded model: sends what schedule_flush() queued, without holding server_lock
+    while True:
+        with replies_queued:
+            while not pending_writes:
+                replies_queued.wait()
+            conns = list(pending_writes)
+            pending_writes.clear()
+        flush_append_only_file()
+        for conn in conns:
+            try:
+                flush_replies(conn)
+            except OSError:
+                pass #the client's own thread sees the connection fail and cleans up
+
+def start_rdb_transfer(replica):
+    try:
+        f = open(rdb_path(), "rb")
+    except OSError as e:
+        log(WARNING, "Can't open the RDB for replication: %s", e)
+        disconnect_replica(replica)
+        return
+    size = os.fstat(f.fileno()).st_size
+    with replica.lock:
+        replica.add_reply(b"$%d\r\n" % size)
+        replica.repl_state = "send_bulk"
+        replica.repl_transfer = {"file": f, "offset": 0, "size": size}
+    if replica.loop is not None:
+        replica.loop.add_writer(replica.sock, on_replica_rdb_writable, replica)
+    else:
+        flush_replies(replica)
+
+def on_replica_rdb_writable(replica_socket, replica):
+    #event loop: send as much of the snapshot as the socket takes, without blocking
+    transfer = replica.repl_transfer
+    try:
+        #the $<size> header first
+        if not replica.write_pending():
+            return
+        while transfer["offset"] < transfer["size"]:
+            count = min(REPL_TRANSFER_CHUNK, transfer["size"] - transfer["offset"])
+            transfer["offset"] += os.sendfile(replica_socket.fileno(), transfer["file"].fileno(),
+                                              transfer["offset"], count)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError as e:
+        log(WARNING, "Error sending the RDB to replica %s:%d: %s", replica.addr[0], replica.addr[1], e)
+        close_client(replica)
+        return
+    replica.loop.remove_writer(replica_socket)
+    finish_rdb_transfer(replica)
+    flush_replies(replica)
+
+def replica_sender(replica):
+    #threaded model: the only thread writing to a replica after PSYNC, one sendall per wakeup
+    while True:
+        with replica.output_ready:
+            while replica.repl_state is not None and not replica.replies and replica.repl_state != "send_bulk":
+                replica.output_ready.wait()
+            #the state is read together with the queue: the $<size> header of a
+            #snapshot is queued in the same step that enters send_bulk
+            state = replica.repl_state
+            batch, replica.replies = replica.replies, []
+        if state is None:
+            return
+        try:
+            if batch:
+                data = b"".join(batch)
+                replica.sock.sendall(data)
+                stats["total_net_repl_output_bytes"] += len(data)
+                with replica.lock:
+                    replica.reply_bytes -= len(data)
+            if state == "send_bulk":
+                replica.sock.sendfile(replica.repl_transfer["file"])
+                finish_rdb_transfer(replica)
+        except (OSError, TypeError) as e:
+            #TypeError: the transfer was dropped with the replica meanwhile
+            log(WARNING, "Error writing to replica %s:%d: %s", replica.addr[0], replica.addr[1], e)
+            disconnect_replica(replica)
+            return
+
+def finish_rdb_transfer(replica):
+    with replica.lock:
+        if replica.repl_state != "send_bulk":
+            return #dropped meanwhile
+        replica.repl_transfer["file"].close()
+        replica.repl_transfer = None
+        replica.repl_state = "online"
+        for command in replica.repl_buffer:
+            replica.add_reply(command)
+        replica.repl_buffer = []
+        replica.repl_buffer_bytes = 0
+    log(NOTICE, "Synchronization with replica %s:%d succeeded", replica.addr[0], replica.addr[1])
+
+def disconnect_replica(replica):
+    if replica.loop is not None:
+        close_client(replica)
+    else:
+        #its own thread notices the closed socket and cleans up
+        drop_replica(replica)
+        try:
+            replica.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def drop_replica(conn):
+    if conn in replicas:
+        replicas.remove(conn)
+    with conn.lock:
+        conn.repl_state = None
+        if conn.repl_transfer is not None:
+            conn.repl_transfer["file"].close()
+            conn.repl_transfer = None
+        #a sender thread sees the state and exits
+        if conn.output_ready is not None:
+            conn.output_ready.notify()
+
+def handle_replconf(args, conn = None):
+    subcommand = args[1].lower()
+    if subcommand == b"listening-port":
+        replica_ip, replica_port = conn.addr[0], conn.addr[1]
+        if conn not in replicas:
+            replicas.append(conn)
+        log(NOTICE, "Replica %s:%d asks for synchronization", replica_ip, replica_port)
+    elif subcommand == b"getack":
+        #ask every replica to report its offset
+        feed_replicas(encode_command(args))
+    elif subcommand == b"ack":
+        try:
+            offset = int(args[2])
+        except ValueError:
+            return NOT_INTEGER_ERROR
+        #acknowledgements are never answered, a reply would corrupt the replica's stream
+        if conn not in replicas:
+            return None
+        conn.repl_ack_offset = offset
+        conn.repl_ack_time = time.monotonic()
+        if waiting_acks:
+            process_waiting_acks()
+        return None
+    return OK
+
+def wait_command(conn, numreplicas, timeout, is_master):
+    if not is_master:
+        return encode_error("ERR WAIT cannot be used with replica instances.")
+    try:
+        numreplicas, timeout = int(numreplicas), int(timeout)
+    except ValueError:
+        return NOT_INTEGER_ERROR
+    if timeout < 0:
+        return encode_error("ERR timeout is negative")
+    #replicas only need to have the client's own writes
+    acked = count_acked_replicas(conn.woff)
+    if acked >= numreplicas or atomic_block["depth"]:
+        return encode_integer(acked)
+    block_client(conn, timeout / 1000, on_wait_timeout, on_wait_close, target = conn.woff, numreplicas = numreplicas)
+    waiting_acks.append(conn)
+    request_acks()
+    return None
+
+def count_acked_replicas(offset):
+    return sum(1 for replica in replicas if replica.repl_state == "online" and replica.repl_ack_offset >= offset)
+
+def request_acks():
+    #WAITs issued before the GETACK goes out share it
+    if not replication["getack_scheduled"]:
+        replication["getack_scheduled"] = True
+        timers.call_later(0, send_getack)
+
+def send_getack():
+    replication["getack_scheduled"] = False
+    if waiting_acks:
+        feed_replicas(encode_command([b"REPLCONF", b"GETACK", b"*"]))
+
+def process_waiting_acks():
+    for conn in list(waiting_acks):
+        acked = count_acked_replicas(conn.blocked["target"])
+        if acked >= conn.blocked["numreplicas"]:
+            waiting_acks.remove(conn)
+            unblock_client(conn, encode_integer(acked))
+
+def on_wait_timeout(conn):
+    waiting_acks.remove(conn)
+    acked = count_acked_replicas(conn.blocked["target"])
+    unblock_client(conn, encode_integer(acked))
+
+def on_wait_close(conn):
+    waiting_acks.remove(conn)
+
+def multi_command(conn):
+    if conn.multi is not None:
+        return encode_error("ERR MULTI calls can not be nested")
+    conn.multi = []
+    conn.multi_error = False
+    return OK
+
+def exec_command(conn, is_master):
+    #the queued writes propagate as one MULTI/EXEC block, so a replica or reload applies all or none
+    queued = conn.multi
+    if queued is None:
+        return encode_error("ERR EXEC without MULTI")
+    aborted, dirty = conn.multi_error, conn.watch_dirty
+    conn.multi = None
+    conn.multi_error = False
+    unwatch_all_keys(conn)
+    if aborted:
+        return encode_error("EXECABORT Transaction discarded because of previous errors.")
+    if dirty:
+        return NULL_ARRAY
+    replies = []
+    begin_atomic_block()
+    try:
+        for args in queued:
+            reply = call_command(args[0].upper(), args, is_master, conn)
+            replies.append(NULL_BULK if reply is None else reply)
+    finally:
+        end_atomic_block()
+    return encode_array(replies)
+
+def discard_command(conn):
+    if conn.multi is None:
+        return encode_error("ERR DISCARD without MULTI")
+    conn.multi = None
+    conn.multi_error = False
+    unwatch_all_keys(conn)
+    return OK
+
+def begin_atomic_block():
+    atomic_block["depth"] += 1
+
+def end_atomic_block():
+    #the outermost EXEC or script closes the MULTI its first write opened
+    atomic_block["depth"] -= 1
+    if not atomic_block["depth"] and atomic_block["opened"]:
+        atomic_block["opened"] = False
+        feed_append_only_file(EXEC_COMMAND)
+        feed_replicas(EXEC_COMMAND)
+
+def watch_command(conn, keys):
+    if conn.multi is not None:
+        return encode_error("ERR WATCH inside MULTI is not allowed")
+    for key in keys:
+        if key not in conn.watched:
+            conn.watched.add(key)
+            watched_keys.setdefault(key, {})[conn] = None
+    return OK
+
+def unwatch_all_keys(conn):
+    for key in conn.watched:
+        watchers = watched_keys[key]
+        del watchers[conn]
+        if not watchers:
+            del watched_keys[key]
+    conn.watched.clear()
+    conn.watch_dirty = False
+
+def signal_modified_key(key):
+    #key was written, deleted or expired: the next EXEC of every client WATCHing it
+    #fails and the clients that may have cached it are told to drop it
+    watchers = watched_keys.get(key)
+    if watchers:
+        for conn in watchers:
+            conn.watch_dirty = True
+    if tracking_table:
+        readers = tracking_table.pop(key, None)
+        if readers:
+            send_invalidation(readers, key)
+    if tracking_prefixes:
+        for prefix, followers in list(tracking_prefixes.items()):
+            if key.startswith(prefix):
+                send_invalidation(followers, key)
+
+def load_script(source):
+    #compiled once per distinct source, later runs only look up its SHA1
+    sha = script_sha(source)
+    function = scripts.get(sha)
+    if function is None:
+        function = scripts[sha] = compile_script(source)
+    return sha, function
+
+def eval_command(conn, args, is_master, by_sha):
+    #a script past busy-reply-threshold is stopped if it hasn't written yet, else only logged
+    try:
+        numkeys = int(args[2])
+    except ValueError:
+        return NOT_INTEGER_ERROR
+    if numkeys < 0:
+        return encode_error("ERR Number of keys can't be negative")
+    if numkeys > len(args) - 3:
+        return encode_error("ERR Number of keys can't be greater than number of args")
+    if by_sha:
+        function = scripts.get(args[1].lower())
+        if function is None:
+            return encode_error("NOSCRIPT No matching script. Please use EVAL.")
+    else:
+        try:
+            _, function = load_script(args[1])
+        except ScriptError as e:
+            return encode_error(str(e))
+    started = time.monotonic()
+    dirty = persistence["dirty"]
+    warned = []
+
+    def execute(call_args):
+        if not call_args:
+            raise ScriptError("ERR Please specify at least one argument for this call")
+        command = call_args[0].upper()
+        if command not in COMMANDS:
+            raise ScriptError("ERR Unknown Redis command called from script")
+        if command in NOSCRIPT_COMMANDS:
+            raise ScriptError("ERR This Redis command is not allowed from scripts")
+        if command in KEYSPACE_COMMANDS and config["workers"] > 1:
+            #a script runs on one worker and would only see its shard
+            raise ScriptError(f"ERR '{command.decode().lower()}' can't be called from a script with --workers")
+        if not is_master and not conn.is_master_link:
+            refusal = replica_refusal(command)
+            if refusal is not None:
+                return refusal
+        reply = call_command(command, call_args, is_master, conn)
+        return NULL_BULK if reply is None else reply
+
+    def tick():
+        elapsed = time.monotonic() - started
+        if elapsed * 1000 < config["busy-reply-threshold"]:
+            return
+        if persistence["dirty"] == dirty:
+            raise ScriptError(f"ERR Script killed: still running after {elapsed:.1f} seconds, "
+                              "over busy-reply-threshold")
+        if not warned:
+            warned.append(True)
+            log(WARNING, "Script running for %.1f seconds has already written, it can't be stopped", elapsed)
+
+    begin_atomic_block()
+    try:
+        return run_script(function, args[3:3 + numkeys], args[3 + numkeys:], execute, tick)
+    except ScriptError as e:
+        return encode_error(str(e))
+    finally:
+        end_atomic_block()
+
+def script_command(args):
+    subcommand = args[1].upper() if len(args) > 1 else b""
+    if subcommand == b"LOAD" and len(args) == 3:
+        try:
+            sha, _ = load_script(args[2])
+        except ScriptError as e:
+            return encode_error(str(e))
+        return encode_bulk(sha)
+    elif subcommand == b"EXISTS" and len(args) > 2:
+        return encode_array([encode_integer(int(sha.lower() in scripts)) for sha in args[2:]])
+    elif subcommand == b"FLUSH" and len(args) <= 3:
+        if len(args) == 3 and args[2].upper() not in (b"ASYNC", b"SYNC"):
+            return encode_error("ERR syntax error")
+        scripts.clear()
+        return OK
+    return encode_error(f"ERR unknown subcommand or wrong number of arguments for 'script|{subcommand.decode(errors='replace').lower()}'")
+
+def hello_command(conn, args):
+    #under RESP3 pubsub messages and invalidations are pushes and HELLO answers with a map
+    resp = conn.resp
+    name = conn.name
+    i = 1
+    if len(args) > 1:
+        try:
+            resp = int(args[1])
+        except ValueError:
+            return encode_error("ERR Protocol version is not an integer or out of range")
+        if resp not in (2, 3):
+            return encode_error("NOPROTO unsupported protocol version")
+        i = 2
+    while i < len(args):
+        option = args[i].upper()
+        if option == b"AUTH" and i + 2 < len(args):
+            #no password is configured: like Redis' default user, any credentials are accepted
+            i += 3
+        elif option == b"SETNAME" and i + 1 < len(args):
+            name = args[i + 1]
+            i += 2
+        else:
+            return encode_error(f"ERR Syntax error in HELLO option '{args[i].decode(errors='replace')}'")
+    conn.resp = resp
+    conn.name = name
+    if resp == 2:
+        #a RESP2 connection can't tell invalidation pushes from replies
+        disable_tracking(conn)
+    fields = [
+        (b"server", encode_bulk(b"redis")),
+        (b"version", encode_bulk(REDIS_VERSION.encode())),
+        (b"proto", encode_integer(resp)),
+        (b"id", encode_integer(conn.id)),
+        (b"mode", encode_bulk(b"cluster" if config["cluster-enabled"] == "yes" else b"standalone")),
+        (b"role", encode_bulk(b"master" if replication["master_host"] is None else b"replica")),
+        (b"modules", encode_array([])),
+    ]
+    if resp == 3:
+        return encode_map([(encode_bulk(field), value) for field, value in fields])
+    return encode_array([item for field, value in fields for item in (encode_bulk(field), value)])
+
+def client_command(conn, args):
+    subcommand = args[1].upper()
+    if subcommand == b"ID" and len(args) == 2:
+        return encode_integer(conn.id)
+    elif subcommand == b"SETNAME" and len(args) == 3:
+        if any(byte <= 32 or byte > 126 for byte in args[2]):
+            return encode_error("ERR Client names cannot contain spaces, newlines or special characters.")
+        conn.name = args[2] or None
+        return OK
+    elif subcommand == b"GETNAME" and len(args) == 2:
+        return NULL_BULK if conn.name is None else encode_bulk(conn.name)
+    elif subcommand == b"TRACKING" and len(args) > 2:
+        return client_tracking_command(conn, args)
+    elif subcommand == b"CACHING" and len(args) == 3:
+        return client_caching_command(conn, args[2].upper())
+    return encode_error(f"ERR unknown subcommand or wrong number of arguments for 'client|{subcommand.decode(errors='replace').lower()}'")
+
+def client_tracking_command(conn, args):
+    #default mode remembers the keys read, BCAST reports every key under the prefixes
+    switch = args[2].upper()
+    if switch not in (b"ON", b"OFF"):
+        return encode_error("ERR syntax error")
+    bcast = optin = optout = False
+    prefixes = []
+    i = 3
+    while i < len(args):
+        option = args[i].upper()
+        if option == b"BCAST":
+            bcast = True
+        elif option == b"OPTIN":
+            optin = True
+        elif option == b"OPTOUT":
+            optout = True
+        elif option == b"PREFIX" and i + 1 < len(args):
+            i += 1
+            prefixes.append(args[i])
+        else:
+            return encode_error("ERR syntax error")
+        i += 1
+    if switch == b"OFF":
+        disable_tracking(conn)
+        return OK
+    if conn.resp != 3:
+        return encode_error("ERR Invalidations are sent as RESP3 pushes, switch the connection with HELLO 3 first")
+    if prefixes and not bcast:
+        return encode_error("ERR PREFIX option requires BCAST mode to be enabled")
+    if optin and optout:
+        return encode_error("ERR You can't use both OPTIN and OPTOUT")
+    if bcast and (optin or optout):
+        return encode_error("ERR OPTIN and OPTOUT are not compatible with BCAST")
+    disable_tracking(conn)
+    if bcast and not prefixes:
+        prefixes = [b""]
+    conn.tracking = dict(bcast = bcast, prefixes = prefixes, optin = optin, optout = optout, caching = None)
+    for prefix in prefixes:
+        tracking_prefixes.setdefault(prefix, {})[conn] = None
+    return OK
+
+def client_caching_command(conn, value):
+    tracking = conn.tracking
+    if tracking is None or not (tracking["optin"] or tracking["optout"]):
+        return encode_error("ERR CLIENT CACHING can be called only when the client is in tracking mode "
+                            "with OPTIN or OPTOUT mode enabled")
+    if value == b"YES":
+        if not tracking["optin"]:
+            return encode_error("ERR CLIENT CACHING YES is only valid when tracking is enabled in OPTIN mode.")
+    elif value == b"NO":
+        if not tracking["optout"]:
+            return encode_error("ERR CLIENT CACHING NO is only valid when tracking is enabled in OPTOUT mode.")
+    else:
+        return encode_error("ERR syntax error")
+    tracking["caching"] = value == b"YES"
+    return OK
+
+def disable_tracking(conn):
+    #the keys it read stay in tracking_table until they change or are pushed out,
+    #their invalidations skip it then
+    tracking = conn.tracking
+    if tracking is None:
+        return
+    conn.tracking = None
+    for prefix in tracking["prefixes"]:
+        followers = tracking_prefixes[prefix]
+        del followers[conn]
+        if not followers:
+            del tracking_prefixes[prefix]
+
+def remember_read_keys(conn, command, args):
+    tracking = conn.tracking
+    if tracking["bcast"] or (tracking["optin"] and not tracking["caching"]) or tracking["caching"] is False:
+        return
+    for key in key_arguments(command, args):
+        readers = tracking_table.get(key)
+        if readers is None:
+            readers = tracking_table[key] = {}
+        readers[conn] = None
+    limit = config["tracking-table-max-keys"]
+    while limit and len(tracking_table) > limit:
+        #full: the oldest key is forgotten, so its readers must stop caching it
+        key = next(iter(tracking_table))
+        send_invalidation(tracking_table.pop(key), key)
+
+def send_invalidation(targets, key):
+    message = INVALIDATE_PUSH + encode_array([encode_bulk(key)])
+    for conn in list(targets):
+        if conn.tracking is not None:
+            deliver_message(conn, message)
+
+def subscription_reply(kind, name, conn):
+    #every (un)subscription is confirmed with the client's remaining count
+    encode = encode_push if conn.resp == 3 else encode_array
+    return encode([encode_bulk(kind), NULL_BULK if name is None else encode_bulk(name),
+                   encode_integer(len(conn.channels) + len(conn.patterns))])
+
+def subscribe_command(conn, names, pattern):
+    replies = []
+    for name in names:
+        if pattern:
+            if name not in conn.patterns:
+                conn.patterns.add(name)
+                pubsub_patterns.add(name, conn)
+            replies.append(subscription_reply(b"psubscribe", name, conn))
         else:
-            return "*3\r\n$8\r\nREPLCONF\r\n$3\r\nACK\r\n$1\r\n0\r\n"
-    return "+OK\r\n"
+            if name not in conn.channels:
+                conn.channels.add(name)
+                pubsub_channels.setdefault(name, {})[conn] = None
+            replies.append(subscription_reply(b"subscribe", name, conn))
+    if conn.loop is None and conn.output_ready is None:
+        #threaded model: a subscriber gets a sender thread, so that publishing to
+        #one that reads slowly never blocks the publisher (and the server lock)
+        conn.output_ready = threading.Condition(conn.lock)
+        threading.Thread(target=subscriber_sender, args=(conn,), daemon=True).start()
+    return b"".join(replies)
 
-def propagate_command(command):
-    for replica_socket in replica_sockets:
-        #should remove socket which are not connected
+def unsubscribe_command(conn, names, pattern):
+    #no names drops every subscription of that kind
+    subscribed = conn.patterns if pattern else conn.channels
+    kind = b"punsubscribe" if pattern else b"unsubscribe"
+    if not names:
+        if not subscribed:
+            return subscription_reply(kind, None, conn)
+        names = list(subscribed)
+    replies = []
+    for name in names:
+        if name in subscribed:
+            subscribed.discard(name)
+            if pattern:
+                pubsub_patterns.remove(name, conn)
+            else:
+                subscribers = pubsub_channels[name]
+                del subscribers[conn]
+                if not subscribers:
+                    del pubsub_channels[name]
+        replies.append(subscription_reply(kind, name, conn))
+    return b"".join(replies)
+
+def release_subscriptions(conn):
+    #the connection is closing
+    if not conn.channels and not conn.patterns:
+        return
+    with server_lock:
+        unsubscribe_command(conn, [], False)
+        unsubscribe_command(conn, [], True)
+    if conn.output_ready is not None:
+        with conn.output_ready:
+            conn.output_ready.notify()
+
+def subscriber_sender(conn):
+    #threaded model: writes a subscriber's output until it leaves subscribe mode
+    while True:
+        with conn.output_ready:
+            while not conn.replies and (conn.channels or conn.patterns):
+                conn.output_ready.wait()
+            if not conn.replies:
+                #flush_replies() writes directly again from now on
+                conn.output_ready = None
+                return
+            batch, conn.replies = conn.replies, []
+        try:
+            data = b"".join(batch)
+            conn.sock.sendall(data)
+            stats["total_net_output_bytes"] += len(data)
+            with conn.lock:
+                conn.reply_bytes -= len(data)
+        except OSError:
+            disconnect_client(conn)
+            with conn.lock:
+                conn.output_ready = None
+            return
+
+def publish(channel, message, args):
+    #the message is encoded once and the same bytes objects are queued on every subscriber
+    body = encode_bulk(channel) + encode_bulk(message)
+    receivers = 0
+    subscribers = pubsub_channels.get(channel)
+    if subscribers:
+        payloads = (b"*3\r\n$7\r\nmessage\r\n" + body, b">3\r\n$7\r\nmessage\r\n" + body)
+        for conn in list(subscribers):
+            deliver_message(conn, payloads[conn.resp == 3])
+        receivers += len(subscribers)
+    for pattern, subscribers in pubsub_patterns.matches(channel):
+        pattern = encode_bulk(pattern)
+        headers = (b"*4\r\n$8\r\npmessage\r\n" + pattern, b">4\r\n$8\r\npmessage\r\n" + pattern)
+        for conn in list(subscribers):
+            deliver_message(conn, headers[conn.resp == 3], body)
+        receivers += len(subscribers)
+    #replicas relay the message to their own subscribers; it isn't data, so the AOF never sees it
+    feed_replicas(encode_command(args))
+    return receivers
+
+def deliver_message(conn, *chunks):
+    with conn.lock:
+        for chunk in chunks:
+            conn.add_reply(chunk)
+        pending = conn.reply_bytes
+    if output_limit_reached(conn, pending, "pubsub"):
+        log(WARNING, "Client %s:%d reached its pubsub output buffer limit, disconnecting it", conn.addr[0], conn.addr[1])
+        disconnect_client(conn)
+    else:
+        schedule_flush(conn)
+
+def disconnect_client(conn):
+    if conn.loop is not None:
+        close_client(conn)
+    else:
+        #its own thread notices the closed socket and cleans up
+        release_subscriptions(conn)
+        disable_tracking(conn)
         try:
-            replica_socket.sendall(command.encode())
-            ip, port = replica_socket.getpeername()
-            print(f"Successfully propagated to {ip}:{port}")
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def pubsub_command(args):
+    subcommand = args[1].upper()
+    if subcommand == b'CHANNELS' and len(args) <= 3:
+        regex = glob_to_regex(args[2]) if len(args) == 3 else None
+        return encode_array([encode_bulk(channel) for channel in pubsub_channels
+                             if regex is None or regex.fullmatch(channel)])
+    elif subcommand == b'NUMSUB':
+        replies = []
+        for channel in args[2:]:
+            replies += [encode_bulk(channel), encode_integer(len(pubsub_channels.get(channel, ())))]
+        return encode_array(replies)
+    elif subcommand == b'NUMPAT' and len(args) == 2:
+        return encode_integer(len(pubsub_patterns))
+    return encode_error(f"ERR unknown subcommand '{args[1].decode(errors='replace')}'")
+
+def replica_lag():
+    #seconds since the master last sent anything; it keeps growing while the link is down
+    if replication["master_last_io"] is None:
+        return float("inf")
+    return time.monotonic() - replication["master_last_io"]
+
+def replication_cron():
+    timers.call_later(REPL_CRON_PERIOD, replication_cron)
+    master_conn = replication["master_link"]
+    if master_conn is not None:
+        #unasked ACKs let the master report our offset and lag, and answer WAIT sooner
+        with master_conn.lock:
+            master_conn.add_reply(encode_command([b"REPLCONF", b"ACK", b"%d" % replication["offset"]]))
+        schedule_flush(master_conn)
+    elif replicas and replication["master_host"] is None:
+        now = time.monotonic()
+        if now - replication["last_ping"] >= config["repl-ping-replica-period"]:
+            #the PING is part of the stream, so replicas of an idle master still see traffic
+            replication["last_ping"] = now
+            feed_replicas(encode_command([b"PING"]))
+
+def propagate_command(args):
+    #every write reaches the AOF and the replicas as the same RESP bytes; the
+    #first write of a transaction or a script opens their MULTI
+    command = encode_command(args)
+    if atomic_block["depth"] and not atomic_block["opened"]:
+        atomic_block["opened"] = True
+        command = MULTI_COMMAND + command
+    feed_append_only_file(command)
+    feed_replicas(command)
+
+def feed_replicas(command):
+    #a master numbers every byte of the stream; a replica's offset follows its own master's
+    backlog = replication["backlog"]
+    if backlog is not None and replication["master_host"] is None:
+        backlog.feed(command)
+        replication["offset"] += len(command)
+    #only queue here; the event loop writes once per iteration and threaded
+    #replicas have a sender thread, so a slow replica never holds up a write
+    for replica in list(replicas):
+        with replica.lock:
+            if replica.repl_state == "online":
+                replica.add_reply(command)
+            elif replica.repl_snapshot_pid is not None:
+                #a replica whose snapshot is already forked gets the write after it,
+                #one still waiting for its snapshot will find the write in there
+                replica.repl_buffer.append(command)
+                replica.repl_buffer_bytes += len(command)
+            else:
+                continue
+            pending = replica.reply_bytes + replica.repl_buffer_bytes
+        if output_limit_reached(replica, pending, "replica"):
+            log(WARNING, "Replica %s:%d reached its output buffer limit, disconnecting it", replica.addr[0], replica.addr[1])
+            disconnect_replica(replica)
+        elif replica.repl_state == "online":
+            schedule_flush(replica)
+
+def output_limit_reached(conn, pending, kind):
+    #Redis semantics: over the hard limit at once, over the soft one for too long
+    hard, soft, seconds = output_buffer_limits[kind]
+    if hard and pending > hard:
+        return True
+    if not soft or pending <= soft:
+        conn.soft_limit_since = None
+        return False
+    now = time.monotonic()
+    if conn.soft_limit_since is None:
+        conn.soft_limit_since = now
+    return now - conn.soft_limit_since > seconds
+
+def process_master_command(master_conn):
+    responses = []
+    parser = master_conn.parser
+    for args in parser:
+        response = process_master_single_command(args, master_conn)
+        if ready_keys:
+            serve_blocked_clients()
+        if response is not None:
+            responses.append(response)
+        #every byte the master sends counts, whether it changed the dataset or not
+        consumed = parser.consumed()
+        replication["offset"] += consumed - master_conn.repl_mark
+        master_conn.repl_mark = consumed
+    return responses
+
+def handle_master_data(master_conn, data):
+    if data:
+        master_conn.parser.feed(data)
+        replication["master_last_io"] = time.monotonic()
+        stats["total_net_repl_input_bytes"] += len(data)
+    with server_lock:
+        responses = process_master_command(master_conn)
+    #only REPLCONF GETACK is answered on the master link
+    if responses:
+        with master_conn.lock:
+            for response in responses:
+                master_conn.add_reply(response)
+        flush_replies(master_conn)
+
+def listen_to_master(master_conn):
+    while True:
+        if master_conn is None:
+            master_conn = reconnect_to_master()
+        replication["master_link"] = master_conn
+        #commands that arrived together with the RDB are already buffered
+        handle_master_data(master_conn, b"")
+        while True:
+            try:
+                data = master_conn.sock.recv(65536)
+                if not data:
+                    break
+                handle_master_data(master_conn, data)
+                flush_append_only_file()
+            except Exception as e:
+                log(WARNING, "Error receiving data from master: %s", e)
+                break
+        master_conn.sock.close()
+        replication["master_link"] = None
+        log(NOTICE, "Connection with master lost")
+        master_conn = None
+
+def on_master_readable(master_socket, loop, master_conn):
+    try:
+        data = master_socket.recv(65536)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError as e:
+        log(WARNING, "Error receiving data from master: %s", e)
+        data = b""
+    if data:
+        try:
+            handle_master_data(master_conn, data)
+            return
         except Exception as e:
+            log(WARNING, "Error processing data from master: %s", e)
+    drop_master_link(master_conn)
+
+def drop_master_link(master_conn):
+    #the link failed to read or write; the handshake blocks, so it runs off the loop and hands the new link back
+    loop = master_conn.loop
+    pending_writes.discard(master_conn)
+    loop.forget(master_conn.sock)
+    master_conn.sock.close()
+    replication["master_link"] = None
+    log(NOTICE, "Connection with master lost")
+    threading.Thread(target=reconnect_in_background, args=(loop,), daemon=True).start()
+
+def reconnect_in_background(loop):
+    master_conn = reconnect_to_master()
+    timers.call_later(0, attach_master_link, loop, master_conn)
+    loop.wake()
+
+def attach_master_link(loop, master_conn):
+    #the handshake used a blocking socket; from here on ACKs are written by the loop
+    master_conn.loop = loop
+    master_conn.sock.setblocking(False)
+    replication["master_link"] = master_conn
+    handle_master_data(master_conn, b"")
+    loop.add_reader(master_conn.sock, on_master_readable, loop, master_conn)
+
+def proxy_command(conn, owners, args, merge = None, dedicated = False):
+    #the client stays blocked until every owner replies, keeping its pipelined commands in order;
+    #merge(replies) builds its reply when there are several, or one needs rewriting. A dedicated
+    #link is opened for this command alone and closed once it replies or the client goes away
+    links = []
+    for owner in owners:
+        link = None if dedicated else cluster["links"].get(owner)
+        if link is None:
             try:
-                ip, port = replica_socket.getpeername()
-            except:
-                ip, port = "unkonwn", "unknown"
-            print(f"Failed to propagate to {ip}:{port}: {e}")
+                link = open_cluster_link(owner, conn.loop, shared = not dedicated)
+            except OSError as e:
+                return encode_error(f"CLUSTERDOWN node {owner} is unreachable: {e}")
+        links.append(link)
+    block_client(conn, 0, None, on_proxy_close, replies = [], expected = len(links), merge = merge,
+                 links = links, dedicated = dedicated)
+    request = encode_command(args)
+    for link in links:
+        with link.lock:
+            link.add_reply(request)
+        link.proxy_waiting.append(conn)
+    for link in links:
+        if link.loop is not None:
+            pending_writes.add(link)
+            continue
+        try:
+            flush_replies(link)
+        except OSError as e:
+            log(WARNING, "Error writing to node %s:%d: %s", link.addr[0], link.addr[1], e)
+            drop_cluster_link(link)
+    return None
 
-def listen_to_master(master_socket):
-    while True:
+def open_cluster_link(owner, loop, shared = True):
+    host, port = cluster["nodes"][owner]
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    link = Connection(sock, (host, port), loop)
+    link.proxy_waiting = collections.deque()
+    if loop is not None:
+        sock.setblocking(False)
+        loop.add_reader(sock, on_cluster_link_readable, link)
+    else:
+        threading.Thread(target=cluster_link_reader, args=(link,), daemon=True).start()
+    if shared:
+        cluster["links"][owner] = link
+    return link
+
+def close_dedicated_link(link):
+    if link.loop is not None:
+        close_client(link)
+        return
+    #wakes its reader thread, which closes the socket
+    try:
+        link.sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def handle_cluster_link_data(link, data):
+    with server_lock:
+        link.parser.feed(data)
+        while True:
+            reply = link.parser.next_reply()
+            if reply is None:
+                break
+            conn = link.proxy_waiting.popleft()
+            if conn is None:
+                continue
+            state = conn.blocked
+            state["replies"].append(reply)
+            if len(state["replies"]) == state["expected"]:
+                merge = state["merge"]
+                unblock_client(conn, reply if merge is None else merge(state["replies"]))
+                if state["dedicated"]:
+                    close_dedicated_link(link)
+                    return
+
+def on_cluster_link_readable(sock, link):
+    try:
+        data = sock.recv(65536)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError:
+        data = b""
+    if data:
         try:
-            data = master_socket.recv(1024)
+            handle_cluster_link_data(link, data)
+            return
+        except ProtocolError as e:
+            log(WARNING, "Error reading from node %s:%d: %s", link.addr[0], link.addr[1], e)
+    close_client(link)
+
+def cluster_link_reader(link):
+    try:
+        while True:
+            data = link.sock.recv(65536)
             if not data:
                 break
-            print(f"received data from master {data}")
-            response = process_master_command(data)
-            print(f"received response for listen_to_master {response}")
-            # if response is not None:
-            #     print(f"sending data to master {response}")
-            #     send_response(master_socket, response)
-        except Exception as e:
-            print(f"Error receiving data from master: {e}")
-            break
-    print("Connection to master closed")
+            handle_cluster_link_data(link, data)
+    except (OSError, ProtocolError) as e:
+        log(WARNING, "Error reading from node %s:%d: %s", link.addr[0], link.addr[1], e)
+    with server_lock:
+        drop_cluster_link(link)
+    link.sock.close()
+
+def drop_cluster_link(conn):
+    #the link is gone: the next proxied command opens a new one, the waiting clients get an error
+    if conn.proxy_waiting is None:
+        return
+    for owner, link in list(cluster["links"].items()):
+        if link is conn:
+            del cluster["links"][owner]
+    waiting, conn.proxy_waiting = conn.proxy_waiting, collections.deque()
+    for client in waiting:
+        if client is not None and client.blocked is not None:
+            #replies still due on other links are skipped
+            on_proxy_close(client)
+            unblock_client(client, encode_error("CLUSTERDOWN lost the link to the node owning the key"))
+
+def on_proxy_close(conn):
+    #the reply still arrives and is skipped; a dedicated link is closed instead, which
+    #also stops a blocking command still waiting on the owner
+    state = conn.blocked
+    for link in state["links"]:
+        for i, waiting in enumerate(link.proxy_waiting):
+            if waiting is conn:
+                link.proxy_waiting[i] = None
+        if state["dedicated"]:
+            close_dedicated_link(link)
+
+def cluster_command(args):
+    if cluster["slot_owner"] is None:
+        return encode_error("ERR This instance has cluster support disabled")
+    subcommand = args[1].upper()
+    nodes = cluster["nodes"]
+    if subcommand == b"KEYSLOT":
+        return encode_integer(key_hash_slot(args[2]))
+    elif subcommand == b"SLOTS":
+        reply = []
+        for first, last, owner in slot_ranges(cluster["slot_owner"]):
+            host, port = nodes[owner]
+            node = encode_array([encode_bulk(host.encode()), encode_integer(port), encode_bulk(node_id(host, port).encode())])
+            reply.append(encode_array([encode_integer(first), encode_integer(last), node]))
+        return encode_array(reply)
+    elif subcommand == b"NODES":
+        ranges = slot_ranges(cluster["slot_owner"])
+        lines = []
+        for index, (host, port) in enumerate(nodes):
+            flags = "myself,master" if index == cluster["myself"] else "master"
+            slots = [str(first) if first == last else f"{first}-{last}" for first, last, owner in ranges if owner == index]
+            lines.append(" ".join([node_id(host, port), f"{host}:{port}@{port + 10000}", flags, "-", "0", "0", "0",
+                                   "connected"] + slots))
+        return encode_bulk("".join(line + "\n" for line in lines).encode())
+    elif subcommand == b"INFO":
+        assigned = sum(1 for owner in cluster["slot_owner"] if owner is not None)
+        lines = [
+            f"cluster_state:{'ok' if assigned == CLUSTER_SLOTS else 'fail'}",
+            f"cluster_slots_assigned:{assigned}",
+            f"cluster_slots_ok:{assigned}",
+            f"cluster_known_nodes:{len(nodes)}",
+            f"cluster_size:{len(set(cluster['slot_owner']) - {None})}",
+        ]
+        return encode_bulk("".join(line + "\r\n" for line in lines).encode())
+    elif subcommand == b"MYID":
+        if cluster["myself"] is None:
+            return encode_error("ERR this node is not in the cluster's node map")
+        return encode_bulk(node_id(*nodes[cluster["myself"]]).encode())
+    return encode_error(f"ERR unknown subcommand '{args[1].decode(errors='replace')}'")
+
+def load_cluster_config(path, port):
+    #each line is host:port followed by single slots or first-last ranges; no file means one node
+    me = (config["cluster-announce-ip"], port)
+    if not os.path.exists(path):
+        cluster["nodes"] = [me]
+        cluster["slot_owner"] = [0] * CLUSTER_SLOTS
+        cluster["myself"] = 0
+        return
+    nodes = []
+    slot_owner = [None] * CLUSTER_SLOTS
+    with open(path) as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            host, _, node_port = fields[0].rpartition(":")
+            nodes.append((host, int(node_port)))
+            for first, last in parse_slot_ranges(fields[1:]):
+                for slot in range(first, last + 1):
+                    if slot_owner[slot] is not None:
+                        raise ValueError(f"slot {slot} is assigned to two nodes")
+                    slot_owner[slot] = len(nodes) - 1
+    cluster["nodes"] = nodes
+    cluster["slot_owner"] = slot_owner
+    #a node missing from the map (a replica, say) redirects every key
+    cluster["myself"] = nodes.index(me) if me in nodes else None
+
+def start_workers(count, port):
+    #each worker owns a slot range, listens on the shared port and on port + 1 + index, and
+    #gets back the socket for the latter; those are all bound before any worker can be
+    #reached, so a connection made meanwhile can't take one of their ports
+    cluster["nodes"] = [("127.0.0.1", port + 1 + i) for i in range(count)]
+    node_sockets = [socket.create_server(address) for address in cluster["nodes"]]
+    slot_owner = []
+    for index, (first, last) in enumerate(split_slots(count)):
+        slot_owner += [index] * (last - first + 1)
+    supervisor = os.getpid()
+    pids = []
+    for index in range(count):
+        pid = os.fork()
+        if pid == 0:
+            cluster["myself"] = index
+            cluster["slot_owner"] = slot_owner
+            for name in ("dbfilename", "appendfilename"):
+                stem, ext = os.path.splitext(config[name])
+                config[name] = f"{stem}-{index}{ext}"
+            timers.call_later(WORKER_CHECK_PERIOD, check_supervisor, supervisor)
+            for other, node_socket in enumerate(node_sockets):
+                if other != index:
+                    node_socket.close()
+            return node_sockets[index]
+        pids.append(pid)
+    for node_socket in node_sockets:
+        node_socket.close()
+    supervise_workers(pids)
+
+def supervise_workers(pids):
+    #a worker that dies takes the others down with it; the supervisor holds no data
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    log(NOTICE, "Started %d workers: %s", len(pids), pids)
+    try:
+        pid, status = os.wait()
+        log(WARNING, "Worker %d exited with status %d, stopping the others", pid, status)
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        #the server is only down once every worker has released its ports
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+    sys.exit(1)
+
+def check_supervisor(supervisor):
+    #a worker must not outlive its supervisor and keep the ports
+    if os.getppid() != supervisor:
+        log(WARNING, "Supervisor is gone, exiting")
+        flush_append_only_file()
+        os._exit(0)
+    timers.call_later(WORKER_CHECK_PERIOD, check_supervisor, supervisor)
+
+def serve_threaded(server_sockets, is_master, master_conn):
+    if not is_master:
+        #start a new thread to listen for commands from master
+        master_listener_thread = threading.Thread(target=listen_to_master, args=(master_conn,))
+        master_listener_thread.start()
+
+    #writes made by timer callbacks (expiry, eviction) reach the AOF right after they run
+    threading.Thread(target=timers.run_forever, args=(flush_append_only_file,), daemon=True).start()
+    threading.Thread(target=write_replies_forever, daemon=True).start()
+
+    #the first socket is the shared port, a worker's own port comes after it
+    for server_socket in server_sockets[1:]:
+        threading.Thread(target=accept_forever, args=(server_socket, is_master, True), daemon=True).start()
+    accept_forever(server_sockets[0], is_master, False)
+
+def accept_forever(server_socket, is_master, on_worker_port):
+    while True:
+        # blocking line.
+        client_socket, addr = server_socket.accept()
+        with server_lock:
+            stats["total_connections_received"] += 1
+        log(VERBOSE, "Accepted %s:%d", addr[0], addr[1])
+
+        #create and start a new thread to handle this client
+        client_thread = threading.Thread(target=handle_client, args=(client_socket, addr, is_master, on_worker_port))
+        client_thread.start()
+
+def serve_eventloop(server_sockets, is_master, master_conn):
+    loop = EventLoop()
+    for index, server_socket in enumerate(server_sockets):
+        server_socket.setblocking(False)
+        loop.add_reader(server_socket, on_client_accept, loop, is_master, index > 0)
+    if master_conn is not None:
+        attach_master_link(loop, master_conn)
+    elif not is_master:
+        threading.Thread(target=reconnect_in_background, args=(loop,), daemon=True).start()
+    loop.run_forever(before_sleep)
+
+def parse_output_buffer_limits(value):
+    #"<class> <hard> <soft> <seconds>", repeated, with memory units allowed
+    fields = value.split()
+    if not fields or len(fields) % 4:
+        raise ValueError("expected <class> <hard limit> <soft limit> <soft seconds> groups")
+    limits = {}
+    for i in range(0, len(fields), 4):
+        kind = "replica" if fields[i] == "slave" else fields[i]
+        if kind not in output_buffer_limits:
+            raise ValueError(f"unknown client class '{fields[i]}'")
+        limits[kind] = (parse_memory(fields[i + 1]), parse_memory(fields[i + 2]), int(fields[i + 3]))
+    return limits
+
+def parse_memory(value):
+    #accepts plain bytes or Redis-style units such as 100mb or 1gb
+    units = {"kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3, "k": 1000, "m": 1000 ** 2, "g": 1000 ** 3}
+    value = value.strip().lower()
+    for suffix, multiplier in units.items():
+        if value.endswith(suffix):
+            return int(value[:-len(suffix)]) * multiplier
+    return int(value)
 
 def main():
     parser = argparse.ArgumentParser(description='Redis Lite Server')
     parser.add_argument("--port", type = int, default = 6379, help = "port to run the server on")
     parser.add_argument("--replicaof", help = "Host and port of the master server")
+    parser.add_argument("--io-model", choices = ["eventloop", "threaded"], default = "eventloop",
+                        help = "serve all sockets from one event loop or spawn a thread per connection")
+    parser.add_argument("--client-output-high-water", type = int, default = config["client-output-high-water"],
+                        help = "pending reply bytes after which a client's input is no longer read")
+    parser.add_argument("--maxmemory", type = parse_memory, default = 0,
+                        help = "dataset size limit (e.g. 100mb), 0 means no limit")
+    parser.add_argument("--maxmemory-policy", choices = MAXMEMORY_POLICIES, default = config["maxmemory-policy"],
+                        help = "how keys are chosen for eviction once maxmemory is reached")
+    parser.add_argument("--maxmemory-samples", type = int, default = config["maxmemory-samples"],
+                        help = "keys sampled per eviction by the lru/lfu policies")
+    parser.add_argument("--dir", default = config["dir"], help = "directory holding the RDB snapshot and the AOF")
+    parser.add_argument("--dbfilename", default = config["dbfilename"], help = "name of the RDB snapshot file")
+    parser.add_argument("--rdbcompression", choices = ["yes", "no"], default = config["rdbcompression"],
+                        help = "LZF-compress string values in snapshots")
+    parser.add_argument("--rdbchecksum", choices = ["yes", "no"], default = config["rdbchecksum"],
+                        help = "write and verify the CRC64 trailer of snapshots")
+    parser.add_argument("--appendonly", choices = ["yes", "no"], default = config["appendonly"],
+                        help = "log every write to the append-only file and load it at startup")
+    parser.add_argument("--appendfilename", default = config["appendfilename"], help = "name of the append-only file")
+    parser.add_argument("--appendfsync", choices = APPENDFSYNC_POLICIES, default = config["appendfsync"],
+                        help = "fsync the append-only file before every reply, once a second or never")
+    parser.add_argument("--repl-backlog-size", type = parse_memory, default = config["repl-backlog-size"],
+                        help = "bytes of replication stream kept for replicas that reconnect")
+    parser.add_argument("--client-output-buffer-limit", type = parse_output_buffer_limits,
+                        help = "e.g. \"replica 256mb 64mb 60\": disconnect a replica (or a pubsub subscriber) whose "
+                               "pending output passes the hard limit, or stays above the soft limit for that "
+                               "many seconds")
+    parser.add_argument("--replica-read-only", choices = ["yes", "no"], default = config["replica-read-only"],
+                        help = "answer writes from clients with -READONLY when running as a replica")
+    parser.add_argument("--replica-max-lag", type = int, default = config["replica-max-lag"],
+                        help = "replica: refuse reads once nothing arrived from the master for this many seconds "
+                               "(keep it above the master's repl-ping-replica-period), 0 disables")
+    parser.add_argument("--repl-ping-replica-period", type = int, default = config["repl-ping-replica-period"],
+                        help = "seconds between the PINGs a master sends its replicas")
+    parser.add_argument("--workers", type = int, default = config["workers"],
+                        help = "shard the keyspace by hash slot across this many processes")
+    parser.add_argument("--worker-routing", choices = ["proxy", "moved"], default = config["worker-routing"],
+                        help = "for a key another worker owns, forward the command to it or answer -MOVED")
+    parser.add_argument("--cluster-enabled", choices = ["yes", "no"], default = config["cluster-enabled"],
+                        help = "serve only the hash slots the node map gives this node, -MOVED for the rest")
+    parser.add_argument("--cluster-config-file", default = config["cluster-config-file"],
+                        help = "node map: one \"host:port slot-range...\" line per node, relative to --dir")
+    parser.add_argument("--cluster-announce-ip", default = config["cluster-announce-ip"],
+                        help = "host this node is listed under in the node map")
+    parser.add_argument("--loglevel", choices = list(LEVELS), default = config["loglevel"],
+                        help = "least important messages written to the log")
+    parser.add_argument("--slowlog-log-slower-than", type = int, default = config["slowlog-log-slower-than"],
+                        help = "microseconds a command must take to be put in the slow log, negative disables it")
+    parser.add_argument("--slowlog-max-len", type = parse_nonnegative, default = config["slowlog-max-len"],
+                        help = "entries the slow log keeps")
+    parser.add_argument("--latency-tracking", choices = ["yes", "no"], default = config["latency-tracking"],
+                        help = "keep per-command latency histograms")
+    parser.add_argument("--tracking-table-max-keys", type = parse_nonnegative,
+                        default = config["tracking-table-max-keys"],
+                        help = "keys remembered for client-side caching, 0 for no limit")
     args = parser.parse_args()
+    config["client-output-high-water"] = args.client_output_high_water
+    config["maxmemory"] = args.maxmemory
+    config["maxmemory-policy"] = args.maxmemory_policy
+    config["maxmemory-samples"] = args.maxmemory_samples
+    config["dir"] = os.path.abspath(args.dir)
+    config["dbfilename"] = args.dbfilename
+    config["rdbcompression"] = args.rdbcompression
+    config["rdbchecksum"] = args.rdbchecksum
+    config["appendonly"] = args.appendonly
+    config["appendfilename"] = args.appendfilename
+    config["appendfsync"] = args.appendfsync
+    config["repl-backlog-size"] = args.repl_backlog_size
+    config["replica-read-only"] = args.replica_read_only
+    config["replica-max-lag"] = args.replica_max_lag
+    config["repl-ping-replica-period"] = args.repl_ping_replica_period
+    config["workers"] = args.workers
+    config["worker-routing"] = args.worker_routing
+    config["cluster-enabled"] = args.cluster_enabled
+    config["cluster-config-file"] = args.cluster_config_file
+    config["cluster-announce-ip"] = args.cluster_announce_ip
+    config["tracking-table-max-keys"] = args.tracking_table_max_keys
+    apply_config("loglevel", args.loglevel)
+    apply_config("slowlog-log-slower-than", args.slowlog_log_slower_than)
+    apply_config("slowlog-max-len", args.slowlog_max_len)
+    apply_config("latency-tracking", args.latency_tracking)
+    if args.client_output_buffer_limit:
+        output_buffer_limits.update(args.client_output_buffer_limit)
+        config["client-output-buffer-limit"] = " ".join(
+            f"{kind} {hard} {soft} {seconds}" for kind, (hard, soft, seconds) in output_buffer_limits.items())
     
     port = args.port
     is_master = args.replicaof is None
-
-    server_socket = socket.create_server(("localhost", port), reuse_port=True)
-    print(f"Server is running on localhost:{port} as {'master' if is_master else 'slave'}")
-
     if not is_master:
+        set_role("S")
         master_host, master_port = args.replicaof.split()
-        master_socket = connect_to_master(master_host, int(master_port), int(port))
+        replication["master_host"], replication["master_port"] = master_host, int(master_port)
+        replication["listening_port"] = port
+    if args.workers > 1:
+        if not is_master:
+            parser.error("--workers can't be combined with --replicaof")
+        if config["cluster-enabled"] == "yes":
+            parser.error("--workers can't be combined with --cluster-enabled")
+        try:
+            node_socket = start_workers(args.workers, port)
+        except OSError as e:
+            parser.error(f"can't listen on the worker ports: {e}")
+    elif config["cluster-enabled"] == "yes":
+        try:
+            load_cluster_config(os.path.join(config["dir"], config["cluster-config-file"]), port)
+        except (OSError, ValueError) as e:
+            parser.error(f"can't load the cluster node map: {e}")
 
-        #start a new thread to listen for commands from master
-        master_listener_thread = threading.Thread(target=listen_to_master, args=(master_socket,))
-        master_listener_thread.start()
+    load_dataset()
+    if config["appendonly"] == "yes":
+        open_append_only_file()
 
-    while True:
-        print("Waiting for a connection...")
-        # blocking line.
-        client_socket, addr = server_socket.accept()
-        print(f"Connection from {addr} has been established.")
+    server_sockets = [socket.create_server(("localhost", port), reuse_port=True)]
+    if config["workers"] > 1:
+        server_sockets.append(node_socket)
+    log(NOTICE, "Server is running on localhost:%d as %s (%s)", port, "master" if is_master else "slave", args.io_model)
 
-        #create and start a new thread to handle this client
-        client_thread = threading.Thread(target=handle_client, args=(client_socket, addr, is_master))
-        client_thread.start()
+    master_conn = None
+    timers.call_later(REPL_CRON_PERIOD, replication_cron)
+    timers.call_later(STATS_CRON_PERIOD, stats_cron)
+    if is_master:
+        timers.call_later(ACTIVE_EXPIRE_CYCLE_PERIOD, active_expire_cycle)
+    else:
+        try:
+            master_conn = connect_to_master(master_host, int(master_port), int(port))
+        except (OSError, ProtocolError, ValueError, rdb.RdbError) as e:
+            #keep serving reads and retry from the background; a corrupt transfer is retried too
+            log(WARNING, "Error connecting to master: %s", e)
+
+    if args.io_model == "threaded":
+        serve_threaded(server_sockets, is_master, master_conn)
+    else:
+        serve_eventloop(server_sockets, is_master, master_conn)
 
-        print(f"Active connections: {threading.active_count() - 1}")
 if __name__ == "__main__":
     main()
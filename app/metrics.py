@@ -0,0 +1,131 @@
+import collections
+
+SUB_BUCKET_BITS = 4 #16 buckets per power of two, so a bucket is at most ~6% wide
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+MAX_TRACKED_USEC = (1 << 36) - 1 #about 19 hours, slower calls are counted here
+
+def bucket_index(value):
+    #values below SUB_BUCKET_COUNT get a bucket each, every power of two above is split in SUB_BUCKET_COUNT
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return ((shift + 1) << SUB_BUCKET_BITS) + (value >> shift) - SUB_BUCKET_COUNT
+
+def bucket_highest(index):
+    #the largest value that lands in the bucket
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    sub = (index & (SUB_BUCKET_COUNT - 1)) + SUB_BUCKET_COUNT
+    return ((sub + 1) << shift) - 1
+
+class LatencyHistogram:
+    #log-linear buckets of microseconds, two significant digits like Redis' HdrHistogram
+
+    def __init__(self):
+        self.counts = [0] * (bucket_index(MAX_TRACKED_USEC) + 1)
+        self.total = 0
+
+    def record(self, usec):
+        index = usec
+        if usec >= SUB_BUCKET_COUNT:
+            #bucket_index() inlined, this runs once per command
+            usec = min(usec, MAX_TRACKED_USEC)
+            shift = usec.bit_length() - SUB_BUCKET_BITS - 1
+            index = ((shift + 1) << SUB_BUCKET_BITS) + (usec >> shift) - SUB_BUCKET_COUNT
+        self.counts[index] += 1
+        self.total += 1
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.total += other.total
+
+    def percentile(self, p):
+        #highest value of the bucket holding the p-th percentile, 0 when empty
+        if not self.total:
+            return 0
+        target = max(1, -(-self.total * p // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return bucket_highest(index)
+        return MAX_TRACKED_USEC
+
+    def cumulative_powers_of_two(self):
+        #(bound, calls faster than bound) for bound = 1, 2, 4... up to the slowest call
+        bound = 1
+        seen = 0
+        index = 0
+        while seen < self.total:
+            #powers of two fall on bucket boundaries, so this count is exact
+            end = bucket_index(bound)
+            while index < end:
+                seen += self.counts[index]
+                index += 1
+            if seen:
+                yield bound, seen
+            bound <<= 1
+
+class CommandStats:
+    __slots__ = ("calls", "usec", "rejected_calls", "failed_calls", "latency")
+
+    def __init__(self):
+        self.calls = 0
+        self.usec = 0
+        self.rejected_calls = 0 #refused before running: arity, subscribe mode, replica state...
+        self.failed_calls = 0 #ran and answered with an error
+        self.latency = LatencyHistogram()
+
+#what SLOWLOG keeps of a command's arguments, as in Redis
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+
+class SlowLog:
+    #the latest commands slower than the threshold, newest first
+
+    def __init__(self, max_len):
+        self.entries = collections.deque(maxlen = max_len)
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, args, started, usec, client):
+        if len(args) > SLOWLOG_ENTRY_MAX_ARGC:
+            kept = list(args[:SLOWLOG_ENTRY_MAX_ARGC - 1])
+            kept.append(b"... (%d more arguments)" % (len(args) - SLOWLOG_ENTRY_MAX_ARGC + 1))
+        else:
+            kept = list(args)
+        for i, arg in enumerate(kept):
+            if len(arg) > SLOWLOG_ENTRY_MAX_STRING:
+                kept[i] = arg[:SLOWLOG_ENTRY_MAX_STRING] + b"... (%d more bytes)" % (len(arg) - SLOWLOG_ENTRY_MAX_STRING)
+        self.entries.appendleft((self.next_id, int(started), usec, kept, client))
+        self.next_id += 1
+
+    def resize(self, max_len):
+        if max_len != self.entries.maxlen:
+            self.entries = collections.deque(self.entries, maxlen = max_len)
+
+    def reset(self):
+        self.entries.clear()
+
+INSTANTANEOUS_SAMPLES = 16
+
+class InstantaneousMetric:
+    #per-second rate of a growing counter, averaged over its last samples
+
+    def __init__(self):
+        self.samples = collections.deque(maxlen = INSTANTANEOUS_SAMPLES)
+        self.last_value = 0
+        self.last_time = None
+
+    def track(self, value, now):
+        if self.last_time is not None and now > self.last_time:
+            self.samples.append((value - self.last_value) / (now - self.last_time))
+        self.last_value = value
+        self.last_time = now
+
+    def rate(self):
+        return sum(self.samples) / len(self.samples) if self.samples else 0
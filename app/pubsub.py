@@ -0,0 +1,109 @@
+import re
+
+#bytes that end the literal prefix of a pattern
+GLOB_SPECIAL = b"*?[\\"
+
+def literal_prefix(pattern):
+    #every channel the pattern matches starts with the part before its first wildcard
+    for i, byte in enumerate(pattern):
+        if byte in GLOB_SPECIAL:
+            return pattern[:i]
+    return pattern
+
+def glob_to_regex(pattern):
+    #*, ?, [a-z], [^abc] and backslash escapes
+    out = []
+    i = 0
+    while i < len(pattern):
+        byte = pattern[i]
+        i += 1
+        if byte == ord("*"):
+            if not out or out[-1] != b".*":
+                out.append(b".*")
+        elif byte == ord("?"):
+            out.append(b".")
+        elif byte == ord("\\") and i < len(pattern):
+            out.append(b"\\x%02x" % pattern[i])
+            i += 1
+        elif byte == ord("["):
+            negate = i < len(pattern) and pattern[i] == ord("^")
+            if negate:
+                i += 1
+            members = []
+            #like Redis, an unterminated class runs to the end of the pattern
+            while i < len(pattern) and pattern[i] != ord("]"):
+                if pattern[i] == ord("\\") and i + 1 < len(pattern):
+                    i += 1
+                    members.append(b"\\x%02x" % pattern[i])
+                elif i + 2 < len(pattern) and pattern[i + 1] == ord("-") and pattern[i + 2] != ord("]"):
+                    low, high = sorted((pattern[i], pattern[i + 2]))
+                    members.append(b"\\x%02x-\\x%02x" % (low, high))
+                    i += 2
+                else:
+                    members.append(b"\\x%02x" % pattern[i])
+                i += 1
+            i += 1 #the closing ]
+            if members:
+                out.append(b"[" + (b"^" if negate else b"") + b"".join(members) + b"]")
+            elif negate:
+                out.append(b".") #[^] excludes nothing
+            else:
+                out.append(b"(?!)") #[] matches nothing
+        else:
+            out.append(b"\\x%02x" % byte)
+    return re.compile(b"".join(out), re.DOTALL)
+
+class PatternIndex:
+    #patterns grouped by literal prefix, a channel only tests those whose prefix it starts with
+
+    def __init__(self):
+        self.by_prefix = {} #prefix -> {pattern: (compiled regex, subscribers)}
+        self.lengths = {} #prefix length -> how many prefixes have it
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for group in self.by_prefix.values():
+            yield from group
+
+    def add(self, pattern, conn):
+        prefix = literal_prefix(pattern)
+        group = self.by_prefix.get(prefix)
+        if group is None:
+            group = self.by_prefix[prefix] = {}
+            self.lengths[len(prefix)] = self.lengths.get(len(prefix), 0) + 1
+        entry = group.get(pattern)
+        if entry is None:
+            entry = group[pattern] = (glob_to_regex(pattern), {})
+            self.count += 1
+        #a dict keeps subscribers in subscription order, which is the delivery order
+        entry[1][conn] = None
+
+    def remove(self, pattern, conn):
+        prefix = literal_prefix(pattern)
+        group = self.by_prefix[prefix]
+        subscribers = group[pattern][1]
+        del subscribers[conn]
+        if subscribers:
+            return
+        del group[pattern]
+        self.count -= 1
+        if group:
+            return
+        del self.by_prefix[prefix]
+        self.lengths[len(prefix)] -= 1
+        if not self.lengths[len(prefix)]:
+            del self.lengths[len(prefix)]
+
+    def matches(self, channel):
+        for length in self.lengths:
+            if length > len(channel):
+                continue
+            group = self.by_prefix.get(channel[:length])
+            if group is None:
+                continue
+            for pattern, (regex, subscribers) in group.items():
+                if regex.fullmatch(channel):
+                    yield pattern, subscribers
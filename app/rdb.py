@@ -0,0 +1,651 @@
+#RDB snapshots: collections are written in the plain encodings, Redis 7's compact ones are read too
+import mmap
+import os
+import signal
+import struct
+
+from app.datatypes import STREAM_SEQ_MASK, Hash, List, Set, Stream, ZSet, stream_id
+
+RDB_VERSION = 11
+
+OPCODE_FUNCTION2 = 0xF5
+OPCODE_MODULE_AUX = 0xF7
+OPCODE_IDLE = 0xF8
+OPCODE_FREQ = 0xF9
+OPCODE_AUX = 0xFA
+OPCODE_RESIZEDB = 0xFB
+OPCODE_EXPIRETIME_MS = 0xFC
+OPCODE_EXPIRETIME = 0xFD
+OPCODE_SELECTDB = 0xFE
+OPCODE_EOF = 0xFF
+
+TYPE_STRING = 0
+TYPE_LIST = 1
+TYPE_SET = 2
+TYPE_ZSET = 3
+TYPE_HASH = 4
+TYPE_ZSET_2 = 5
+TYPE_SET_INTSET = 11
+TYPE_HASH_LISTPACK = 16
+TYPE_ZSET_LISTPACK = 17
+TYPE_LIST_QUICKLIST_2 = 18
+TYPE_SET_LISTPACK = 20
+TYPE_STREAM_LISTPACKS = 15
+TYPE_STREAM_LISTPACKS_2 = 19
+TYPE_STREAM_LISTPACKS_3 = 21
+
+#flags of an entry in a stream listpack
+STREAM_ITEM_FLAG_DELETED = 1
+STREAM_ITEM_FLAG_SAMEFIELDS = 2
+
+QUICKLIST_NODE_PLAIN = 1
+
+LEN_6BIT = 0
+LEN_14BIT = 1
+LEN_32BIT = 0x80
+LEN_64BIT = 0x81
+ENC_INT8 = 0
+ENC_INT16 = 1
+ENC_INT32 = 2
+ENC_LZF = 3
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+class RdbError(Exception):
+    pass
+
+#CRC-64/Jones as used by Redis (reflected, poly 0xad93d23594c935a9). A byte loop runs at a
+#few MB/s in Python, so each chunk is instead read as one big polynomial (bytes bit-reversed
+#into normal order) and reduced with a handful of whole-number shifts and xors
+CRC64_POLY = (1 << 64) | 0xAD93D23594C935A9
+CRC64_CHUNK = 1 << 18 #bytes reduced at once
+CRC64_SMALL = 192 #bits under which the reduction goes bit by bit
+BIT_REVERSED = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+x_pow_mod_cache = {}
+
+def _clmul(a, b):
+    #carry-less product; b is at most 64 bits, a may be huge
+    if a.bit_length() <= 4096:
+        result = 0
+        while b:
+            low = b & -b
+            result ^= a << (low.bit_length() - 1)
+            b ^= low
+        return result
+    #one shift and xor per nibble of b, from the products of a with every nibble
+    t = [0, a, a << 1, 0, a << 2, 0, 0, 0, a << 3]
+    t[3], t[5], t[6] = t[2] ^ a, t[4] ^ a, t[4] ^ t[2]
+    t[7] = t[6] ^ a
+    t += [t[8] ^ t[i] for i in range(1, 8)]
+    result = 0
+    shift = 0
+    while b:
+        if b & 15:
+            result ^= t[b & 15] << shift
+        b >>= 4
+        shift += 4
+    return result
+
+def _small_mod(a):
+    for shift in range(a.bit_length() - 65, -1, -1):
+        if a >> (shift + 64) & 1:
+            a ^= CRC64_POLY << shift
+    return a
+
+def _x_pow_mod(k):
+    #x^k mod the polynomial
+    result = x_pow_mod_cache.get(k)
+    if result is None:
+        if k < CRC64_SMALL:
+            result = _small_mod(1 << k)
+        else:
+            half = _x_pow_mod(k // 2)
+            result = _small_mod(_clmul(half, half) << (k & 1))
+        x_pow_mod_cache[k] = result
+    return result
+
+def _poly_mod(a):
+    #fold the top half onto the bottom one: a = h * x^k + l = h * (x^k mod poly) + l
+    while a.bit_length() > CRC64_SMALL:
+        k = a.bit_length() // 2
+        a = _clmul(a >> k, _x_pow_mod(k)) ^ (a & ((1 << k) - 1))
+    return _small_mod(a)
+
+def _reflect64(value):
+    return int(f"{value:064b}"[::-1], 2)
+
+def crc64(crc, data):
+    view = memoryview(data).cast("B")
+    #the register after a chunk of n bytes is (register * x^8n + chunk * x^64) mod poly
+    register = _reflect64(crc)
+    for start in range(0, len(view), CRC64_CHUNK):
+        chunk = view[start:start + CRC64_CHUNK]
+        message = int.from_bytes(chunk.tobytes().translate(BIT_REVERSED), "big")
+        register = _poly_mod((register << 8 * len(chunk)) ^ (message << 64))
+    return _reflect64(register)
+
+def lzf_compress(data):
+    #None if it doesn't shrink
+    length = len(data)
+    if length < 4:
+        return None
+    out = bytearray()
+    table = {}
+    literal_start = 0
+    i = 0
+    while i < length - 2:
+        triple = data[i:i + 3]
+        ref = table.get(triple)
+        table[triple] = i
+        offset = i - ref - 1 if ref is not None else 8192
+        if offset >= 8192:
+            i += 1
+            continue
+        match = 3
+        limit = min(264, length - i)
+        while match < limit and data[ref + match] == data[i + match]:
+            match += 1
+        _lzf_literals(out, data, literal_start, i)
+        code = match - 2
+        if code < 7:
+            out.append((code << 5) | (offset >> 8))
+        else:
+            out.append((7 << 5) | (offset >> 8))
+            out.append(code - 7)
+        out.append(offset & 0xFF)
+        i += match
+        literal_start = i
+        if len(out) >= length:
+            return None
+    _lzf_literals(out, data, literal_start, length)
+    return bytes(out) if len(out) < length else None
+
+def _lzf_literals(out, data, start, end):
+    while start < end:
+        run = min(32, end - start)
+        out.append(run - 1)
+        out += data[start:start + run]
+        start += run
+
+def lzf_decompress(data, expected_length):
+    out = bytearray()
+    i = 0
+    length = len(data)
+    while i < length:
+        ctrl = data[i]
+        i += 1
+        if ctrl < 32:
+            out += data[i:i + ctrl + 1]
+            i += ctrl + 1
+            continue
+        run = ctrl >> 5
+        if run == 7:
+            run += data[i]
+            i += 1
+        ref = len(out) - ((ctrl & 0x1F) << 8) - data[i] - 1
+        i += 1
+        run += 2
+        if ref < 0:
+            raise RdbError("invalid LZF back reference")
+        if ref + run <= len(out):
+            out += out[ref:ref + run]
+        else:
+            #overlapping copy repeats the bytes being produced
+            for k in range(run):
+                out.append(out[ref + k])
+    if len(out) != expected_length:
+        raise RdbError("LZF payload has the wrong length")
+    return bytes(out)
+
+class RdbWriter:
+    #writes through a 1 MiB buffer, keeping a running CRC64
+
+    def __init__(self, fileobj, checksum = True, compression = False):
+        self.file = fileobj
+        self.checksum = checksum
+        self.compression = compression
+        self.crc = 0
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= WRITE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.checksum:
+            self.crc = crc64(self.crc, self.buffer)
+        self.file.write(self.buffer)
+        self.buffer.clear()
+
+    def write_header(self, aux):
+        self.write(b"REDIS%04d" % RDB_VERSION)
+        for name, value in aux.items():
+            self.write(bytes((OPCODE_AUX,)))
+            self.write_string(name)
+            self.write_string(value)
+
+    def select_db(self, db, size, expires_size):
+        self.write(bytes((OPCODE_SELECTDB,)))
+        self.write_length(db)
+        self.write(bytes((OPCODE_RESIZEDB,)))
+        self.write_length(size)
+        self.write_length(expires_size)
+
+    def write_length(self, length):
+        if length < 1 << 6:
+            self.write(bytes((length,)))
+        elif length < 1 << 14:
+            self.write(bytes(((LEN_14BIT << 6) | (length >> 8), length & 0xFF)))
+        elif length <= 0xFFFFFFFF:
+            self.write(bytes((LEN_32BIT,)) + struct.pack(">I", length))
+        else:
+            self.write(bytes((LEN_64BIT,)) + struct.pack(">Q", length))
+
+    def write_string(self, value):
+        if isinstance(value, int):
+            if -(1 << 7) <= value < 1 << 7:
+                self.write(bytes((0xC0 | ENC_INT8,)) + struct.pack("<b", value))
+                return
+            if -(1 << 15) <= value < 1 << 15:
+                self.write(bytes((0xC0 | ENC_INT16,)) + struct.pack("<h", value))
+                return
+            if -(1 << 31) <= value < 1 << 31:
+                self.write(bytes((0xC0 | ENC_INT32,)) + struct.pack("<i", value))
+                return
+            value = b"%d" % value
+        elif isinstance(value, str):
+            value = value.encode()
+        if self.compression and len(value) > 20:
+            compressed = lzf_compress(value)
+            if compressed is not None:
+                self.write(bytes((0xC0 | ENC_LZF,)))
+                self.write_length(len(compressed))
+                self.write_length(len(value))
+                self.write(compressed)
+                return
+        self.write_length(len(value))
+        self.write(value)
+
+    def write_entry(self, key, value, expire_ms = None):
+        if expire_ms is not None:
+            self.write(bytes((OPCODE_EXPIRETIME_MS,)) + struct.pack("<q", expire_ms))
+        if isinstance(value, (bytes, int)):
+            self.write(bytes((TYPE_STRING,)))
+            self.write_string(key)
+            self.write_string(value)
+        elif isinstance(value, Hash):
+            self.write(bytes((TYPE_HASH,)))
+            self.write_string(key)
+            self.write_length(len(value))
+            for field, item in value.items():
+                self.write_string(field)
+                self.write_string(item)
+        elif isinstance(value, ZSet):
+            self.write(bytes((TYPE_ZSET_2,)))
+            self.write_string(key)
+            self.write_length(len(value))
+            for member, score in value.items():
+                self.write_string(member)
+                self.write(struct.pack("<d", score))
+        elif isinstance(value, Stream):
+            self.write(bytes((TYPE_STREAM_LISTPACKS_3,)))
+            self.write_string(key)
+            self.write_stream(value)
+        else:
+            #lists and sets are both a count followed by the elements
+            self.write(bytes((TYPE_LIST if isinstance(value, List) else TYPE_SET,)))
+            self.write_string(key)
+            self.write_length(len(value))
+            for item in value:
+                self.write_string(item)
+
+    def write_stream(self, stream):
+        #one listpack per block, keyed by its first ID as 128 big-endian bits; each
+        #entry's ID is stored as a difference from that one
+        self.write_length(len(stream.blocks))
+        for block in stream.blocks:
+            master_id = block.ids[0]
+            master_fields = block.entries[0][::2]
+            elements = [len(block.ids), 0, len(master_fields), *master_fields, 0]
+            for sid, fields in zip(block.ids, block.entries):
+                head = [(sid >> 64) - (master_id >> 64), (sid & STREAM_SEQ_MASK) - (master_id & STREAM_SEQ_MASK)]
+                if fields[::2] == master_fields:
+                    elements += [STREAM_ITEM_FLAG_SAMEFIELDS, *head, *fields[1::2], len(master_fields) + 3]
+                else:
+                    elements += [0, *head, len(fields) // 2, *fields, len(fields) + 4]
+            self.write_string(struct.pack(">QQ", master_id >> 64, master_id & STREAM_SEQ_MASK))
+            self.write_string(listpack_encode(elements))
+        self.write_length(len(stream))
+        for sid in (stream.last_id, stream.first_id, stream.max_deleted_id):
+            self.write_length(sid >> 64)
+            self.write_length(sid & STREAM_SEQ_MASK)
+        self.write_length(stream.entries_added)
+        self.write_length(0) #consumer groups
+
+    def finish(self):
+        self.write(bytes((OPCODE_EOF,)))
+        self.flush()
+        #the checksum itself is not part of the checksummed data; 0 means "not computed"
+        self.file.write(struct.pack("<Q", self.crc if self.checksum else 0))
+
+class RdbReader:
+    #strings are copied out one at a time, so a mapped file is never held twice
+
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.pos = 0
+        self.aux = {}
+
+    def read(self, n):
+        end = self.pos + n
+        if end > len(self.view):
+            raise RdbError("unexpected end of RDB data")
+        chunk = self.view[self.pos:end]
+        self.pos = end
+        return chunk
+
+    def read_byte(self):
+        if self.pos >= len(self.view):
+            raise RdbError("unexpected end of RDB data")
+        byte = self.view[self.pos]
+        self.pos += 1
+        return byte
+
+    def read_length(self):
+        #(length, is_encoded), encoded lengths carry a special string format
+        first = self.read_byte()
+        kind = first >> 6
+        if kind == LEN_6BIT:
+            return first & 0x3F, False
+        if kind == LEN_14BIT:
+            return ((first & 0x3F) << 8) | self.read_byte(), False
+        if first == LEN_32BIT:
+            return struct.unpack(">I", self.read(4))[0], False
+        if first == LEN_64BIT:
+            return struct.unpack(">Q", self.read(8))[0], False
+        if kind == 3:
+            return first & 0x3F, True
+        raise RdbError(f"invalid length encoding {first:#x}")
+
+    def read_string(self):
+        #bytes, or an int for integer-encoded strings
+        length, encoded = self.read_length()
+        if not encoded:
+            return self.read(length).tobytes()
+        if length == ENC_INT8:
+            return struct.unpack("<b", self.read(1))[0]
+        if length == ENC_INT16:
+            return struct.unpack("<h", self.read(2))[0]
+        if length == ENC_INT32:
+            return struct.unpack("<i", self.read(4))[0]
+        if length == ENC_LZF:
+            compressed_length, _ = self.read_length()
+            original_length, _ = self.read_length()
+            return lzf_decompress(self.read(compressed_length), original_length)
+        raise RdbError(f"unknown string encoding {length}")
+
+    def read_element(self):
+        value = self.read_string()
+        return b"%d" % value if isinstance(value, int) else value
+
+    def read_string_double(self):
+        #old sorted sets store scores as text after a length byte, with 253-255 meaning nan, inf and -inf
+        length = self.read_byte()
+        if length >= 253:
+            return (float("nan"), float("inf"), float("-inf"))[length - 253]
+        return float(self.read(length).tobytes())
+
+    def read_value(self, value_type):
+        if value_type == TYPE_STRING:
+            return self.read_string()
+        if value_type == TYPE_LIST:
+            return List([self.read_element() for _ in range(self.read_length()[0])])
+        if value_type == TYPE_SET:
+            return Set(self.read_element() for _ in range(self.read_length()[0]))
+        if value_type == TYPE_HASH:
+            return Hash.from_pairs((self.read_element(), self.read_element()) for _ in range(self.read_length()[0]))
+        if value_type == TYPE_ZSET_2:
+            return ZSet.from_items((self.read_element(), struct.unpack("<d", self.read(8))[0])
+                                   for _ in range(self.read_length()[0]))
+        if value_type == TYPE_ZSET:
+            return ZSet.from_items((self.read_element(), self.read_string_double())
+                                   for _ in range(self.read_length()[0]))
+        if value_type == TYPE_SET_INTSET:
+            return Set(b"%d" % member for member in intset_members(self.read_string()))
+        if value_type == TYPE_SET_LISTPACK:
+            return Set(listpack_entries(self.read_string()))
+        if value_type == TYPE_HASH_LISTPACK:
+            entries = listpack_entries(self.read_string())
+            return Hash.from_pairs(zip(entries[::2], entries[1::2]))
+        if value_type == TYPE_ZSET_LISTPACK:
+            entries = listpack_entries(self.read_string())
+            return ZSet.from_items(zip(entries[::2], map(float, entries[1::2])))
+        if value_type == TYPE_LIST_QUICKLIST_2:
+            items = []
+            for _ in range(self.read_length()[0]):
+                container = self.read_length()[0]
+                node = self.read_element()
+                if container == QUICKLIST_NODE_PLAIN:
+                    items.append(node)
+                else:
+                    items += listpack_entries(node)
+            return List(items)
+        if value_type in (TYPE_STREAM_LISTPACKS, TYPE_STREAM_LISTPACKS_2, TYPE_STREAM_LISTPACKS_3):
+            return self.read_stream(value_type)
+        raise RdbError(f"unsupported value type {value_type}")
+
+    def read_stream(self, value_type):
+        stream = Stream()
+        for _ in range(self.read_length()[0]):
+            master_ms, master_seq = struct.unpack(">QQ", self.read_element())
+            elements = listpack_entries(self.read_element())
+            master_fields = elements[3:3 + int(elements[2])]
+            pos = 4 + len(master_fields) #past the master entry's terminating 0
+            while pos < len(elements):
+                flags, ms_diff, seq_diff = int(elements[pos]), int(elements[pos + 1]), int(elements[pos + 2])
+                pos += 3
+                if flags & STREAM_ITEM_FLAG_SAMEFIELDS:
+                    values = elements[pos:pos + len(master_fields)]
+                    fields = [item for pair in zip(master_fields, values) for item in pair]
+                else:
+                    count = int(elements[pos])
+                    fields = elements[pos + 1:pos + 1 + 2 * count]
+                pos += len(fields) // 2 if flags & STREAM_ITEM_FLAG_SAMEFIELDS else len(fields) + 1
+                pos += 1 #lp-count
+                if not flags & STREAM_ITEM_FLAG_DELETED:
+                    stream.append(stream_id(master_ms + ms_diff, master_seq + seq_diff), fields)
+        self.read_length() #length, implied by the entries
+        last_ms, last_seq = self.read_length()[0], self.read_length()[0]
+        stream.last_id = stream_id(last_ms, last_seq)
+        if value_type != TYPE_STREAM_LISTPACKS:
+            self.read_length() #first ID, implied by the entries
+            self.read_length()
+            max_deleted_ms, max_deleted_seq = self.read_length()[0], self.read_length()[0]
+            stream.max_deleted_id = stream_id(max_deleted_ms, max_deleted_seq)
+            stream.entries_added = self.read_length()[0]
+        if self.read_length()[0]:
+            raise RdbError("stream consumer groups are not supported")
+        return stream
+
+    def entries(self):
+        #(key, value, expire_ms or None) for every key
+        magic = self.read(9).tobytes()
+        if magic[:5] != b"REDIS" or not magic[5:].isdigit():
+            raise RdbError("not an RDB file")
+        if int(magic[5:]) > RDB_VERSION:
+            raise RdbError(f"can't handle RDB format version {int(magic[5:])}")
+        expire_ms = None
+        while True:
+            opcode = self.read_byte()
+            if opcode == OPCODE_EOF:
+                return
+            if opcode == OPCODE_AUX:
+                name = self.read_string()
+                self.aux[name] = self.read_string()
+            elif opcode == OPCODE_SELECTDB:
+                self.read_length()
+            elif opcode == OPCODE_RESIZEDB:
+                self.read_length()
+                self.read_length()
+            elif opcode == OPCODE_EXPIRETIME_MS:
+                expire_ms = struct.unpack("<q", self.read(8))[0]
+            elif opcode == OPCODE_EXPIRETIME:
+                expire_ms = struct.unpack("<i", self.read(4))[0] * 1000
+            elif opcode == OPCODE_IDLE:
+                self.read_length()
+            elif opcode == OPCODE_FREQ:
+                self.read_byte()
+            elif opcode in (OPCODE_FUNCTION2, OPCODE_MODULE_AUX):
+                raise RdbError("functions and modules are not supported")
+            else:
+                key = self.read_string()
+                if isinstance(key, int):
+                    key = b"%d" % key
+                yield key, self.read_value(opcode), expire_ms
+                expire_ms = None
+
+    def stored_checksum(self):
+        if len(self.view) - self.pos < 8:
+            return 0 #RDB versions before 5 have no checksum
+        return struct.unpack("<Q", self.view[self.pos:self.pos + 8])[0]
+
+def listpack_entries(blob):
+    #the backwards length after each entry only matters walking from the end, so it is skipped
+    if len(blob) < 7:
+        raise RdbError("truncated listpack")
+    view = memoryview(blob)
+    entries = []
+    pos = 6 #32-bit total size and 16-bit element count
+    while True:
+        if pos >= len(view):
+            raise RdbError("listpack without terminator")
+        first = view[pos]
+        if first == 0xFF:
+            return entries
+        if first < 0x80: #7-bit unsigned integer
+            value, size = first, 1
+        elif first < 0xC0: #string up to 63 bytes
+            length = first & 0x3F
+            value, size = view[pos + 1:pos + 1 + length].tobytes(), 1 + length
+        elif first < 0xE0: #13-bit signed integer
+            value = ((first & 0x1F) << 8) | view[pos + 1]
+            value, size = value - (1 << 13) if value >= 1 << 12 else value, 2
+        elif first < 0xF0: #string up to 4095 bytes
+            length = ((first & 0x0F) << 8) | view[pos + 1]
+            value, size = view[pos + 2:pos + 2 + length].tobytes(), 2 + length
+        elif first == 0xF0: #string with a 32-bit length
+            length = struct.unpack_from("<I", view, pos + 1)[0]
+            value, size = view[pos + 5:pos + 5 + length].tobytes(), 5 + length
+        elif first <= 0xF4: #16, 24, 32 or 64-bit signed integer
+            width = (2, 3, 4, 8)[first - 0xF1]
+            value = int.from_bytes(view[pos + 1:pos + 1 + width], "little", signed = True)
+            size = 1 + width
+        else:
+            raise RdbError(f"invalid listpack encoding {first:#x}")
+        entries.append(b"%d" % value if isinstance(value, int) else value)
+        pos += size + listpack_backlen_size(size)
+
+def listpack_backlen_size(size):
+    #bytes of the backwards length, 7 bits of it per byte
+    return 1 if size <= 127 else 2 if size < 16383 else 3 if size < 2097151 else 4 if size < 268435455 else 5
+
+def listpack_encode(elements):
+    out = bytearray()
+    for element in elements:
+        if isinstance(element, int):
+            if 0 <= element <= 127:
+                entry = bytes((element,))
+            elif -4096 <= element <= 4095:
+                element &= 0x1FFF
+                entry = bytes((0xC0 | element >> 8, element & 0xFF))
+            else:
+                width = next(width for width in (2, 3, 4, 8) if -(1 << 8 * width - 1) <= element < 1 << 8 * width - 1)
+                entry = bytes((0xF1 + (2, 3, 4, 8).index(width),)) + element.to_bytes(width, "little", signed = True)
+        elif len(element) <= 63:
+            entry = bytes((0x80 | len(element),)) + element
+        elif len(element) <= 4095:
+            entry = bytes((0xE0 | len(element) >> 8, len(element) & 0xFF)) + element
+        else:
+            entry = b"\xf0" + struct.pack("<I", len(element)) + element
+        size = len(entry)
+        backlen = bytearray()
+        for shift in range(7 * (listpack_backlen_size(size) - 1), -1, -7):
+            backlen.append((size >> shift) & 0x7F | (0x80 if shift != 7 * (listpack_backlen_size(size) - 1) else 0))
+        out += entry
+        out += backlen
+    header = struct.pack("<IH", 6 + len(out) + 1, min(len(elements), 0xFFFF))
+    return header + bytes(out) + b"\xff"
+
+def intset_members(blob):
+    #a sorted array of 2, 4 or 8-byte little-endian integers after a two-field header
+    width, count = struct.unpack_from("<II", blob)
+    if width not in (2, 4, 8) or len(blob) < 8 + width * count:
+        raise RdbError("invalid intset")
+    return struct.unpack_from("<%d%s" % (count, {2: "h", 4: "i", 8: "q"}[width]), blob, 8)
+
+def dump(fileobj, entries, aux, db_size, expires_size, checksum = True, compression = False):
+    writer = RdbWriter(fileobj, checksum, compression)
+    writer.write_header(aux)
+    writer.select_db(0, db_size, expires_size)
+    for key, value, expire_ms in entries:
+        writer.write_entry(key, value, expire_ms)
+    writer.finish()
+
+def load_file(path, verify_checksum = True, aux = None):
+    #a forked child checks the CRC64 while we parse; RdbError after the last entry if it doesn't match
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            raise RdbError("empty RDB file")
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mapped:
+            checker = _start_checksum(mapped, size - 8) if verify_checksum and size > 8 else None
+            reader = RdbReader(mapped)
+            try:
+                yield from reader.entries()
+                stored = reader.stored_checksum()
+            except BaseException:
+                _abort_checksum(checker)
+                raise
+            finally:
+                reader.view.release()
+            computed = _finish_checksum(checker)
+            if computed is not None and stored and computed != stored:
+                raise RdbError("RDB checksum mismatch")
+            if aux is not None:
+                aux.update(reader.aux)
+
+def _start_checksum(mapped, length):
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            os.write(write_fd, struct.pack("<Q", crc64(0, memoryview(mapped)[:length])))
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    return pid, read_fd
+
+def _abort_checksum(checker):
+    if checker is None:
+        return
+    pid, read_fd = checker
+    os.close(read_fd)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+def _finish_checksum(checker):
+    if checker is None:
+        return None
+    pid, read_fd = checker
+    try:
+        data = os.read(read_fd, 8)
+    finally:
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+    if len(data) != 8:
+        raise RdbError("checksum verification failed")
+    return struct.unpack("<Q", data)[0]
@@ -0,0 +1,208 @@
+#an inline command or a multibulk header longer than this without a newline is garbage
+MAX_INLINE_SIZE = 64 * 1024
+#largest bulk argument accepted, like proto-max-bulk-len, so a bogus length cannot make us buffer forever
+MAX_BULK_LEN = 512 * 1024 * 1024
+
+OK = b"+OK\r\n"
+PONG = b"+PONG\r\n"
+NULL_BULK = b"$-1\r\n"
+NULL_ARRAY = b"*-1\r\n"
+NULL = b"_\r\n" #RESP3
+
+class ProtocolError(Exception):
+    pass
+
+class RespParser:
+    #bulks are located from their length, never scanned, and a partial multibulk keeps its parsed arguments
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.args = None      # arguments of the multibulk being read
+        self.remaining = 0    # arguments still missing from it
+        self.bulk_len = -1    # length of a bulk whose header was already consumed
+        self.base = 0         # bytes dropped from the front of buffer so far
+
+    def feed(self, data):
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.base += self.pos
+            self.pos = 0
+        self.buffer += data
+
+    def consumed(self):
+        return self.base + self.pos
+
+    def __iter__(self):
+        while True:
+            args = self.next_command()
+            if args is None:
+                return
+            yield args
+
+    def pending(self):
+        return len(self.buffer) - self.pos
+
+    def next_command(self):
+        #None until a whole command is buffered
+        buf = self.buffer
+        while self.args is None:
+            if self.pos >= len(buf):
+                return None
+            end = self._find_line(buf)
+            if end < 0:
+                return None
+            if buf[self.pos] != ord("*"):
+                args = bytes(buf[self.pos:end]).split()
+                self.pos = end + 2
+                if args:
+                    return args
+                continue
+            count = self._parse_int(buf, self.pos + 1, end, "invalid multibulk length")
+            self.pos = end + 2
+            if count > 0:
+                self.args = []
+                self.remaining = count
+
+        with memoryview(buf) as view:
+            while self.remaining:
+                if self.bulk_len < 0:
+                    if self.pos >= len(buf):
+                        return None
+                    end = self._find_line(buf)
+                    if end < 0:
+                        return None
+                    if buf[self.pos] != ord("$"):
+                        raise ProtocolError(f"expected '$', got '{chr(buf[self.pos])}'")
+                    self.bulk_len = self._parse_int(buf, self.pos + 1, end, "invalid bulk length")
+                    if self.bulk_len < 0 or self.bulk_len > MAX_BULK_LEN:
+                        raise ProtocolError("invalid bulk length")
+                    self.pos = end + 2
+                end = self.pos + self.bulk_len
+                if len(buf) < end + 2:
+                    return None
+                self.args.append(view[self.pos:end].tobytes())
+                self.pos = end + 2
+                self.bulk_len = -1
+                self.remaining -= 1
+
+        args, self.args = self.args, None
+        return args
+
+    def next_line(self):
+        #replies on the master link
+        end = self.buffer.find(b"\r\n", self.pos)
+        if end < 0:
+            return None
+        line = bytes(self.buffer[self.pos:end])
+        self.pos = end + 2
+        return line
+
+    def next_reply(self):
+        #for links relaying replies verbatim: aggregates are walked, never decoded
+        buf = self.buffer
+        pos = self.pos
+        missing = 1 #replies (or aggregate elements) still to skip
+        while missing:
+            end = buf.find(b"\r\n", pos)
+            if end < 0:
+                return None
+            kind = buf[pos]
+            missing -= 1
+            if kind in b"$=!":
+                length = self._parse_int(buf, pos + 1, end, "invalid bulk length")
+                pos = end + 2
+                if length >= 0:
+                    if len(buf) < pos + length + 2:
+                        return None
+                    pos += length + 2
+            elif kind in b"*~>%":
+                count = self._parse_int(buf, pos + 1, end, "invalid multibulk length")
+                missing += max(count, 0) * (2 if kind == ord("%") else 1)
+                pos = end + 2
+            else:
+                pos = end + 2
+        reply = bytes(buf[self.pos:pos])
+        self.pos = pos
+        return reply
+
+    def take(self, count):
+        #raw bytes for payloads streamed past the parser
+        data = bytes(self.buffer[self.pos:self.pos + count])
+        self.pos += len(data)
+        return data
+
+    def _find_line(self, buf):
+        end = buf.find(b"\r\n", self.pos)
+        if end < 0 and len(buf) - self.pos > MAX_INLINE_SIZE:
+            raise ProtocolError("too big inline request")
+        return end
+
+    @staticmethod
+    def _parse_int(buf, start, end, message):
+        try:
+            return int(buf[start:end])
+        except ValueError:
+            raise ProtocolError(message) from None
+
+class SimpleString(bytes):
+    pass #a +status reply decoded by decode_reply()
+
+class ErrorReply(bytes):
+    pass #a -error reply decoded by decode_reply()
+
+def decode_reply(data):
+    #one reply from this server as Python values, for scripts and the benchmark
+    value, _ = _decode_at(data, 0)
+    return value
+
+def _decode_at(data, pos):
+    end = data.index(b"\r\n", pos)
+    kind, line = data[pos:pos + 1], data[pos + 1:end]
+    pos = end + 2
+    if kind == b"+":
+        return SimpleString(line), pos
+    if kind == b"-":
+        return ErrorReply(line), pos
+    if kind == b":":
+        return int(line), pos
+    if kind == b"_":
+        return None, pos
+    if kind == b"$":
+        length = int(line)
+        if length < 0:
+            return None, pos
+        return data[pos:pos + length], pos + length + 2
+    if kind in b"*>":
+        count = int(line)
+        if count < 0:
+            return None, pos
+        items = []
+        for _ in range(count):
+            item, pos = _decode_at(data, pos)
+            items.append(item)
+        return items, pos
+    raise ProtocolError(f"unexpected reply type {kind!r}")
+
+def encode_bulk(value):
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+def encode_error(message):
+    return b"-" + message.encode() + b"\r\n"
+
+def encode_integer(value):
+    return b":%d\r\n" % value
+
+def encode_array(items):
+    return b"*%d\r\n" % len(items) + b"".join(items)
+
+def encode_push(items):
+    #RESP3 out-of-band message
+    return b">%d\r\n" % len(items) + b"".join(items)
+
+def encode_map(pairs):
+    #RESP3 map of encoded (key, value) pairs
+    return b"%%%d\r\n" % len(pairs) + b"".join(key + value for key, value in pairs)
+
+def encode_command(args):
+    return encode_array([encode_bulk(arg) for arg in args])
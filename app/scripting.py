@@ -0,0 +1,269 @@
+#EVAL scripts: a restricted subset of Python, checked against an allow-list and compiled once;
+#the body of a function given KEYS and ARGV that calls commands with call()/pcall()
+import ast
+import hashlib
+
+from app.resp import (
+    NULL_BULK, ErrorReply, SimpleString, decode_reply, encode_array, encode_bulk, encode_error, encode_integer,
+)
+
+class ScriptError(Exception):
+    pass #the message is the error reply, without its '-'
+
+#statement and expression nodes a script may contain
+ALLOWED_NODES = frozenset([
+    ast.Module, ast.Expr, ast.Assign, ast.AugAssign, ast.If, ast.For, ast.While, ast.Break, ast.Continue,
+    ast.Return, ast.Pass, ast.Delete,
+    ast.BoolOp, ast.And, ast.Or, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod,
+    ast.Pow, ast.LShift, ast.RShift, ast.BitOr, ast.BitXor, ast.BitAnd, ast.UnaryOp, ast.Not, ast.USub,
+    ast.UAdd, ast.Invert, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.In,
+    ast.NotIn, ast.Is, ast.IsNot, ast.IfExp, ast.Call, ast.Name, ast.Load, ast.Store, ast.Del,
+    ast.Constant, ast.List, ast.Tuple, ast.Dict, ast.Subscript, ast.Slice, ast.Starred, ast.Attribute,
+    ast.ListComp, ast.DictComp, ast.comprehension, ast.JoinedStr, ast.FormattedValue,
+])
+#methods a script may call on the values it handles
+ALLOWED_ATTRIBUTES = frozenset([
+    "split", "join", "upper", "lower", "strip", "startswith", "endswith", "replace", "find",
+    "append", "extend", "insert", "pop", "index", "count", "get", "keys", "values", "items",
+])
+#parameters of the function a script is compiled into
+SCRIPT_PARAMETERS = ("KEYS", "ARGV", "call", "pcall", "status_reply", "error_reply")
+TICK_INTERVAL = 1024 #loop iterations between two checks of the script's running time
+MAX_RANGE_LENGTH = 10 ** 7 #longest range, list or tuple a script may build in one step
+MAX_STRING_LENGTH = 512 * 1024 * 1024 #longest string likewise, the largest bulk a client may send
+MAX_INT_BITS = 64 * 1024 #largest integer ** * and << may produce
+SEQUENCE_TYPES = (str, bytes, list, tuple)
+
+#the tick() of the script running now, see run_script()
+running = {"tick": None, "count": 0}
+
+class StatusReply(str):
+    pass #returned as a status, so call("SET", ...) == "OK"
+
+class ErrorString(str):
+    pass #what pcall() returns for a failed command
+
+def tick_once():
+    count = running["count"] = running["count"] + 1
+    if not count % TICK_INTERVAL:
+        running["tick"]()
+
+def ticks(iterable):
+    for item in iterable:
+        count = running["count"] = running["count"] + 1
+        if not count % TICK_INTERVAL:
+            running["tick"]()
+        yield item
+
+def counted(function):
+    #a builtin consuming an iterable gets it through ticks(), so sum(range(10 ** 12)) can be stopped
+    def wrapper(*args, **kwargs):
+        if args and not isinstance(args[0], dict) and (len(args) == 1 or function is sum):
+            args = (ticks(args[0]),) + args[1:]
+        return function(*args, **kwargs)
+    return wrapper
+
+def checked_range(*args):
+    values = range(*args)
+    try:
+        too_long = len(values) > MAX_RANGE_LENGTH
+    except OverflowError:
+        too_long = True
+    if too_long:
+        raise ScriptError(f"ERR Error running script: range() longer than {MAX_RANGE_LENGTH} items")
+    return values
+
+def check_length(sample, length):
+    #length of a str, bytes, list or tuple like sample about to be built
+    limit = MAX_STRING_LENGTH if isinstance(sample, (str, bytes)) else MAX_RANGE_LENGTH
+    if length > limit:
+        raise ScriptError(f"ERR Error running script: {type(sample).__name__} longer than {limit} items")
+
+def check_int_bits(bits):
+    if bits > MAX_INT_BITS:
+        raise ScriptError(f"ERR Error running script: integer larger than {MAX_INT_BITS} bits")
+
+def checked_add(left, right):
+    #a few iterations of s = s + s need no loop ticks to exhaust memory
+    if type(left) is not int and isinstance(left, SEQUENCE_TYPES) and isinstance(right, SEQUENCE_TYPES):
+        check_length(left, len(left) + len(right))
+    return left + right
+
+def checked_mul(left, right):
+    if type(left) is int and type(right) is int:
+        check_int_bits(left.bit_length() + right.bit_length())
+        return left * right
+    if isinstance(right, SEQUENCE_TYPES):
+        left, right = right, left
+    if isinstance(left, SEQUENCE_TYPES) and isinstance(right, int):
+        check_length(left, len(left) * right)
+    elif isinstance(left, int) and isinstance(right, int):
+        check_int_bits(left.bit_length() + right.bit_length())
+    return left * right
+
+def checked_pow(left, right):
+    if isinstance(left, int) and isinstance(right, int) and right > 0 and abs(left) > 1:
+        check_int_bits((abs(left).bit_length() - 1) * right)
+    return left ** right
+
+def checked_lshift(left, right):
+    if isinstance(left, int) and isinstance(right, int) and left and right > 0:
+        check_int_bits(left.bit_length() + right)
+    return left << right
+
+def checked_item(container, index, operator, value):
+    #container[index] op= value, for the operators above
+    container[index] = operator(container[index], value)
+
+SAFE_BUILTINS = {
+    "len": len, "int": int, "float": float, "str": str, "bool": bool, "list": counted(list),
+    "dict": counted(dict), "tuple": counted(tuple), "range": checked_range, "min": counted(min),
+    "max": counted(max), "abs": abs, "sum": counted(sum), "sorted": counted(sorted), "enumerate": enumerate,
+    "zip": zip, "reversed": reversed,
+}
+#names the instrumented code calls, out of the scripts' reach as they start with an underscore
+INSTRUMENTATION = {
+    "__tick__": tick_once, "__ticks__": ticks, "__checked_item__": checked_item, "__checked_add__": checked_add,
+    "__checked_mul__": checked_mul, "__checked_pow__": checked_pow, "__checked_lshift__": checked_lshift,
+}
+CHECKED_OPERATORS = {ast.Add: "__checked_add__", ast.Mult: "__checked_mul__", ast.Pow: "__checked_pow__",
+                     ast.LShift: "__checked_lshift__"}
+
+def instrumentation_call(name, args):
+    return ast.Call(ast.Name(name, ast.Load()), args, [])
+
+class Instrumenter(ast.NodeTransformer):
+    #loops report to __tick__, comprehensions and unpacking through the __ticks__ iterator,
+    #and the operators that can build huge values go through the checked_* helpers
+
+    def visit_While(self, node):
+        self.generic_visit(node)
+        node.body.insert(0, ast.Expr(instrumentation_call("__tick__", [])))
+        return node
+
+    def visit_For(self, node):
+        self.generic_visit(node)
+        node.iter = instrumentation_call("__ticks__", [node.iter])
+        return node
+
+    visit_comprehension = visit_For
+
+    def visit_Starred(self, node):
+        self.generic_visit(node)
+        if isinstance(node.ctx, ast.Load):
+            node.value = instrumentation_call("__ticks__", [node.value])
+        return node
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        helper = CHECKED_OPERATORS.get(type(node.op))
+        if helper is None:
+            return node
+        return instrumentation_call(helper, [node.left, node.right])
+
+    def visit_AugAssign(self, node):
+        self.generic_visit(node)
+        helper = CHECKED_OPERATORS.get(type(node.op))
+        if helper is None:
+            return node
+        target = node.target
+        if isinstance(target, ast.Name):
+            value = instrumentation_call(helper, [ast.Name(target.id, ast.Load()), node.value])
+            return ast.Assign([target], value)
+        if isinstance(target, ast.Subscript) and not isinstance(target.slice, ast.Slice):
+            #the container and index are evaluated once, as in the original statement
+            return ast.Expr(instrumentation_call("__checked_item__",
+                                                 [target.value, target.slice, ast.Name(helper, ast.Load()), node.value]))
+        raise ScriptError("ERR Error compiling script: this augmented assignment is not allowed in scripts")
+
+def script_sha(source):
+    return hashlib.sha1(source).hexdigest().encode()
+
+def compile_script(source):
+    try:
+        tree = ast.parse(source.decode("utf-8", "surrogateescape"), "@user_script")
+    except SyntaxError as e:
+        raise ScriptError(f"ERR Error compiling script (new function): line {e.lineno}: {e.msg}") from None
+    for node in ast.walk(tree):
+        if type(node) not in ALLOWED_NODES:
+            raise ScriptError(f"ERR Error compiling script: {type(node).__name__} is not allowed in scripts")
+        if isinstance(node, ast.Name) and node.id.startswith("_"):
+            raise ScriptError(f"ERR Error compiling script: name '{node.id}' is not allowed in scripts")
+        if isinstance(node, ast.Attribute) and node.attr not in ALLOWED_ATTRIBUTES:
+            raise ScriptError(f"ERR Error compiling script: attribute '{node.attr}' is not allowed in scripts")
+    tree = Instrumenter().visit(tree)
+    wrapper = ast.parse(f"def __script__({', '.join(SCRIPT_PARAMETERS)}):\n    pass")
+    wrapper.body[0].body = tree.body or [ast.Pass()]
+    ast.fix_missing_locations(wrapper)
+    namespace = {"__builtins__": {}, **SAFE_BUILTINS, **INSTRUMENTATION}
+    exec(compile(wrapper, "@user_script", "exec"), namespace)
+    return namespace["__script__"]
+
+def to_argument(value):
+    if isinstance(value, str):
+        return value.encode("utf-8", "surrogateescape")
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value).encode()
+    raise ScriptError("ERR Command arguments must be strings or integers")
+
+def from_reply(value):
+    #a command's decoded reply as the script sees it
+    if isinstance(value, SimpleString):
+        return StatusReply(value.decode("utf-8", "surrogateescape"))
+    if isinstance(value, ErrorReply):
+        return ErrorString(value.decode("utf-8", "surrogateescape"))
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "surrogateescape")
+    if isinstance(value, list):
+        return [from_reply(item) for item in value]
+    return value
+
+def to_reply(value):
+    #like Lua's conversion, False is a null and floats are truncated
+    if value is None or value is False:
+        return NULL_BULK
+    if value is True:
+        return encode_integer(1)
+    if isinstance(value, ErrorString):
+        return encode_error(value)
+    if isinstance(value, StatusReply):
+        return b"+" + value.encode("utf-8", "surrogateescape") + b"\r\n"
+    if isinstance(value, (int, float)):
+        return encode_integer(int(value))
+    if isinstance(value, (str, bytes)):
+        return encode_bulk(to_argument(value))
+    if isinstance(value, (list, tuple)):
+        return encode_array([to_reply(item) for item in value])
+    raise ScriptError(f"ERR Script returned an unsupported {type(value).__name__} value")
+
+def run_script(function, keys, argv, execute, tick):
+    #tick() is called every TICK_INTERVAL loop iterations and may raise ScriptError to stop the script
+    def call(*args):
+        reply = from_reply(decode_reply(execute([to_argument(arg) for arg in args])))
+        if isinstance(reply, ErrorString):
+            raise ScriptError(reply)
+        return reply
+
+    def pcall(*args):
+        try:
+            return from_reply(decode_reply(execute([to_argument(arg) for arg in args])))
+        except ScriptError as e:
+            return ErrorString(str(e))
+
+    running["tick"] = tick
+    running["count"] = 0
+    try:
+        result = function([key.decode("utf-8", "surrogateescape") for key in keys],
+                          [arg.decode("utf-8", "surrogateescape") for arg in argv],
+                          call, pcall, StatusReply, ErrorString)
+        return to_reply(result)
+    except ScriptError:
+        raise
+    except RecursionError:
+        raise ScriptError("ERR Error running script: maximum recursion depth exceeded") from None
+    except Exception as e:
+        raise ScriptError(f"ERR Error running script: {type(e).__name__}: {e}") from None
+    finally:
+        running["tick"] = None
@@ -0,0 +1,43 @@
+import pytest
+
+from app.conftest import Server, free_port
+
+@pytest.fixture
+def node(io_model, tmp_path):
+    #this node serves slots 0-8191 and a second, never started, node 8192-16000; 16001 up is unassigned
+    node = Server(tmp_path, "--io-model", io_model, "--cluster-enabled", "yes")
+    other = free_port()
+    (tmp_path / "nodes.conf").write_text(f"127.0.0.1:{node.port} 0-8191\n127.0.0.1:{other} 8192-16000\n")
+    node.start()
+    node.other = other
+    yield node
+    node.stop()
+
+def key_in(client, first, last, prefix = "key"):
+    for i in range(100000):
+        key = f"{prefix}:{i}"
+        slot = client("CLUSTER", "KEYSLOT", key)
+        if first <= slot <= last:
+            return key, slot
+
+def test_keys_of_another_node_are_redirected(node):
+    client = node.client()
+    mine, _ = key_in(client, 0, 8191)
+    theirs, slot = key_in(client, 8192, 16000)
+    assert client("SET", mine, "1") == b"OK"
+    assert client("GET", mine) == b"1"
+    for command in (("GET", theirs), ("SET", theirs, "1"), ("HSET", theirs, "f", "v"), ("BLPOP", theirs, 1),
+                    ("EVAL", "return 1", 1, theirs)):
+        assert client(*command) == f"MOVED {slot} 127.0.0.1:{node.other}".encode()
+    assert client("MGET", "{%s}a" % theirs, "{%s}b" % theirs) == f"MOVED {slot} 127.0.0.1:{node.other}".encode()
+    assert client("MGET", mine, theirs).startswith(b"CROSSSLOT")
+    unassigned, _ = key_in(client, 16001, 16383)
+    assert client("GET", unassigned).startswith(b"CLUSTERDOWN")
+    assert client("DBSIZE") == 1
+
+def test_redirect_inside_a_transaction_aborts_it(node):
+    client = node.client()
+    theirs, slot = key_in(client, 8192, 16000)
+    assert client("MULTI") == b"OK"
+    assert client("SET", theirs, "1") == f"MOVED {slot} 127.0.0.1:{node.other}".encode()
+    assert client("EXEC").startswith(b"EXECABORT")
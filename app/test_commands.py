@@ -0,0 +1,102 @@
+import time
+
+from app.conftest import wait_for
+
+def test_multi_key_commands(server):
+    client = server.client()
+    assert client("MSET", "a", "1", "b", "2", "c", "3") == b"OK"
+    assert client("MGET", "a", "missing", "c", "b") == [b"1", None, b"3", b"2"]
+    client("RPUSH", "list", "x")
+    #MGET answers nil for a key of another type rather than failing
+    assert client("MGET", "a", "list") == [b"1", None]
+    assert client("EXISTS", "a", "a", "missing", "list") == 3
+    assert client("MSETNX", "d", "4", "a", "9") == 0
+    assert client("MGET", "a", "d") == [b"1", None]
+    assert client("MSETNX", "d", "4", "e", "5") == 1
+    assert client("DEL", "a", "b", "missing", "list") == 3
+    assert client("UNLINK", "c", "d", "e") == 3
+    assert client("DBSIZE") == 0
+    assert client("MSET", "a", "1", "b").startswith(b"ERR wrong number of arguments")
+
+def test_mset_replaces_ttl_and_type(server):
+    client = server.client()
+    client("SET", "a", "old", "PX", 200)
+    client("HSET", "h", "f", "v")
+    client("MSET", "a", "new", "h", "string")
+    time.sleep(0.4)
+    assert client("MGET", "a", "h") == [b"new", b"string"]
+    assert client("TYPE", "h") == b"string"
+
+def test_sorted_set_commands(server):
+    client = server.client()
+    #past the listpack limit, served from the skiplist
+    for i in range(300):
+        client("ZADD", "z", i % 50, f"m{i:03}")
+    assert client("OBJECT", "ENCODING", "z") == b"skiplist"
+    model = sorted((i % 50, f"m{i:03}".encode()) for i in range(300))
+    assert client("ZCARD", "z") == 300
+    assert client("ZRANGE", "z", 0, -1) == [member for _, member in model]
+    assert client("ZRANGE", "z", -3, -1, "WITHSCORES") == [item for score, member in model[-3:]
+                                                           for item in (member, str(score).encode())]
+    assert [client("ZRANK", "z", member) for _, member in model[::37]] == list(range(0, 300, 37))
+    assert client("ZRANGEBYSCORE", "z", 10, "(12") == [member for score, member in model if 10 <= score < 12]
+    assert client("ZRANGEBYSCORE", "z", "(40", "+inf", "LIMIT", 3, 4) == [member for score, member in model
+                                                                           if score > 40][3:7]
+    assert client("ZREM", "z", "m000", "absent") == 1
+    assert client("ZRANK", "z", "m000") is None
+    assert client("ZRANK", "z", "m050") == 0
+
+def blocked_clients(client):
+    return int(client.info("clients")["blocked_clients"])
+
+def test_blocked_pops_are_served_in_arrival_order(server):
+    pusher = server.client()
+    waiters = [server.client() for _ in range(3)]
+    for n, waiter in enumerate(waiters, 1):
+        waiter.send("BLPOP", "q", 5)
+        wait_for(lambda: blocked_clients(pusher) == n)
+    assert pusher("RPUSH", "q", "a", "b", "c", "d") == 4
+    assert [waiter.read() for waiter in waiters] == [[b"q", b"a"], [b"q", b"b"], [b"q", b"c"]]
+    assert pusher("LRANGE", "q", 0, -1) == [b"d"]
+    assert blocked_clients(pusher) == 0
+
+def test_blocked_pop_timeout_and_keys(server):
+    client, pusher = server.client(), server.client()
+    started = time.monotonic()
+    assert client("BLPOP", "q", 0.2) is None
+    assert time.monotonic() - started >= 0.2
+    #the first key with elements is served, from its tail for BRPOP
+    pusher("RPUSH", "second", "x", "y")
+    assert client("BRPOP", "first", "second", 1) == [b"second", b"y"]
+    client.send("BLMOVE", "src", "dst", "LEFT", "RIGHT", 5)
+    wait_for(lambda: blocked_clients(pusher) == 1)
+    pusher("RPUSH", "src", "moved")
+    assert client.read() == b"moved"
+    assert pusher("LRANGE", "dst", 0, -1) == [b"moved"]
+
+def test_stream_add_and_range(server):
+    client = server.client()
+    #enough entries to span several of the stream's blocks
+    ids = [client("XADD", "s", f"{i + 1}-0", "n", i) for i in range(250)]
+    assert ids[:2] == [b"1-0", b"2-0"]
+    assert client("XADD", "s", "5-0", "n", "x").startswith(b"ERR The ID specified in XADD")
+    assert client("XADD", "s", "250-*", "n", "250") == b"250-1"
+    assert client("XLEN", "s") == 251
+    entries = client("XRANGE", "s", "99", "102")
+    assert entries == [[b"%d-0" % i, [b"n", b"%d" % (i - 1)]] for i in range(99, 103)]
+    assert [entry[0] for entry in client("XRANGE", "s", "-", "+", "COUNT", 3)] == [b"1-0", b"2-0", b"3-0"]
+    assert [entry[0] for entry in client("XREVRANGE", "s", "+", "-", "COUNT", 2)] == [b"250-1", b"250-0"]
+    assert client("XREAD", "COUNT", 2, "STREAMS", "s", "200-0") == [[b"s", [[b"201-0", [b"n", b"200"]],
+                                                                         [b"202-0", [b"n", b"201"]]]]]
+
+def test_xread_block(server):
+    reader, writer = server.client(), server.client()
+    writer("XADD", "s", "1-0", "f", "old")
+    started = time.monotonic()
+    assert reader("XREAD", "BLOCK", 200, "STREAMS", "s", "$") is None
+    assert time.monotonic() - started >= 0.2
+    #only entries added after the call count for $
+    reader.send("XREAD", "BLOCK", 5000, "STREAMS", "other", "s", "0-0", "$")
+    wait_for(lambda: int(writer.info("clients")["blocked_clients"]) == 1)
+    writer("XADD", "s", "2-0", "f", "new")
+    assert reader.read() == [[b"s", [[b"2-0", [b"f", b"new"]]]]]
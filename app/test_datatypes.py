@@ -0,0 +1,44 @@
+import random
+
+from app.datatypes import ZSET_MAX_LISTPACK_ENTRIES, ZSet
+
+def check(zset, model):
+    #model is the sorted list of (score, member) the zset must match
+    assert len(zset) == len(model)
+    assert zset.range_by_rank(0, len(model) - 1) == model
+    for rank, (score, member) in enumerate(model):
+        assert zset.rank(member) == rank
+        assert zset.score(member) == score
+    for start, stop in ((0, 0), (3, 17), (len(model) // 2, len(model) - 1)):
+        assert zset.range_by_rank(start, stop) == model[start:stop + 1]
+
+def test_zset_rank_and_range_on_the_skiplist():
+    rng = random.Random(7)
+    zset, scores = ZSet(), {}
+    for i in range(600):
+        member = b"m%d" % rng.randrange(400)
+        if rng.random() < 0.2 and member in scores:
+            assert zset.remove(member)
+            del scores[member]
+        else:
+            score = rng.randrange(100)
+            assert zset.add(member, score) == scores.get(member)
+            scores[member] = score
+    assert zset.encoding == "skiplist"
+    model = sorted((score, member) for member, score in scores.items())
+    check(zset, model)
+    assert zset.rank(b"absent") is None
+    assert not zset.remove(b"absent")
+    assert zset.range_by_score(10, False, 20, True) == [(s, m) for s, m in model if 10 <= s < 20]
+    assert zset.range_by_score(10, True, 20, False, 2, 5) == [(s, m) for s, m in model if 10 < s <= 20][2:7]
+
+def test_zset_converts_past_the_listpack_limit():
+    zset = ZSet.from_items((b"m%d" % i, i % 10) for i in range(ZSET_MAX_LISTPACK_ENTRIES))
+    assert zset.encoding == "listpack"
+    model = sorted((i % 10, b"m%d" % i) for i in range(ZSET_MAX_LISTPACK_ENTRIES))
+    check(zset, model)
+    zset.add(b"last", 5)
+    assert zset.encoding == "skiplist"
+    check(zset, sorted(model + [(5, b"last")]))
+    long_member = ZSet.from_items([(b"x" * 100, 1)])
+    assert long_member.encoding == "skiplist"
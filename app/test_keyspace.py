@@ -0,0 +1,79 @@
+from itertools import count
+
+import pytest
+
+from app.keyspace import BUCKET_COUNT, Keyspace
+
+def filled(size):
+    keyspace = Keyspace()
+    for i in range(size):
+        keyspace[b"key:%d" % i] = i
+    return keyspace
+
+def full_scan(keyspace, count, between_calls = None):
+    found = []
+    cursor = 0
+    while True:
+        cursor, keys = keyspace.scan(cursor, count)
+        found += keys
+        if between_calls is not None:
+            between_calls()
+        if not cursor:
+            return found
+
+def test_mapping():
+    keyspace = filled(1000)
+    keyspace[b"key:1"] = "new"
+    assert len(keyspace) == 1000
+    assert keyspace[b"key:1"] == "new"
+    del keyspace[b"key:2"]
+    assert keyspace.pop(b"key:3") == 3
+    assert keyspace.pop(b"key:3", "gone") == "gone"
+    assert b"key:2" not in keyspace
+    assert keyspace.get(b"key:2") is None
+    assert len(keyspace) == 998
+    assert sorted(keyspace.keys()) == sorted(key for key, _ in keyspace.items())
+
+def test_scan_returns_every_key_once():
+    keyspace = filled(5000)
+    found = full_scan(keyspace, 10)
+    assert len(found) == len(set(found)) == 5000
+
+def test_scan_under_writes():
+    #keys present from the first call to the last come back exactly once, whatever changes meanwhile
+    keyspace = filled(5000)
+    stable = {b"key:%d" % i for i in range(0, 5000, 2)}
+    added = count(5000)
+
+    def mutate():
+        for _ in range(20):
+            i = next(added)
+            keyspace[b"key:%d" % i] = i
+            victim = b"key:%d" % (i - 4999)
+            if victim not in stable:
+                keyspace.pop(victim)
+
+    found = full_scan(keyspace, 25, mutate)
+    assert len(found) == len(set(found))
+    assert stable <= set(found)
+
+def test_scan_of_empty_keyspace():
+    assert Keyspace().scan(0, 10) == (0, [])
+
+@pytest.mark.parametrize("cursor", [-1, BUCKET_COUNT, 99999999])
+def test_scan_rejects_cursors_out_of_range(cursor):
+    with pytest.raises(ValueError):
+        filled(10).scan(cursor, 10)
+
+def test_random_keys():
+    keyspace = filled(100)
+    sample = keyspace.random_keys(20)
+    assert len(sample) == len(set(sample)) == 20
+    assert all(key in keyspace for key in sample)
+    assert sorted(filled(3).random_keys(10)) == [b"key:0", b"key:1", b"key:2"]
+
+def test_detach():
+    keyspace = filled(10)
+    detached = keyspace.detach()
+    assert len(keyspace) == 0
+    assert len(detached) == 10
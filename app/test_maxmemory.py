@@ -0,0 +1,45 @@
+def memory(client):
+    fields = client.info("memory")
+    return int(fields["used_memory"]), int(fields["maxmemory"])
+
+def test_lru_eviction_stays_under_the_limit(start_server, io_model):
+    server = start_server("--io-model", io_model, "--maxmemory", "64kb", "--maxmemory-policy", "allkeys-lru")
+    client = server.client()
+    for i in range(2000):
+        assert client("SET", f"key:{i}", "x" * 100) == b"OK"
+        #a key read all along is never the least recently used one
+        assert client("GET", "key:0") == b"x" * 100
+        used, limit = memory(client)
+        assert used <= limit
+    assert int(client.info("stats")["evicted_keys"]) > 0
+    assert client("DBSIZE") < 2000
+
+def test_volatile_ttl_evicts_the_nearest_expiry_first(start_server, io_model):
+    server = start_server("--io-model", io_model, "--maxmemory", "32kb", "--maxmemory-policy", "volatile-ttl")
+    client = server.client()
+    for i in range(50):
+        client("SET", f"keep:{i}", "x" * 100)
+    for i in range(400):
+        reply = client("SET", f"ttl:{i}", "x" * 100, "EX", 1000 + i)
+        if reply != b"OK":
+            break
+        used, limit = memory(client)
+        assert used <= limit
+    #the longest-lived volatile keys are the ones left, keys without a ttl are never evicted
+    assert all(client("EXISTS", f"keep:{i}") for i in range(50))
+    assert client("EXISTS", "ttl:0") == 0
+    assert client("EXISTS", f"ttl:{i - 1}") == 1
+
+def test_noeviction_refuses_writes_but_not_reads(start_server, io_model):
+    server = start_server("--io-model", io_model, "--maxmemory", "16kb")
+    client = server.client()
+    for i in range(1000):
+        reply = client("SET", f"key:{i}", "x" * 100)
+        if reply != b"OK":
+            break
+    assert reply.startswith(b"OOM")
+    used, limit = memory(client)
+    assert used <= limit
+    assert client("GET", "key:0") == b"x" * 100
+    assert client("DEL", "key:0") == 1
+    assert client("SET", "key:0", "y") == b"OK"
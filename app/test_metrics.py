@@ -0,0 +1,51 @@
+import pytest
+
+from app.metrics import SUB_BUCKET_COUNT, bucket_highest, bucket_index
+
+def test_histogram_buckets_are_contiguous_and_narrow():
+    for value in list(range(5000)) + [10 ** 6, 10 ** 9, 12345678901]:
+        index = bucket_index(value)
+        assert bucket_highest(index - 1) < value <= bucket_highest(index) if index else value == 0
+        low = bucket_highest(index - 1) + 1 if index else 0
+        assert bucket_highest(index) - low + 1 <= max(1, low // SUB_BUCKET_COUNT)
+
+def commandstat(client, command):
+    fields = client.info("commandstats")[f"cmdstat_{command}"]
+    return {name: float(value) for name, value in (field.split("=") for field in fields.split(","))}
+
+def test_commandstats(server):
+    client = server.client()
+    for _ in range(3):
+        client("SET", "key", "value")
+    client("INCR", "key")
+    client("GET")
+    set_stats = commandstat(client, "set")
+    assert set_stats["calls"] == 3 and set_stats["failed_calls"] == 0
+    assert set_stats["usec_per_call"] == pytest.approx(set_stats["usec"] / 3, abs = 0.01)
+    #an error from a command that ran counts as failed, one refused before running as rejected
+    assert commandstat(client, "incr")["failed_calls"] == 1
+    assert commandstat(client, "get")["rejected_calls"] == 1
+    assert commandstat(client, "get")["calls"] == 0
+    assert client("CONFIG", "RESETSTAT") == b"OK"
+    assert "cmdstat_set" not in client.info("commandstats")
+
+def test_slowlog(server):
+    client = server.client()
+    assert client("CONFIG", "SET", "slowlog-log-slower-than", 0) == b"OK"
+    client("SLOWLOG", "RESET")
+    client("SET", "key", "x" * 1000)
+    client("RPUSH", "list", *range(100))
+    entries = client("SLOWLOG", "GET", 2)
+    #newest first, long arguments and argument lists cut short
+    assert entries[0][3][:3] == [b"RPUSH", b"list", b"0"] and len(entries[0][3]) == 32
+    assert entries[0][3][-1] == b"... (71 more arguments)"
+    assert entries[1][3][:2] == [b"SET", b"key"] and entries[1][3][2].endswith(b"... (872 more bytes)")
+    assert entries[0][0] == entries[1][0] + 1
+    assert client("CONFIG", "SET", "slowlog-max-len", 2) == b"OK"
+    for _ in range(5):
+        client("PING")
+    assert client("SLOWLOG", "LEN") == 2
+    assert client("CONFIG", "SET", "slowlog-log-slower-than", -1) == b"OK"
+    client("SLOWLOG", "RESET")
+    client("PING")
+    assert client("SLOWLOG", "LEN") == 0
@@ -0,0 +1,76 @@
+from app.conftest import wait_for
+
+def test_save_and_reload(server):
+    client = server.client()
+    client("SET", "string", "value")
+    client("SET", "counter", 41)
+    client("INCR", "counter")
+    client("SET", "later", "x", "PX", 100000)
+    client("SET", "expired", "x", "PX", 1)
+    client("RPUSH", "list", "a", "b", "c")
+    client("HSET", "hash", "f", "v")
+    assert client("SAVE") == b"OK"
+    server.stop()
+    assert [path.name for path in server.directory.iterdir() if path.suffix == ".rdb"] == ["dump.rdb"]
+    server.start()
+    client = server.client()
+    assert client("GET", "string") == b"value"
+    assert client("GET", "counter") == b"42"
+    assert client("GET", "later") == b"x"
+    assert client("GET", "expired") is None
+    assert client("LRANGE", "list", 0, -1) == [b"a", b"b", b"c"]
+    assert client("HGET", "hash", "f") == b"v"
+
+def aof_size(client):
+    return int(client.info("persistence")["aof_current_size"])
+
+def test_append_only_file_replay(start_server, io_model):
+    server = start_server("--io-model", io_model, "--appendonly", "yes", "--appendfsync", "always")
+    client = server.client()
+    client("SET", "string", "value")
+    for _ in range(5):
+        client("INCR", "counter")
+    client("RPUSH", "list", "a", "b", "c")
+    client("LPOP", "list")
+    client("HSET", "hash", "f", "v")
+    client("ZADD", "zset", 2, "b", 1, "a")
+    client("SET", "gone", "x")
+    client("DEL", "gone")
+    client("SET", "later", "x", "PX", 100000)
+    client("SET", "expired", "x", "PX", 1)
+    client("MULTI")
+    client("SET", "in-multi", "1")
+    client("EXEC")
+    server.stop()
+    server.start()
+    client = server.client()
+    assert client("GET", "string") == b"value"
+    assert client("GET", "counter") == b"5"
+    assert client("LRANGE", "list", 0, -1) == [b"b", b"c"]
+    assert client("HGET", "hash", "f") == b"v"
+    assert client("ZRANGE", "zset", 0, -1) == [b"a", b"b"]
+    assert client("EXISTS", "gone") == 0
+    assert client("GET", "later") == b"x"
+    assert client("GET", "expired") is None
+    assert client("GET", "in-multi") == b"1"
+
+def test_rewrite_compacts_and_reloads(start_server, io_model):
+    server = start_server("--io-model", io_model, "--appendonly", "yes", "--appendfsync", "always")
+    client = server.client()
+    for _ in range(500):
+        client("INCR", "counter")
+    client("RPUSH", "list", *range(100))
+    before = aof_size(client)
+    assert client("BGREWRITEAOF").startswith(b"Background append only file rewriting")
+    wait_for(lambda: client.info("persistence")["aof_rewrite_in_progress"] == "0")
+    assert client.info("persistence")["aof_last_bgrewrite_status"] == "ok"
+    assert aof_size(client) < before
+    #writes made after the rewrite land after the rewritten base
+    client("INCR", "counter")
+    client("SET", "after", "1")
+    server.stop()
+    server.start()
+    client = server.client()
+    assert client("GET", "counter") == b"501"
+    assert client("LLEN", "list") == 100
+    assert client("GET", "after") == b"1"
@@ -0,0 +1,30 @@
+from app.conftest import wait_for
+
+def test_pattern_subscriptions(server):
+    subscriber, publisher = server.client(), server.client()
+    assert subscriber("PSUBSCRIBE", "news.*", "h?llo") == [b"psubscribe", b"news.*", 1]
+    assert subscriber.read() == [b"psubscribe", b"h?llo", 2]
+    assert subscriber("SUBSCRIBE", "news.sport") == [b"subscribe", b"news.sport", 3]
+    assert publisher("PUBLISH", "news.tech", "a") == 1
+    assert subscriber.read() == [b"pmessage", b"news.*", b"news.tech", b"a"]
+    #a channel matching both a subscription and a pattern is delivered once for each
+    assert publisher("PUBLISH", "news.sport", "b") == 2
+    assert subscriber.read() == [b"message", b"news.sport", b"b"]
+    assert subscriber.read() == [b"pmessage", b"news.*", b"news.sport", b"b"]
+    assert publisher("PUBLISH", "hello", "c") == 1
+    assert subscriber.read() == [b"pmessage", b"h?llo", b"hello", b"c"]
+    assert publisher("PUBLISH", "newsroom", "d") == 0
+    assert publisher("PUBSUB", "NUMPAT") == 2
+    assert subscriber("PUNSUBSCRIBE", "news.*") == [b"punsubscribe", b"news.*", 2]
+    assert publisher("PUBLISH", "news.tech", "e") == 0
+
+def test_publish_reaches_every_pattern_subscriber(server):
+    subscribers = [server.client() for _ in range(5)]
+    for subscriber in subscribers:
+        subscriber("PSUBSCRIBE", "room:*")
+    publisher = server.client()
+    assert publisher("PUBLISH", "room:1", "hi") == 5
+    assert all(subscriber.read() == [b"pmessage", b"room:*", b"room:1", b"hi"] for subscriber in subscribers)
+    #a subscriber that disconnects is dropped once the server sees the close
+    subscribers[0].close()
+    wait_for(lambda: publisher("PUBLISH", "room:1", "again") == 4)
@@ -0,0 +1,80 @@
+import pytest
+
+from app import rdb
+from app.datatypes import Hash, List, Set, Stream, ZSet, stream_id
+
+INT64_MAX = (1 << 63) - 1
+
+def dataset():
+    stream = Stream()
+    for i in range(1, 251):
+        stream.append(stream_id(1000 + i, 0), [b"field", b"%d" % i] if i % 3 else [b"other", b"x", b"y", b"z"])
+    stream.last_id = stream_id(5000, 7)
+    return [
+        (b"plain", b"value", None),
+        (b"number", 12345, 1700000000000),
+        (b"negative", -7, None),
+        (b"compressible", b"abc" * 1000, INT64_MAX),
+        (b"list", List([b"a", b"b", b"c"] * 100), None),
+        (b"intset", Set([b"1", b"2", b"30000"]), None),
+        (b"set", Set([b"x", b"y", b"%d" % 10 ** 12]), None),
+        (b"hash", Hash.from_pairs([(b"f%d" % i, b"v%d" % i) for i in range(200)]), None),
+        (b"zset", ZSet.from_items([(b"m%d" % i, i / 4) for i in range(300)]), 1),
+        (b"stream", stream, None),
+    ]
+
+def comparable(value):
+    if isinstance(value, (Hash, ZSet)):
+        return sorted(value.items())
+    if isinstance(value, Set):
+        return sorted(value)
+    if isinstance(value, Stream):
+        return list(value), value.last_id
+    if isinstance(value, List):
+        return list(value)
+    return value
+
+def round_trip(tmp_path, entries, **options):
+    path = tmp_path / "dump.rdb"
+    with open(path, "wb") as f:
+        rdb.dump(f, entries, {"redis-ver": "7.2.0"}, len(entries), sum(e is not None for _, _, e in entries), **options)
+    aux = {}
+    return list(rdb.load_file(str(path), True, aux)), aux
+
+@pytest.mark.parametrize("compression", [False, True])
+def test_round_trip(tmp_path, compression):
+    entries = dataset()
+    loaded, aux = round_trip(tmp_path, entries, compression = compression)
+    assert aux[b"redis-ver"] == b"7.2.0"
+    assert [(key, comparable(value), expire) for key, value, expire in loaded] == \
+           [(key, comparable(value), expire) for key, value, expire in entries]
+
+def test_checksum_mismatch(tmp_path):
+    path = tmp_path / "dump.rdb"
+    with open(path, "wb") as f:
+        rdb.dump(f, [(b"key", b"value" * 10, None)], {}, 1, 0)
+    data = bytearray(path.read_bytes())
+    data[data.index(b"valuevalue")] ^= 1
+    path.write_bytes(bytes(data))
+    with pytest.raises(rdb.RdbError):
+        list(rdb.load_file(str(path)))
+
+def test_not_an_rdb_file(tmp_path):
+    path = tmp_path / "dump.rdb"
+    path.write_bytes(b"hello world")
+    with pytest.raises(rdb.RdbError):
+        list(rdb.load_file(str(path)))
+
+def test_lzf():
+    data = b"abcdefgh" * 500 + bytes(range(256))
+    compressed = rdb.lzf_compress(data)
+    assert len(compressed) < len(data)
+    assert rdb.lzf_decompress(compressed, len(data)) == data
+    assert rdb.lzf_compress(bytes(range(20))) is None
+
+def test_crc64():
+    assert rdb.crc64(0, b"123456789") == 0xE9C6D914C4B8D9CA
+    data = bytes(range(256)) * (rdb.CRC64_CHUNK // 128 + 3)
+    #resuming from a running CRC at any split gives the same result
+    for split in (0, 1, 4097, rdb.CRC64_CHUNK, len(data)):
+        assert rdb.crc64(rdb.crc64(0, data[:split]), data[split:]) == rdb.crc64(0, data)
@@ -0,0 +1,199 @@
+import socket
+import time
+
+from app import rdb
+from app.conftest import wait_for
+from app.resp import ErrorReply, RespParser, encode_command
+
+def test_replconf_ack_with_bad_offset(server):
+    client = server.client()
+    reply = client("REPLCONF", "ACK", "xyz")
+    assert isinstance(reply, ErrorReply) and reply.startswith(b"ERR value is not an integer")
+    assert client("PING") == b"PONG"
+
+def test_replconf_ack_from_a_client_is_ignored(server):
+    client = server.client()
+    client.send("REPLCONF", "ACK", "100")
+    #acks are never answered, so the next reply is the PING's
+    assert client("PING") == b"PONG"
+
+def fake_handshake(link):
+    #acknowledges PING and REPLCONF, returns once PSYNC arrives
+    parser = RespParser()
+    while True:
+        command = parser.next_command()
+        if command is None:
+            parser.feed(link.recv(65536))
+        elif command[0].upper() == b"PSYNC":
+            return
+        else:
+            link.sendall(b"+OK\r\n")
+
+def test_corrupt_full_sync_is_retried(tmp_path, start_server):
+    #a fake master that answers the handshake with an RDB failing its checksum
+    with open(tmp_path / "good.rdb", "wb") as f:
+        rdb.dump(f, [(b"key", b"value" * 10, None)], {}, 1, 0)
+    payload = bytearray((tmp_path / "good.rdb").read_bytes())
+    payload[payload.index(b"valuevalue")] ^= 1
+    listener = socket.create_server(("localhost", 0))
+    listener.settimeout(10)
+    replica = start_server("--replicaof", "localhost %d" % listener.getsockname()[1])
+    with listener:
+        for _ in range(3):
+            link, _ = listener.accept()
+            with link:
+                fake_handshake(link)
+                link.sendall(b"+FULLRESYNC %s 0\r\n$%d\r\n" % (b"a" * 40, len(payload)) + bytes(payload))
+                time.sleep(0.2)
+    assert replica.client()("GET", "key") is None
+
+def caught_up(client, replica = 0):
+    #the replica acknowledged everything the master has sent
+    info = client.info("replication")
+    return "offset=%s," % info["master_repl_offset"] in info.get("slave%d" % replica, "")
+
+def test_replica_acks_and_reconnects(start_server, io_model):
+    master = start_server("--io-model", io_model)
+    replica = start_server("--io-model", io_model, "--replicaof", "localhost %d" % master.port)
+    client = master.client()
+    client("SET", "key", "1")
+    #the replica acknowledges its offset every second over the master link
+    wait_for(lambda: caught_up(client))
+    master.stop()
+    master.start()
+    master.client()("SET", "after", "2")
+    reader = replica.client()
+    wait_for(lambda: reader.info("replication")["master_link_status"] == "up")
+    wait_for(lambda: reader("GET", "after") == b"2")
+
+class FakeReplica:
+    #speaks the replica side of the protocol by hand, to see what the master sends
+    def __init__(self, port, replid = b"?", offset = -1):
+        self.sock = socket.create_connection(("localhost", port), timeout = 5)
+        self.reader = self.sock.makefile("rb")
+        for command in ([b"PING"], [b"REPLCONF", b"listening-port", b"0"], [b"REPLCONF", b"capa", b"psync2"]):
+            self.sock.sendall(encode_command(command))
+            self.reader.readline()
+        self.sock.sendall(encode_command([b"PSYNC", replid, b"%d" % offset]))
+        reply = self.reader.readline().split()
+        self.resync = reply[0]
+        if self.resync == b"+FULLRESYNC":
+            self.replid, self.offset = reply[1], int(reply[2])
+            size = int(self.reader.readline()[1:])
+            self.reader.read(size)
+        else:
+            self.replid, self.offset = reply[1], offset - 1
+        self.stream = b""
+
+    def read_until(self, command):
+        #the stream up to and including command; the replica then holds all of it
+        wanted = encode_command(command)
+        while wanted not in self.stream:
+            self.stream += self.reader.read1(65536)
+        self.offset += len(self.stream)
+        return self.stream
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+def test_partial_resync_after_link_drop(server):
+    client = server.client()
+    replica = FakeReplica(server.port)
+    assert replica.resync == b"+FULLRESYNC"
+    client("SET", "a", "1")
+    replica.read_until([b"SET", b"a", b"1"])
+    replica.close()
+    #written while the link is down: the backlog keeps it
+    client("SET", "b", "2")
+    client("SET", "c", "3")
+    resumed = FakeReplica(server.port, replica.replid, replica.offset + 1)
+    assert resumed.resync == b"+CONTINUE"
+    missed = resumed.read_until([b"SET", b"c", b"3"])
+    assert encode_command([b"SET", b"b", b"2"]) in missed
+    assert encode_command([b"SET", b"a", b"1"]) not in missed
+    resumed.close()
+
+def test_resync_outside_the_backlog_is_full(server):
+    client = server.client()
+    replica = FakeReplica(server.port)
+    client("SET", "a", "1")
+    replica.read_until([b"SET", b"a", b"1"])
+    replica.close()
+    for replid, offset in ((replica.replid, replica.offset + 1000000), (b"b" * 40, replica.offset + 1)):
+        retry = FakeReplica(server.port, replid, offset)
+        assert retry.resync == b"+FULLRESYNC"
+        retry.close()
+
+def test_writes_reach_every_replica(start_server, io_model):
+    master = start_server("--io-model", io_model)
+    replicas = [start_server("--io-model", io_model, "--replicaof", "localhost %d" % master.port) for _ in range(3)]
+    client = master.client()
+    wait_for(lambda: client.info("replication")["connected_slaves"] == "3")
+    #a replica that never reads must not hold up the others
+    stalled = FakeReplica(master.port)
+    #more than the socket buffers hold
+    for i in range(200):
+        client("SET", f"key:{i}", "x" * 50000)
+    client("SET", "last", "1")
+    for replica in replicas:
+        reader = replica.client()
+        wait_for(lambda: reader("GET", "last") == b"1")
+        assert reader("DBSIZE") == 201
+    wait_for(lambda: all(caught_up(client, i) for i in range(3)))
+    assert client("PING") == b"PONG"
+    stalled.close()
+
+def test_wait_counts_acknowledging_replicas(start_server, io_model):
+    master = start_server("--io-model", io_model)
+    for _ in range(2):
+        start_server("--io-model", io_model, "--replicaof", "localhost %d" % master.port)
+    client = master.client()
+    wait_for(lambda: client.info("replication")["connected_slaves"] == "2")
+    client("SET", "key", "1")
+    assert client("WAIT", 2, 5000) == 2
+    client("SET", "key", "2")
+    #asking for more replicas than there are waits out the timeout, then reports those that acked
+    started = time.monotonic()
+    assert client("WAIT", 3, 300) == 2
+    assert time.monotonic() - started >= 0.3
+
+def test_wait_times_out_without_acks(server):
+    client = server.client()
+    #a replica that takes the stream but never acknowledges it
+    silent = FakeReplica(server.port)
+    wait_for(lambda: client.info("replication")["connected_slaves"] == "1")
+    client("SET", "key", "1")
+    started = time.monotonic()
+    assert client("WAIT", 1, 300) == 0
+    assert time.monotonic() - started >= 0.3
+    assert client("WAIT", 0, 0) == 0
+    silent.close()
+
+def test_replica_refuses_writes(start_server, io_model):
+    master = start_server("--io-model", io_model)
+    replica = start_server("--io-model", io_model, "--replicaof", "localhost %d" % master.port)
+    master.client()("SET", "key", "1")
+    reader = replica.client()
+    wait_for(lambda: reader("GET", "key") == b"1")
+    for command in (("SET", "key", "2"), ("DEL", "key"), ("RPUSH", "list", "a")):
+        assert reader(*command).startswith(b"READONLY")
+    assert reader("GET", "key") == b"1"
+    writable = start_server("--io-model", io_model, "--replicaof", "localhost %d" % master.port,
+                            "--replica-read-only", "no")
+    assert writable.client()("SET", "local", "1") == b"OK"
+
+def test_stale_replica_refuses_reads(start_server, io_model):
+    master = start_server("--io-model", io_model, "--repl-ping-replica-period", "1")
+    replica = start_server("--io-model", io_model, "--replicaof", "localhost %d" % master.port,
+                           "--replica-max-lag", "2")
+    master.client()("SET", "key", "1")
+    reader = replica.client()
+    wait_for(lambda: reader("GET", "key") == b"1")
+    #the master's pings keep an idle link fresh
+    time.sleep(3)
+    assert reader("GET", "key") == b"1"
+    master.stop()
+    wait_for(lambda: reader("GET", "key").startswith(b"MASTERDOWN"))
+    assert reader("PING") == b"PONG"
+    assert reader.info("replication")["master_link_status"] == "down"
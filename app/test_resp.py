@@ -0,0 +1,73 @@
+import pytest
+
+from app.resp import (
+    MAX_BULK_LEN, ErrorReply, ProtocolError, RespParser, SimpleString, decode_reply, encode_command,
+)
+
+def parse(*chunks):
+    parser = RespParser()
+    commands = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        commands += list(parser)
+    return parser, commands
+
+def test_multibulk_split_at_every_byte():
+    data = encode_command([b"SET", b"key", b"a\r\nvalue"]) + encode_command([b"GET", b"key"])
+    parser, commands = parse(*(data[i:i + 1] for i in range(len(data))))
+    assert commands == [[b"SET", b"key", b"a\r\nvalue"], [b"GET", b"key"]]
+    assert parser.consumed() == len(data)
+    assert parser.pending() == 0
+
+def test_inline_commands():
+    _, commands = parse(b"PING\r\n\r\nECHO  hi\r\n")
+    assert commands == [[b"PING"], [b"ECHO", b"hi"]]
+
+def test_empty_multibulk_is_skipped():
+    _, commands = parse(b"*0\r\n*1\r\n$4\r\nPING\r\n")
+    assert commands == [[b"PING"]]
+
+def test_incomplete_command_waits_for_more():
+    parser, commands = parse(b"*2\r\n$3\r\nGET\r\n$3\r\nke")
+    assert commands == []
+    parser.feed(b"y\r\n")
+    assert parser.next_command() == [b"GET", b"key"]
+
+@pytest.mark.parametrize("header", [b"$99999999999", b"$%d" % (MAX_BULK_LEN + 1), b"$-1", b"$abc"])
+def test_bad_bulk_length(header):
+    parser = RespParser()
+    parser.feed(b"*1\r\n" + header + b"\r\n")
+    with pytest.raises(ProtocolError):
+        parser.next_command()
+
+def test_bulk_at_the_limit_is_buffered():
+    parser = RespParser()
+    parser.feed(b"*1\r\n$%d\r\nabc" % MAX_BULK_LEN)
+    assert parser.next_command() is None
+
+def test_bad_multibulk_length():
+    parser = RespParser()
+    parser.feed(b"*x\r\n")
+    with pytest.raises(ProtocolError):
+        parser.next_command()
+
+def test_unterminated_inline_request():
+    parser = RespParser()
+    parser.feed(b"a" * (128 * 1024))
+    with pytest.raises(ProtocolError):
+        parser.next_command()
+
+def test_next_reply_waits_for_nested_elements():
+    reply = b"*2\r\n*1\r\n$1\r\na\r\n:5\r\n"
+    parser = RespParser()
+    parser.feed(reply[:-3])
+    assert parser.next_reply() is None
+    parser.feed(reply[-3:] + b"+OK\r\n")
+    assert parser.next_reply() == reply
+    assert parser.next_reply() == b"+OK\r\n"
+
+def test_decode_reply():
+    assert decode_reply(b"*5\r\n+OK\r\n-ERR no\r\n:-3\r\n$-1\r\n$2\r\nhi\r\n") == [b"OK", b"ERR no", -3, None, b"hi"]
+    assert isinstance(decode_reply(b"+OK\r\n"), SimpleString)
+    assert isinstance(decode_reply(b"-ERR no\r\n"), ErrorReply)
+    assert decode_reply(b">2\r\n$10\r\ninvalidate\r\n_\r\n") == [b"invalidate", None]
@@ -0,0 +1,107 @@
+import socket
+import threading
+
+import pytest
+
+from app.resp import ErrorReply, encode_command
+
+def test_oversized_bulk_closes_only_that_connection(server):
+    client, other = server.client(), server.client()
+    client.sock.sendall(b"*1\r\n$99999999999\r\n")
+    assert client.read_raw().startswith(b"-ERR Protocol error")
+    with pytest.raises(ConnectionError):
+        client.read_raw()
+    assert other("PING") == b"PONG"
+
+def test_closed_socket_mid_command(server):
+    sock = socket.create_connection(("localhost", server.port))
+    sock.sendall(b"*3\r\n$3\r\nSET\r\n$1\r\nk")
+    sock.close()
+    assert server.client()("PING") == b"PONG"
+
+@pytest.mark.parametrize("option, amount", [
+    ("EX", 10 ** 16), ("PX", 10 ** 23), ("EXAT", 10 ** 17), ("PXAT", 1 << 63),
+])
+def test_set_rejects_expire_beyond_int64(server, option, amount):
+    client = server.client()
+    assert client("SET", "key", "value", option, amount) == b"ERR invalid expire time in 'set' command"
+    assert client("EXISTS", "key") == 0
+    assert client("SET", "key", "value", "PXAT", (1 << 63) - 1) == b"OK"
+    assert client("SAVE") == b"OK"
+
+def test_pexpireat_rejects_out_of_range(server):
+    client = server.client()
+    client("SET", "key", "value")
+    assert client("PEXPIREAT", "key", 10 ** 20) == b"ERR invalid expire time in 'pexpireat' command"
+    assert client("PEXPIREAT", "key", -(10 ** 20)) == b"ERR invalid expire time in 'pexpireat' command"
+    assert client("GET", "key") == b"value"
+    assert client("SAVE") == b"OK"
+
+def test_scan_and_keys(server):
+    client = server.client()
+    for i in range(300):
+        client("SET", f"user:{i}", i)
+    client("RPUSH", "user:list", "x")
+    client("SET", "gone", "x", "PX", 1)
+    found, cursor = [], b"0"
+    while True:
+        cursor, keys = client("SCAN", cursor, "MATCH", "user:*", "COUNT", 50)
+        found += keys
+        if cursor == b"0":
+            break
+    assert len(found) == len(set(found)) == 301
+    assert client("SCAN", 0, "TYPE", "list", "COUNT", 100000) == [b"0", [b"user:list"]]
+    assert sorted(client("KEYS", "user:1?")) == [b"user:%d" % i for i in range(10, 20)]
+    assert client("KEYS", "gone") == []
+
+def test_scan_rejects_bad_cursors(server):
+    client = server.client()
+    client("SET", "key", "value")
+    for cursor in ("99999999", "-1", "abc"):
+        assert client("SCAN", cursor) == b"ERR invalid cursor"
+
+@pytest.mark.parametrize("script", [
+    "return sum(range(10 ** 12))",
+    "return len(list(range(10 ** 10)))",
+    "return 2 ** 10 ** 10",
+    "return len('a' * 10 ** 10)",
+    "x = 1\nx <<= 10 ** 9\nreturn 1",
+    "s = 'ab'\nfor i in range(64):\n    s = s + s\nreturn len(s)",
+])
+def test_script_cannot_build_huge_values(server, script):
+    client = server.client()
+    reply = client("EVAL", script, 0)
+    assert isinstance(reply, ErrorReply) and reply.startswith(b"ERR Error running script")
+    assert client("PING") == b"PONG"
+
+def test_busy_script_is_stopped(server):
+    client = server.client()
+    assert client("CONFIG", "SET", "busy-reply-threshold", 100) == b"OK"
+    reply = client("EVAL", "while True:\n    pass", 0)
+    assert reply.startswith(b"ERR Script killed")
+    assert client("EVAL", "return sum([n * 2 for n in range(1000)])", 0) == 999000
+
+def info_field(client, section, name):
+    for line in client("INFO", section).decode().splitlines():
+        if line.startswith(name + ":"):
+            return int(line.split(":")[1])
+    raise KeyError(name)
+
+def test_input_bytes_from_concurrent_clients(server):
+    #every byte read is counted once, whichever thread read it
+    watcher = server.client()
+    before = info_field(watcher, "stats", "total_net_input_bytes")
+    clients = [server.client() for _ in range(4)]
+
+    def echo(client):
+        for _ in range(200):
+            assert client("ECHO", "abcd") == b"abcd"
+
+    threads = [threading.Thread(target = echo, args = (client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    after = info_field(watcher, "stats", "total_net_input_bytes")
+    assert after - before == 4 * 200 * len(encode_command([b"ECHO", b"abcd"])) + \
+           len(encode_command([b"INFO", b"stats"]))
@@ -0,0 +1,103 @@
+import time
+
+from app.resp import ErrorReply
+
+def tracking_client(server, *options):
+    client = server.client()
+    client.send("HELLO", 3)
+    client.read_raw()
+    assert client("CLIENT", "TRACKING", "on", *options) == b"OK"
+    return client
+
+def pushes(client):
+    #pushes for writes that already completed are queued ahead of the reply to a later PING
+    client("PING")
+    received, client.pushes = client.pushes, []
+    return received
+
+def test_tracking_needs_resp3(server):
+    client = server.client()
+    assert isinstance(client("CLIENT", "TRACKING", "on"), ErrorReply)
+    assert client("CLIENT", "TRACKING", "off") == b"OK"
+
+def test_write_invalidates_keys_read(server):
+    cache, writer = tracking_client(server), server.client()
+    writer("SET", "k", "1")
+    writer("SET", "other", "1")
+    assert cache("GET", "k") == b"1"
+    assert pushes(cache) == []
+    writer("SET", "k", "2")
+    writer("SET", "other", "2")
+    assert pushes(cache) == [[b"invalidate", [b"k"]]]
+    #one invalidation per read: the key is forgotten until it is read again
+    writer("SET", "k", "3")
+    assert pushes(cache) == []
+    cache("MGET", "k", "other")
+    writer("DEL", "k")
+    writer("INCR", "other")
+    assert pushes(cache) == [[b"invalidate", [b"k"]], [b"invalidate", [b"other"]]]
+
+def test_writes_of_every_kind_invalidate(server):
+    cache, writer = tracking_client(server), server.client()
+    for key in ("h", "m", "s"):
+        cache("GET", key)
+    writer("HSET", "h", "f", "v")
+    writer("MULTI")
+    writer("SET", "m", "1")
+    writer("EXEC")
+    writer("EVAL", "return call('SET', KEYS[0], '1')", 1, "s")
+    writer("SET", "p", "1")
+    cache("GET", "p")
+    writer("PEXPIREAT", "p", 1)
+    assert pushes(cache) == [[b"invalidate", [key]] for key in (b"h", b"m", b"s", b"p")]
+
+def test_expired_key_is_invalidated(server):
+    cache, writer = tracking_client(server), server.client()
+    writer("SET", "e", "1", "PX", 50)
+    cache("GET", "e")
+    deadline = time.monotonic() + 5
+    received = []
+    while not received and time.monotonic() < deadline:
+        time.sleep(0.05)
+        received = pushes(cache)
+    assert received == [[b"invalidate", [b"e"]]]
+
+def test_flush_invalidates_everything(server):
+    cache, writer = tracking_client(server), server.client()
+    cache("GET", "k")
+    writer("FLUSHALL")
+    assert pushes(cache) == [[b"invalidate", None]]
+
+def test_tracking_table_is_bounded(server):
+    cache = tracking_client(server)
+    assert cache("CONFIG", "SET", "tracking-table-max-keys", 2) == b"OK"
+    for key in ("a", "b", "c"):
+        cache("GET", key)
+    assert pushes(cache) == [[b"invalidate", [b"a"]]]
+
+def test_bcast_prefixes(server):
+    cache, writer = tracking_client(server, "BCAST", "PREFIX", "user:", "PREFIX", "s:"), server.client()
+    for key in ("user:1", "s:1", "x"):
+        writer("SET", key, "1")
+    assert pushes(cache) == [[b"invalidate", [b"user:1"]], [b"invalidate", [b"s:1"]]]
+
+def test_optin_tracks_only_after_caching_yes(server):
+    cache, writer = tracking_client(server, "OPTIN"), server.client()
+    cache("GET", "a")
+    assert cache("CLIENT", "CACHING", "yes") == b"OK"
+    cache("GET", "b")
+    cache("GET", "c")
+    writer("MSET", "a", "1", "b", "1", "c", "1")
+    assert pushes(cache) == [[b"invalidate", [b"b"]]]
+
+def test_tracking_off_and_disconnect(server):
+    cache, writer = tracking_client(server), server.client()
+    cache("GET", "k")
+    assert cache("CLIENT", "TRACKING", "off") == b"OK"
+    writer("SET", "k", "1")
+    assert pushes(cache) == []
+    cache("CLIENT", "TRACKING", "on")
+    cache("GET", "k")
+    cache.close()
+    writer("SET", "k", "2")
+    assert b"tracking_clients:0" in writer("INFO", "clients")
@@ -0,0 +1,136 @@
+from itertools import count
+
+import pytest
+
+from app.conftest import Client, wait_for
+from app.main import COMMAND_KEYS
+from app.resp import ErrorReply
+
+WORKERS = "3"
+
+@pytest.fixture
+def workers(start_server, io_model):
+    server = start_server("--workers", WORKERS, "--io-model", io_model)
+    client = server.client()
+    #the shared port answers as soon as one worker listens; a fan-out needs all of them
+    wait_for(lambda: client("DBSIZE") == 0)
+    return server
+
+def full_scan(client, *options):
+    found, cursor = [], b"0"
+    while True:
+        cursor, keys = client("SCAN", cursor, *options)
+        found += keys
+        if cursor == b"0":
+            return found
+
+def test_keyspace_commands_cover_every_worker(workers):
+    client = workers.client()
+    for i in range(30):
+        client("SET", f"key:{i}", i)
+    assert client("DBSIZE") == 30
+    assert sorted(client("KEYS", "key:*")) == sorted(b"key:%d" % i for i in range(30))
+    found = full_scan(client, "COUNT", 1000)
+    assert len(found) == len(set(found)) == 30
+    assert client("SCAN", 99999999) == b"ERR invalid cursor"
+    assert client("FLUSHALL") == b"OK"
+    assert client("DBSIZE") == 0
+    assert all(client("GET", f"key:{i}") is None for i in range(30))
+
+def test_keyspace_commands_refused_where_they_would_see_one_worker(workers):
+    client = workers.client()
+    assert client("MULTI") == b"OK"
+    assert isinstance(client("DBSIZE"), ErrorReply)
+    assert client("EXEC").startswith(b"EXECABORT")
+    reply = client("EVAL", "return call('KEYS', '*')", 0)
+    assert isinstance(reply, ErrorReply) and b"--workers" in reply
+
+def worker_client(server, index):
+    #connected to one worker's own port, so the worker serving it is known
+    client = Client(server.port + 1 + index)
+    server.clients.append(client)
+    return client
+
+def foreign_key(client, prefix):
+    #a key owned by some worker other than the one serving client, and that worker's index
+    nodes = client("CLUSTER", "NODES").decode().splitlines()
+    myself = next(i for i, line in enumerate(nodes) if "myself" in line)
+    ranges = client("CLUSTER", "SLOTS")
+    ports = [int(line.split()[1].split("@")[0].rsplit(":", 1)[1]) for line in nodes]
+    for i in count():
+        key = f"{prefix}:{i}"
+        slot = client("CLUSTER", "KEYSLOT", key)
+        owner = ports.index(next(node[1] for first, last, node in ranges if first <= slot <= last))
+        if owner != myself:
+            return key, owner
+
+def test_blocking_commands_wait_on_the_owning_worker(workers):
+    blocked, other = worker_client(workers, 0), worker_client(workers, 0)
+    key, _ = foreign_key(blocked, "list")
+    blocked.send("BLPOP", key, 5)
+    #the shared link to the owner keeps serving other clients meanwhile
+    assert other("SET", key + ":x", "1") == b"OK"
+    assert other("RPUSH", key, "v") == 1
+    assert blocked.read() == [key.encode(), b"v"]
+    assert blocked("BLPOP", key, 0.1) is None
+    stream, _ = foreign_key(blocked, "stream")
+    blocked.send("XREAD", "BLOCK", 5000, "STREAMS", stream, "0-0")
+    blocked.send("PING")
+    entry_id = other("XADD", stream, "*", "f", "v")
+    assert blocked.read() == [[stream.encode(), [[entry_id, [b"f", b"v"]]]]]
+    assert blocked.read() == b"PONG"
+
+def test_disconnect_cancels_proxied_blocking_command(workers):
+    blocked = worker_client(workers, 0)
+    key, owner = foreign_key(blocked, "list")
+    watcher = worker_client(workers, owner)
+    blocked.send("BLPOP", key, 0)
+    wait_for(lambda: watcher.info("clients")["blocked_clients"] == "1")
+    blocked.close()
+    wait_for(lambda: watcher.info("clients")["blocked_clients"] == "0")
+    watcher("RPUSH", key, "v")
+    assert watcher("LRANGE", key, 0, -1) == [b"v"]
+
+def test_transaction_on_another_workers_key_is_refused(workers):
+    client = worker_client(workers, 0)
+    key, _ = foreign_key(client, "key")
+    assert client("MULTI") == b"OK"
+    reply = client("SET", key, "1")
+    assert isinstance(reply, ErrorReply) and b"--workers" in reply
+    assert client("EXEC").startswith(b"EXECABORT")
+    assert client("GET", key) is None
+
+#one valid call of every command with keys; {k} is a hash tag, so all keys of a call share a slot
+KEYED_CALLS = [
+    ("SET", "{k}s", "1"), ("GET", "{k}s"), ("INCR", "{k}n"), ("DECR", "{k}n"), ("INCRBY", "{k}n", 5),
+    ("DECRBY", "{k}n", 2), ("EXISTS", "{k}s", "{k}n"), ("TYPE", "{k}s"), ("OBJECT", "ENCODING", "{k}n"),
+    ("PEXPIREAT", "{k}s", 1 << 50), ("MSET", "{k}a", "1", "{k}b", "2"), ("MSETNX", "{k}c", "1", "{k}d", "2"),
+    ("MGET", "{k}a", "{k}b"), ("DEL", "{k}a"), ("UNLINK", "{k}b"),
+    ("RPUSH", "{k}l", "a", "b", "c", "d"), ("LPUSH", "{k}l", "z"), ("LPOP", "{k}l"), ("RPOP", "{k}l"),
+    ("LRANGE", "{k}l", 0, -1), ("LLEN", "{k}l"), ("LMOVE", "{k}l", "{k}m", "LEFT", "RIGHT"),
+    ("BLMOVE", "{k}l", "{k}m", "LEFT", "RIGHT", 1), ("BLPOP", "{k}m", 1), ("BRPOP", "{k}l", "{k}m", 1),
+    ("HSET", "{k}h", "f", "1"), ("HGET", "{k}h", "f"), ("HGETALL", "{k}h"), ("HINCRBY", "{k}h", "f", 1),
+    ("HLEN", "{k}h"), ("HDEL", "{k}h", "f"),
+    ("SADD", "{k}t", "m"), ("SISMEMBER", "{k}t", "m"), ("SMEMBERS", "{k}t"), ("SCARD", "{k}t"), ("SREM", "{k}t", "m"),
+    ("ZADD", "{k}z", 1, "m"), ("ZRANGE", "{k}z", 0, -1), ("ZRANGEBYSCORE", "{k}z", 0, 2), ("ZRANK", "{k}z", "m"),
+    ("ZSCORE", "{k}z", "m"), ("ZCARD", "{k}z"), ("ZREM", "{k}z", "m"),
+    ("XADD", "{k}x", "*", "f", "v"), ("XRANGE", "{k}x", "-", "+"), ("XREVRANGE", "{k}x", "+", "-"),
+    ("XLEN", "{k}x"), ("XTRIM", "{k}x", "MAXLEN", 10), ("XSETID", "{k}x", "99999999999999-0"),
+]
+
+def calls(client, command):
+    stat = client.info("commandstats").get(f"cmdstat_{command.lower()}")
+    return 0 if stat is None else int(stat.split(",")[0].split("=")[1])
+
+def test_every_keyed_command_runs_on_the_owning_worker(workers):
+    assert {call[0].encode() for call in KEYED_CALLS} == set(COMMAND_KEYS)
+    client = worker_client(workers, 0)
+    tag, owner = foreign_key(client, "tag")
+    shard = worker_client(workers, owner)
+    for command, *args in KEYED_CALLS:
+        args = [arg.replace("{k}", "{%s}" % tag) if isinstance(arg, str) else arg for arg in args]
+        before, local = calls(shard, command), calls(client, command)
+        reply = client(command, *args)
+        assert not isinstance(reply, ErrorReply), (command, reply)
+        assert calls(shard, command) == before + 1, command
+        assert calls(client, command) == local, command